@@ -0,0 +1,90 @@
+import logging
+import sys
+from collections import deque
+
+from TransactionLogging import log_enabled, STEGANOGRAPHY
+from constants import T1_DECODER_WINDOW, T1_DECODER_MIN_SAMPLES
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                    handlers=[logging.StreamHandler(sys.stdout)])
+
+
+def two_means(sorted_values):
+    """
+    Exact two-cluster k-means of one-dimensional values: the split of the sorted values with the smallest sum of
+    squared distances to the two cluster means.
+
+    :param sorted_values: at least two values in ascending order
+    :returns: (mean of the lower cluster, mean of the upper cluster)
+    """
+    num_values = len(sorted_values)
+    prefix_sums = [0.0]
+    prefix_squares = [0.0]
+    for value in sorted_values:
+        prefix_sums.append(prefix_sums[-1] + value)
+        prefix_squares.append(prefix_squares[-1] + value * value)
+    best = None
+    for split in range(1, num_values):
+        lower_sum, upper_sum = prefix_sums[split], prefix_sums[-1] - prefix_sums[split]
+        # Sum of squared distances to the mean = sum of squares - sum^2 / n, per cluster
+        cost = (prefix_squares[-1] - lower_sum * lower_sum / split
+                - upper_sum * upper_sum / (num_values - split))
+        if best is None or cost < best[0]:
+            best = (cost, lower_sum / split, upper_sum / (num_values - split))
+    return best[1], best[2]
+
+
+class AdaptiveDelayDecoder:
+    """Classify the round trip times of one session into delayed and undelayed packets. The RTTs of the last
+        T1_DECODER_WINDOW packets are kept per function code. The lower of two clusters (k-means) of a window is the
+        learned baseline RTT, e.g. shifted by network throttling or cache hits, the upper cluster are the packets
+        delayed by the proxy server. A packet counts as delayed, if its RTT is above the middle of both clusters, or
+        half the embedding delay above the baseline if the window holds one cluster only."""
+
+    def __init__(self, delay_time, window=T1_DECODER_WINDOW, min_samples=T1_DECODER_MIN_SAMPLES):
+        """
+        :param delay_time: delay in seconds, with which the proxy server embeds a bit (T1_DELAY_TIME)
+        """
+        self._delay_time = delay_time
+        self._window = window
+        self._min_samples = min_samples
+        self._rtts = {}
+
+    def threshold(self, function_code):
+        """
+        :returns: RTT in seconds above which a packet with this function code counts as delayed
+        """
+        # The fastest packet in the windows of the session is undelayed. The first packets of a session may all be
+        # delayed, until then the RTT of an undelayed packet is assumed to be far below the delay
+        if sum(len(window) for window in self._rtts.values()) < self._min_samples:
+            fastest = 0.0
+        else:
+            fastest = min(min(window) for window in self._rtts.values() if window)
+        rtts = self._rtts.get(function_code)
+        if rtts is None or len(rtts) < self._min_samples:
+            # Not enough packets of this function code yet
+            return fastest + self._delay_time / 2
+        sorted_rtts = sorted(rtts)
+        lower_mean, upper_mean = two_means(sorted_rtts)
+        if upper_mean - lower_mean >= self._delay_time / 2:
+            return (lower_mean + upper_mean) / 2
+        # Only one cluster in the window, the split is noise. It holds the undelayed packets, unless it is far above
+        # the fastest packet of the session, e.g. while a run of bits delays every packet of this function code
+        median = sorted_rtts[len(sorted_rtts) // 2]
+        baseline = median if median - fastest < self._delay_time / 2 else fastest
+        return baseline + self._delay_time / 2
+
+    def is_delayed(self, function_code, rtt):
+        """
+        Classify the RTT of a packet and add it to the window of its function code.
+
+        :returns: True if the packet was delayed by the proxy server
+        """
+        threshold = self.threshold(function_code)
+        rtts = self._rtts.get(function_code)
+        if rtts is None:
+            rtts = self._rtts[function_code] = deque(maxlen=self._window)
+        rtts.append(rtt)
+        if log_enabled(STEGANOGRAPHY):
+            logging.info(f"RTT {rtt:.6f}s of function code {function_code}, delay threshold {threshold:.6f}s")
+        return rtt >= threshold
@@ -4,75 +4,96 @@ import time
 import struct
 from socket import AF_UNSPEC, SOCK_STREAM
 from pyModbusTCP.client import ModbusClient as BaseModbusClient
-from constants import HEADER_BITS_LENGTH, THROTTLING_TIME, RTT_VARIANZ
+from constants import T1_DELAY_TIME
 from pyModbusTCP.constants import MB_CONNECT_ERR,MB_SOCK_CLOSE_ERR, MB_SEND_ERR, MB_TIMEOUT_ERR
+from pyModbusTCP.constants import (READ_HOLDING_REGISTERS, WRITE_SINGLE_REGISTER, WRITE_MULTIPLE_REGISTERS,
+                                   WRITE_READ_MULTIPLE_REGISTERS)
+from TransactionLogging import log_enabled, start_transaction, STEGANOGRAPHY
+from PacketTrace import trace_enabled, trace_transaction
+from CovertChunks import CovertFrameReader, CovertMessageAssembler, HiddenMessageSink
+from AdaptiveDelayDecoder import AdaptiveDelayDecoder
 import logging
 import sys
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
                     handlers=[logging.StreamHandler(sys.stdout)])
 
-class ReadMsgT1:
-    """This class extract hidden message from proxy server embedded with inter-packet-time methods"""
-    hidden_message_t1 = ''
-    msg_bits = ''
-    bits_message_counter = 0
-    stop_read_msg = False
-    request_send_time = None
-    response_receive_time = None
+# Delay in seconds, with which a bit is embedded, must match T1_DELAY_TIME of the proxy server
+T1_DELAY_TIME = float(os.getenv('T1_DELAY_TIME', T1_DELAY_TIME))
 
-    @staticmethod
-    def resolve_hidden_message_s1(function_code, collapsed_time):
+# Function codes of the responses accepted by the application-layer filter
+SUPPORTED_FUNCTION_CODES = (READ_HOLDING_REGISTERS, WRITE_SINGLE_REGISTER, WRITE_MULTIPLE_REGISTERS,
+                            WRITE_READ_MULTIPLE_REGISTERS)
+
+
+class ReadMsgT1:
+    """This class extract hidden message from proxy server embedded with inter-packet-time methods. Each session of a
+        CustomModbusClient has a decoder of its own, which learns the baseline RTT of the session and reads the chunk
+        frames of its responses. The proxy server stripes the message in sequence-numbered chunks over all client
+        sessions, the chunks of all clients of this process are reassembled by one CovertMessageAssembler and the
+        completed message is published to the sink."""
+    assembler = CovertMessageAssembler()
+    sink = HiddenMessageSink()
+
+    def __init__(self, delay_time=T1_DELAY_TIME):
+        self._frame_reader = CovertFrameReader(ReadMsgT1.assembler)
+        self._delay_decoder = AdaptiveDelayDecoder(delay_time)
+
+    def resolve_hidden_message_t1(self, function_code, collapsed_time):
         """
-            this method resolves and add bit to the result string `hidden_message_s1`. A modbus/TCP packet with even length
-            represents a bit 1 and a modbus/TCP packet with odd length represents a bit 0.
+            this method resolves the bit encoded in the round trip time of a modbus/TCP packet and hands it to the frame
+            reader of the session. A delayed read request represents a bit 1 and a delayed write request represents a
+            bit 0, a packet which is not delayed represents no bit.
 
             :param function_code: function code of current modbus/TCP packet
             :param collapsed_time: round trip time from sending time of a modbus/TCP request
                                    to receiving time of a modbus/TCP response
         """
-        if len(ReadMsgT1.msg_bits) < HEADER_BITS_LENGTH:
-            ReadMsgT1.resolve_length_message(function_code, collapsed_time)
-        else:
-            if ReadMsgT1.bits_message_counter > 0:
-                msg_changed, temp_hidden_message = ReadMsgT1.delay_logic(
-                    collapsed_time,
-                    function_code,
-                    ReadMsgT1.hidden_message_t1
-                )
-
-                if msg_changed:
-                    ReadMsgT1.hidden_message_t1 = temp_hidden_message
-                    ReadMsgT1.bits_message_counter -= 1
-
-                logging.info(f"Reading hidden message: {ReadMsgT1.hidden_message_t1}")
-            else:
-                logging.info(f"Read hidden message complete. Full message: {ReadMsgT1.hidden_message_t1}")
-                ReadMsgT1.stop_read_msg = True
-
-    @classmethod
-    def resolve_length_message(cls, function_code, collapsed_time):
-        _, cls.msg_bits = cls.delay_logic(collapsed_time,function_code, cls.msg_bits)
-        logging.info(f"hidden message header in bits: {cls.msg_bits}")
-        if len(cls.msg_bits) == HEADER_BITS_LENGTH:
-            cls.bits_message_counter = int(cls.msg_bits, 2)
-            logging.info(f"number of bits to read: {cls.bits_message_counter}")
-
-    @staticmethod
-    def delay_logic(rtt, function_code, bit_sequence):
-        read_msg_changed = False
-        # In order to calculate steganography delay, throttling must be known beforehand by message receiver
-
-        if 0.25 <= rtt + RTT_VARIANZ < 0.5 and function_code == 3:
-            bit_sequence += '1'
-            read_msg_changed = True
+        if ReadMsgT1.assembler.complete:
+            return
+        bit = self.delay_logic(collapsed_time, function_code)
+        if bit is None:
+            return
+        if log_enabled(STEGANOGRAPHY):
+            logging.info(f"Reading hidden bit: {bit}")
+        message = self._frame_reader.feed(bit)
+        if message is not None:
+            logging.info(f"Read hidden message complete. Full message: {message}")
+            ReadMsgT1.sink.publish(message)
+
+    def delay_logic(self, rtt, function_code):
+        """
+        :returns: the bit encoded by a delayed packet, None if the packet is not delayed
+        """
+        # The proxy server delays read and write single register requests only, the RTT of bulk requests (FC16,
+        # FC23) is not learned
+        if function_code != 3 and function_code != 6:
+            return None
+        # The delay decoder learns the RTT of undelayed packets of the session, e.g. with network throttling
+        if not self._delay_decoder.is_delayed(function_code, rtt):
+            return None
+        if function_code == 3:
+            return 1
+        if function_code == 6:
+            return 0
+        return None
 
-        if 0.25 <= rtt + RTT_VARIANZ < 0.5 and function_code == 6:
-            bit_sequence += '0'
-            read_msg_changed = True
 
-        return read_msg_changed, bit_sequence
 class CustomModbusClient(BaseModbusClient):
+    # Record of the current transaction, which is written as one log line when the response arrives. None if the
+    # transaction is not logged
+    _record = None
+    # Last request sent, it is traced together with its response
+    _request_frame = None
+    # Unit id of the last request sent, the unit id of the client may change between requests to address several
+    # units behind a gateway
+    _request_unit_id = None
+    # Decoder of the hidden message embedded with inter-packet-times in the responses of the current session
+    _hidden_message_t1 = None
+    # Times of the last request and its response, the round trip time of each session is measured on its own
+    request_send_time = None
+    response_receive_time = None
+
     def open(self):
         """Connect to modbus server (open TCP connection).
 
@@ -119,6 +140,8 @@ class CustomModbusClient(BaseModbusClient):
         # check connect status
         if not self.is_open:
             raise BaseModbusClient._NetworkError(MB_CONNECT_ERR, 'connection refused')
+        # A new session at the proxy server, the chunk read incompletely in the previous session is sent again
+        self._hidden_message_t1 = ReadMsgT1()
 
     def _send(self, frame):
         """Send frame over current socket.
@@ -133,8 +156,7 @@ class CustomModbusClient(BaseModbusClient):
         try:
             self._sock.send(frame)
             # Record the time when the Modbus/TCP response is sent
-            ReadMsgT1.request_send_time = time.time()
-            logging.info(f"Request sent at: {ReadMsgT1.request_send_time}")
+            self.request_send_time = time.time()
 
         except socket.timeout:
             self._sock.close()
@@ -157,11 +179,15 @@ class CustomModbusClient(BaseModbusClient):
         self._transaction_id += 1
         protocol_id = 0
         length = len(pdu) + 1
-        mbap = struct.pack('>HHHB', self._transaction_id, protocol_id, length, self.unit_id)
+        self._request_unit_id = self.unit_id
+        mbap = struct.pack('>HHHB', self._transaction_id, protocol_id, length, self._request_unit_id)
 
-        self.mbap_header_logging(self._transaction_id, protocol_id, length, self.unit_id, "Request")
-        self.pdu_body_logging(pdu, "Request")
+        self._record = start_transaction()
+        self.mbap_header_logging(self._record, self._transaction_id, protocol_id, length, self.unit_id, "Request")
+        self.pdu_body_logging(self._record, pdu, "Request")
         # full modbus/TCP frame = [MBAP]PDU
+        if trace_enabled():
+            self._request_frame = mbap + pdu
 
         return mbap + pdu
 
@@ -189,16 +215,22 @@ class CustomModbusClient(BaseModbusClient):
         self.check_response_pdu_body(rx_pdu, min_len)
 
         # Record the time when the Modbus/TCP response is received
-        ReadMsgT1.response_receive_time = time.time()
-        logging.info(f"Response received at: {ReadMsgT1.response_receive_time}")
-        collapsed_time = ReadMsgT1.response_receive_time - ReadMsgT1.request_send_time
-        logging.info(f"Round-trip-time: {collapsed_time}")
+        self.response_receive_time = time.time()
+        collapsed_time = self.response_receive_time - self.request_send_time
+        if self._record is not None:
+            self._record.round_trip_time("Round-trip-time", collapsed_time)
+            self._record.emit()
+        if self._request_frame is not None:
+            trace_transaction(self.request_send_time,
+                              collapsed_time,
+                              self._request_frame,
+                              memoryview(self._request_frame)[7:],
+                              rx_mbap + rx_pdu)
         function_code = struct.unpack('>B', rx_pdu[0:1])[0]
 
         # Check if there is hidden message to read
         if os.getenv('APPLY_INTER_PACKET_TIMES', False):
-            if not ReadMsgT1.stop_read_msg:
-                ReadMsgT1.resolve_hidden_message_s1(function_code, collapsed_time)
+            self._hidden_message_t1.resolve_hidden_message_t1(function_code, collapsed_time)
 
         # for auto_close mode, close socket after each request
         if self.auto_close:
@@ -210,13 +242,13 @@ class CustomModbusClient(BaseModbusClient):
 
     def check_response_mbap_header(self, f_transaction_id, f_protocol_id, f_length, f_unit_id, rx_mbap):
         # print out Response header
-        self.mbap_header_logging(f_transaction_id, f_protocol_id, f_length, f_unit_id, "Response")
+        self.mbap_header_logging(self._record, f_transaction_id, f_protocol_id, f_length, f_unit_id, "Response")
 
         # check MBAP fields
         f_transaction_err = f_transaction_id != self._transaction_id
         f_protocol_err = f_protocol_id != 0
         f_length_err = f_length >= 256
-        f_unit_id_err = f_unit_id != self.unit_id
+        f_unit_id_err = f_unit_id != self._request_unit_id
 
         # checking error status of fields
         if f_transaction_err or f_protocol_err or f_length_err or f_unit_id_err:
@@ -227,9 +259,10 @@ class CustomModbusClient(BaseModbusClient):
     def check_response_pdu_body(self, rx_pdu, min_len):
         # check function code from recv PDU
         rx_function_code = struct.unpack('B', rx_pdu[0:1])[0]
-        self.pdu_body_logging(rx_pdu, "Response")
-        if rx_function_code != 3 and rx_function_code != 6:
-            raise BaseModbusClient._NetworkError(4, 'Function code is not 3 or 6')
+        self.pdu_body_logging(self._record, rx_pdu, "Response")
+        # An exception response carries the function code of the request with bit 0x80 set
+        if rx_function_code & 0x7F not in SUPPORTED_FUNCTION_CODES:
+            raise BaseModbusClient._NetworkError(4, 'Function code is not 3, 6, 16 or 23')
 
         # check PDU length for global minimal frame (an except frame: func code + exp code)
         if len(rx_pdu) < 2:
@@ -245,17 +278,13 @@ class CustomModbusClient(BaseModbusClient):
             raise BaseModbusClient._NetworkError(4, 'PDU length is too short for current request')
 
     @staticmethod
-    def mbap_header_logging(transaction_id, protocol_id, length, unit_id, packet_type):
-        logging.info(f"{packet_type} header:")
-        logging.info(f"{packet_type}_TID: {transaction_id}")
-        logging.info(f"{packet_type}_PID: {protocol_id}")
-        logging.info(f"{packet_type}_LF: {length}")
-        logging.info(f"{packet_type}_UID: {unit_id}")
-        logging.info("----------------------------------")
+    def mbap_header_logging(record, transaction_id, protocol_id, length, unit_id, packet_type):
+        """Add the header of a modbus/TCP packet to the record of its transaction"""
+        if record is not None:
+            record.header(packet_type, transaction_id, protocol_id, length, unit_id)
 
     @staticmethod
-    def pdu_body_logging(pdu_body, packet_type):
-        function_code = struct.unpack('B', pdu_body[0:1])[0]
-        logging.info(f"{packet_type} PDU:")
-        logging.info(f"{packet_type}_FC: {function_code}")
-        logging.info("---------------------------------")
+    def pdu_body_logging(record, pdu_body, packet_type):
+        """Add the function code of a modbus/TCP packet to the record of its transaction"""
+        if record is not None:
+            record.field(f"{packet_type}_FC", pdu_body[0])
@@ -0,0 +1,178 @@
+import atexit
+import os
+import struct
+import threading
+
+# This module is used by all segments (modbus-client, proxy-server and modbus-server) and by the analysers in
+# TestResults. Each of them is built or run on its own, so every directory holds an identical copy of it.
+
+# One fixed-width record per modbus/TCP transaction, little endian without padding:
+# request time (epoch seconds), round-trip-time (seconds), request TID, response TID, PID, request LF, response LF,
+# UID, function code, register address, quantity of registers, register value, flags
+TRACE_RECORD = struct.Struct('<ddHHHHHBBHHHB')
+TRACE_FIELDS = ('request_time', 'round_trip_time', 'request_tid', 'response_tid', 'protocol_id', 'request_lf',
+                'response_lf', 'unit_id', 'function_code', 'address', 'quantity', 'value', 'flags')
+TRACE_DTYPE = ('<f8', '<f8', '<u2', '<u2', '<u2', '<u2', '<u2', 'u1', 'u1', '<u2', '<u2', '<u2', 'u1')
+
+TRACE_CACHE_HIT = 0x01  # response was built from the cache of the proxy server
+TRACE_EXCEPTION = 0x02  # response is a modbus exception
+
+TRACE_MAX_BYTES = 64 * 1024 * 1024  # size of a trace file before it is rotated
+TRACE_BACKUP_COUNT = 5  # number of rotated trace files which are kept
+TRACE_BUFFER_RECORDS = 256  # records collected in memory before they are appended to the trace file
+TRACE_FLUSH_INTERVAL = 1  # interval in seconds in which buffered records are appended to the trace file
+
+_MBAP_HEADER = struct.Struct('>HHHB')
+_ADDRESS_QUANTITY = struct.Struct('>HH')
+_REGISTER = struct.Struct('>H')
+
+_trace = None
+
+
+class PacketTrace:
+    """Append-only binary trace file. Records are collected in a buffer and appended to the file as a whole, the file
+        is rotated like a log file (`trace.bin` -> `trace.bin.1` -> ... -> `trace.bin.<backup_count>`) when it
+        exceeds `max_bytes`. A record never spans two files."""
+
+    def __init__(self, path, max_bytes=TRACE_MAX_BYTES, backup_count=TRACE_BACKUP_COUNT):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backup_count = backup_count
+        self._lock = threading.Lock()
+        self._buffer = bytearray(TRACE_RECORD.size * TRACE_BUFFER_RECORDS)
+        self._buffered = 0
+        self._file = open(path, 'ab', buffering=0)
+        self._file_size = self._file.tell()
+        # Records of a process which is stopped are lost for at most TRACE_FLUSH_INTERVAL seconds
+        self._closed = threading.Event()
+        threading.Thread(target=self._flush_periodically, daemon=True).start()
+
+    def write(self, *fields):
+        """Add one record, fields in the order of TRACE_FIELDS"""
+        with self._lock:
+            TRACE_RECORD.pack_into(self._buffer, self._buffered * TRACE_RECORD.size, *fields)
+            self._buffered += 1
+            if self._buffered == TRACE_BUFFER_RECORDS:
+                self._flush()
+
+    def _flush(self):
+        if not self._buffered or self._closed.is_set():
+            return
+        num_bytes = self._buffered * TRACE_RECORD.size
+        if self._file_size > 0 and self._file_size + num_bytes > self._max_bytes:
+            self._rotate()
+        self._file.write(memoryview(self._buffer)[:num_bytes])
+        self._file_size += num_bytes
+        self._buffered = 0
+
+    def _rotate(self):
+        self._file.close()
+        for index in range(self._backup_count - 1, 0, -1):
+            if os.path.exists(f"{self._path}.{index}"):
+                os.replace(f"{self._path}.{index}", f"{self._path}.{index + 1}")
+        if self._backup_count > 0:
+            os.replace(self._path, f"{self._path}.1")
+        else:
+            os.remove(self._path)
+        self._file = open(self._path, 'ab', buffering=0)
+        self._file_size = 0
+
+    def _flush_periodically(self):
+        while not self._closed.wait(TRACE_FLUSH_INTERVAL):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._closed.set()
+            self._file.close()
+
+
+def setup_trace():
+    """Open the trace file given by the environment variable PACKET_TRACE_FILE. Without it no trace is written.
+        Calling it again has no effect."""
+    global _trace
+    path = os.getenv('PACKET_TRACE_FILE')
+    if _trace is not None or not path:
+        return
+    _trace = PacketTrace(path)
+    # Write the buffered records before the process exits
+    atexit.register(_trace.close)
+
+
+def trace_enabled():
+    return _trace is not None
+
+
+def trace_transaction(request_time, round_trip_time, request_mbap_header, request_pdu_body, response_frame, flags=0):
+    """
+    Write the trace record of a transaction, if a trace file is open.
+
+    :param request_time: time when the request was received or sent
+    :param round_trip_time: time until the response was sent or received
+    :param request_mbap_header: MBAP header of the request
+    :param request_pdu_body: PDU payload of the request
+    :param response_frame: whole modbus/TCP response (MBAP header and PDU payload)
+    :param flags: TRACE_CACHE_HIT if the response was built from cache
+    """
+    if _trace is None or len(request_pdu_body) < 5:
+        return
+    (request_tid, protocol_id, request_lf, unit_id) = _MBAP_HEADER.unpack_from(request_mbap_header)
+    (response_tid, _, response_lf, _) = _MBAP_HEADER.unpack_from(response_frame)
+    function_code = request_pdu_body[0]
+    (address, quantity) = _ADDRESS_QUANTITY.unpack_from(request_pdu_body, 1)
+    value = 0
+    response_function_code = response_frame[7]
+    if response_function_code >= 0x80:
+        flags |= TRACE_EXCEPTION
+    elif function_code == 3 or function_code == 23:
+        # Only the value of the first register read is traced
+        if len(response_frame) >= 11:
+            value = _REGISTER.unpack_from(response_frame, 9)[0]
+    elif function_code == 6:
+        # The second field of write single register is the written value
+        (value, quantity) = (quantity, 1)
+    elif function_code == 16 and len(request_pdu_body) >= 8:
+        value = _REGISTER.unpack_from(request_pdu_body, 6)[0]
+    _trace.write(request_time, round_trip_time, request_tid, response_tid, protocol_id, request_lf, response_lf,
+                 unit_id, function_code, address, quantity, value, flags)
+
+
+def trace_files(path):
+    """Return the trace file and its rotated files, oldest first"""
+    files = []
+    index = 1
+    while os.path.exists(f"{path}.{index}"):
+        files.append(f"{path}.{index}")
+        index += 1
+    files.reverse()
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def read_trace(path, chunk_records=65536):
+    """
+    Read a trace file and its rotated files.
+
+    :param path: path of the trace file, e.g. the value of PACKET_TRACE_FILE
+    :param chunk_records: maximum number of records per array
+    :returns: generator of NumPy structured arrays with the fields of TRACE_FIELDS
+    """
+    # NumPy is only needed by the analysers, the segments write traces without it
+    import numpy as np
+    dtype = np.dtype(list(zip(TRACE_FIELDS, TRACE_DTYPE)))
+    chunk_size = chunk_records * TRACE_RECORD.size
+    for file_path in trace_files(path):
+        with open(file_path, 'rb') as file:
+            while True:
+                data = file.read(chunk_size)
+                # An incomplete record at the end of a file which is still written is skipped
+                num_records = len(data) // TRACE_RECORD.size
+                if num_records == 0:
+                    break
+                yield np.frombuffer(data, dtype=dtype, count=num_records)
@@ -4,13 +4,36 @@ import random
 import logging
 import sys
 from CustomModbusClient import CustomModbusClient
-from constants import STARTING_ADDRESS, REQUEST_DURATION, PROXY_SERVER_PORT
+from TransactionLogging import setup_logging
+from PacketTrace import setup_trace
+from constants import STARTING_ADDRESS, REQUEST_DURATION, PROXY_SERVER_PORT, BULK_QUANTITY
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
-                    handlers=[logging.StreamHandler(sys.stdout)])
+# Configure logging. Log lines are written by a background thread
+setup_logging()
+setup_trace()
 
 proxy_server_name = os.getenv('PROXY_SERVER_NAME', 'localhost')
+# Number of registers written by one bulk request, set in the docker-compose file
+bulk_quantity = int(os.getenv('BULK_QUANTITY', BULK_QUANTITY))
+
+
+def parse_unit_ids(unit_ids):
+    """
+    :param unit_ids: comma separated unit ids and ranges of unit ids, e.g. "1-247" or "1,2,10-20"
+    :returns: list of unit ids
+    """
+    result = []
+    for part in unit_ids.split(','):
+        first, _, last = part.strip().partition('-')
+        result.extend(range(int(first), int(last or first) + 1))
+    if not all(0 <= unit_id <= 255 for unit_id in result):
+        raise ValueError(f"Unit ids must be between 0 and 255: {unit_ids}")
+    return result
+
+
+# Unit ids of the devices behind the gateway, each request is sent to one of them at random. Set in the
+# docker-compose file, if not set all requests are sent to unit id 1
+unit_ids = parse_unit_ids(os.getenv('UNIT_IDS', '1'))
 
 client = CustomModbusClient(host=proxy_server_name, port=PROXY_SERVER_PORT, auto_open=True)
 
@@ -45,6 +68,39 @@ def write_single_register():
         logging.error(f"Error during writing registers: {e}")
 
 
+def write_multiple_registers():
+    """writing random values into `bulk_quantity` holding registers at once (FC16). The result will be logged out
+        when response arrives"""
+    try:
+        writing_address = random.randint(STARTING_ADDRESS, STARTING_ADDRESS + 100 - bulk_quantity)
+        random_writing_values = [random.randint(0, 1000) for _ in range(bulk_quantity)]
+        logging.info(f"Request: Write {bulk_quantity} value(s) to register {writing_address}")
+        success = client.write_multiple_registers(writing_address, random_writing_values)
+        if success:
+            logging.info(f"Response: values {random_writing_values} are written to address {writing_address} \n\n")
+        else:
+            logging.error(f"Failed to write to address {writing_address}")
+    except Exception as e:
+        logging.error(f"Error during writing registers: {e}")
+
+
+def write_read_multiple_registers():
+    """writing random values into `bulk_quantity` holding registers and reading them back in one request (FC23). The
+        result will be logged out when response arrives"""
+    try:
+        writing_address = random.randint(STARTING_ADDRESS, STARTING_ADDRESS + 100 - bulk_quantity)
+        random_writing_values = [random.randint(0, 1000) for _ in range(bulk_quantity)]
+        logging.info(f"Request: Write and read {bulk_quantity} value(s) at register {writing_address}")
+        result = client.write_read_multiple_registers(writing_address, random_writing_values, writing_address,
+                                                      bulk_quantity)
+        if result:
+            logging.info(f"Response: value {result} is read from address {writing_address} \n\n")
+        else:
+            logging.error(f"Failed to write and read at address {writing_address}")
+    except Exception as e:
+        logging.error(f"Error during writing and reading registers: {e}")
+
+
 try:
     # Check if client is opened for connection. If not, try to open a new connection
     if not client.is_open:
@@ -64,7 +120,16 @@ try:
             continue
 
         request_start_time = time.time()
-        if counter % 2 == 0:
+        # The response is checked against the unit id of its request
+        client.unit_id = random.choice(unit_ids)
+        if bulk_quantity > 1 and counter % 4 == 3:
+            # Every fourth request is a bulk request, the read and write single register requests carry the
+            # inter-packet-times steganography
+            if counter % 8 == 3:
+                write_multiple_registers()
+            else:
+                write_read_multiple_registers()
+        elif counter % 2 == 0:
             read_holding_register()
         else:
             write_single_register()
@@ -1,7 +1,7 @@
-HEADER_BITS_LENGTH = 10  # 10 first bits in steganography message will be used to represent number of bits in embedded
-                         # message (exclude first 10 bits)
 STARTING_ADDRESS = 0  # There are 100 holding registers in databank at server. There index start with 0
 PROXY_SERVER_PORT = 502
 REQUEST_DURATION = 1800
-THROTTLING_TIME = 0.07
-RTT_VARIANZ = 0.005
\ No newline at end of file
+BULK_QUANTITY = 1  # Registers written by one bulk request (FC16 and FC23), with 1 no bulk requests are sent
+T1_DELAY_TIME = 0.25  # Delay in seconds, with which the proxy server embeds a bit with inter-packet-times
+T1_DECODER_WINDOW = 64  # Number of last round trip times per function code, from which the baseline RTT is learned
+T1_DECODER_MIN_SAMPLES = 8  # Number of round trip times of a function code needed before its window is clustered
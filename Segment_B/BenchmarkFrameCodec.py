@@ -0,0 +1,133 @@
+import logging
+import struct
+import sys
+import timeit
+
+from ModbusFrame import ModbusFrame, REQUEST_PDU, FC_BYTE_COUNT, REGISTER
+from ProtocolNormalisation import ProtocolNormalisation, Transaction
+from SteganographySizeModulationMethod import add_dummy_bytes_request
+from TransactionLogging import log_enabled, STEGANOGRAPHY, NORMALISATION
+from constants import DUMMY_EMBEDDED_BYTE
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                    handlers=[logging.StreamHandler(sys.stdout)])
+
+# Microbenchmark of the CPU cost per transaction of the frame handling in the proxy server, without sockets, cache
+# lookups and logging. usage: python BenchmarkFrameCodec.py [number of transactions]
+
+REQUEST = struct.pack('>HHHB', 1, 0, 6, 1) + REQUEST_PDU.pack(3, 10, 1)
+RESPONSE = struct.pack('>HHHB', 0, 0, 5, 1) + FC_BYTE_COUNT.pack(3, 2) + REGISTER.pack(829)
+
+
+class SingleTransactionTable:
+    """Transaction table holding the same transaction for every request, so that only the frame handling is
+        measured"""
+
+    def __init__(self):
+        self._transaction = Transaction(1, 0, None)
+
+    def register(self, client_tid, context=None):
+        return self._transaction
+
+    def resolve(self, upstream_tid):
+        return self._transaction
+
+
+def add_one_byte_request_with_slices(mbap_header_tuple, function_code, pdu_body_raw):
+    """add_one_byte_request before ModbusFrame"""
+    (transaction_id, protocol_id, length, unit_id) = mbap_header_tuple
+    if function_code == 3 or function_code == 6:
+        new_mbap_header = struct.pack('>HHHB', transaction_id, protocol_id, length + 1, unit_id)
+        return new_mbap_header + pdu_body_raw + struct.pack('B', DUMMY_EMBEDDED_BYTE)
+
+
+def s1_size_modulation_with_slices(modbus_message):
+    """S1SizeModulation.s1_size_modulation before ModbusFrame, a bit which needs an additional byte"""
+    mbap_header = modbus_message[:7]
+    pdu_body = modbus_message[7:]
+    mbap_header_tuple = struct.unpack('>HHHB', mbap_header)
+    function_code = struct.unpack('B', pdu_body[:1])[0]
+    log_enabled(STEGANOGRAPHY)
+    return add_one_byte_request_with_slices(mbap_header_tuple, function_code, pdu_body)
+
+
+def normalise_request_with_slices(mbap_header, pdu_body, transaction_table):
+    """ProtocolNormalisation.normalise_request before ModbusFrame"""
+    (transaction_id, protocol_id, length, unit_id) = struct.unpack('>HHHB', mbap_header)
+    log_enabled(NORMALISATION)
+    transaction = transaction_table.register(transaction_id)
+    new_mbap_header = struct.pack('>HHHB', transaction.upstream_tid, protocol_id, length, unit_id)
+    return new_mbap_header + pdu_body, transaction
+
+
+def normalise_response_with_slices(mbap_header, pdu_body, transaction_table):
+    """ProtocolNormalisation.normalise_response before ModbusFrame"""
+    (transaction_id, protocol_id, length, unit_id) = struct.unpack('>HHHB', mbap_header)
+    log_enabled(NORMALISATION)
+    transaction = transaction_table.resolve(transaction_id)
+    new_mbap_header = struct.pack('>HHHB', transaction.client_tid, protocol_id, length, unit_id)
+    return new_mbap_header + pdu_body, transaction
+
+
+def transaction_with_slices(transaction_table, request_data, response_data):
+    """Frame handling of the proxy server before ModbusFrame: every stage slices the frame, unpacks the MBAP header
+        again and builds a new packet by concatenation"""
+    # handle_client
+    request_mbap_header = request_data[:7]
+    request_pdu_body = request_data[7:]
+    (transaction_id, protocol_id, length, unit_id) = struct.unpack('>HHHB', request_mbap_header)
+    function_code = struct.unpack('B', request_pdu_body[:1])[0]
+    # Caching.check_if_value_in_cache
+    (function_code, start_address, quantity_to_read) = struct.unpack('>BHH', request_pdu_body)
+    embedded_request = s1_size_modulation_with_slices(request_data)
+    request_mbap_header = embedded_request[:7]
+    request_pdu_body = embedded_request[7:]
+    normalised_request, _ = normalise_request_with_slices(request_mbap_header, request_pdu_body, transaction_table)
+    # handle_client, response from server
+    response_mbap_header = response_data[:7]
+    transaction_id_res = struct.unpack('>H', response_mbap_header[:2])[0]
+    response_pdu_body = response_data[7:]
+    function_code = struct.unpack('B', response_pdu_body[:1])[0]
+    # Caching.store_read_response
+    (_, start_address, quantity_to_read) = struct.unpack('>BHH', request_pdu_body[:5])
+    (function_code, byte_count) = struct.unpack('>BB', response_pdu_body[:2])
+    normalised_response, _ = normalise_response_with_slices(response_mbap_header, response_pdu_body,
+                                                            transaction_table)
+    return normalised_request, normalised_response
+
+
+def transaction_with_frames(transaction_table, request_data, response_data):
+    """Frame handling of the proxy server with ModbusFrame: the header is parsed once per frame and rewritten in
+        place"""
+    request = ModbusFrame.parse(request_data)
+    (start_address, quantity_to_read) = request.address_and_quantity()
+    log_enabled(STEGANOGRAPHY)
+    request = add_dummy_bytes_request(request)
+    normalised_request, transaction = ProtocolNormalisation.normalise_request(request, transaction_table)
+    response = ModbusFrame.parse(response_data)
+    (start_address, quantity_to_read) = request.address_and_quantity()
+    (function_code, byte_count) = FC_BYTE_COUNT.unpack_from(response.raw, 7)
+    ProtocolNormalisation.normalise_response(response, transaction_table)
+    return normalised_request, response.raw
+
+
+def benchmark(transaction, number):
+    """
+    :returns: CPU time per transaction in microseconds, best of 5 runs
+    """
+    transaction_table = SingleTransactionTable()
+    request_data = memoryview(REQUEST)
+    response_data = memoryview(RESPONSE)
+    timer = timeit.Timer(lambda: transaction(transaction_table, request_data, response_data))
+    return min(timer.repeat(repeat=5, number=number)) / number * 1e6
+
+
+if __name__ == '__main__':
+    num_transactions = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    # The benchmark measures the frame handling, not the log lines of the stages
+    logging.disable(logging.INFO)
+    time_with_slices = benchmark(transaction_with_slices, num_transactions)
+    time_with_frames = benchmark(transaction_with_frames, num_transactions)
+    print(f"slices and struct.unpack: {time_with_slices:.2f} µs per transaction")
+    print(f"ModbusFrame:              {time_with_frames:.2f} µs per transaction")
+    print(f"speed-up:                 {time_with_slices / time_with_frames:.2f}x")
@@ -1,101 +1,466 @@
-import struct
+import heapq
 import time
 import logging
 import sys
+import threading
+from array import array
+from collections import OrderedDict
 
-from constants import CACHE_TTL
+from ModbusFrame import ModbusFrame, MBAP_HEADER, FC_BYTE_COUNT, PDU_DATA_OFFSET
+from TransactionLogging import log_enabled, CACHE
+from constants import (CACHE_TTL, CACHE_MAX_ENTRIES, NUM_REGISTERS, MAX_REGISTERS_PER_READ, MBAP_HEADER_SIZE,
+                       CACHE_PAGE_SIZE, CACHE_GENERATION_SLOTS)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
                     handlers=[logging.StreamHandler(sys.stdout)])
 
 
-class Caching:
-    """This class simulates caching mechanism. when response from read single holding register arrives at proxy server
-        , its value will be saved in cache. After an amount of time (10 seconds) this value will be removed, or when new
-        value is written to this holding register."""
+class RegisterPage:
+    """CACHE_PAGE_SIZE consecutive registers of a register map. Values, time of caching and validity are stored in
+        compact arrays indexed by the offset of the register in the page."""
+    __slots__ = ('values', 'timestamps', 'valid', 'num_valid')
+
+    def __init__(self):
+        self.values = array('H', bytes(2 * CACHE_PAGE_SIZE))
+        self.timestamps = array('d', bytes(8 * CACHE_PAGE_SIZE))
+        self.valid = bytearray(CACHE_PAGE_SIZE)
+        self.num_valid = 0
+
+
+class RegisterMap:
+    """Cached holding registers of one unit. The addresses are split into pages of CACHE_PAGE_SIZE registers, a page
+        is allocated with its first cached register and released with its last valid one. The memory of the cache
+        therefore follows the number of cached registers (CACHE_MAX_ENTRIES), not the number of units. A range of
+        registers is checked and copied page by page, without one dictionary lookup per register."""
+    __slots__ = ('pages', 'num_valid')
 
     def __init__(self):
-        self._cache = {}  # Dictionary to store cache data
+        self.pages = {}  # page index -> RegisterPage
+        self.num_valid = 0
+
+    def segments(self, start_address, quantity):
+        """
+        Split a range of registers at the page boundaries.
+
+        :returns: list of (page or None if not allocated, offset in page, first address, number of registers)
+        """
+        page_index, offset = divmod(start_address, CACHE_PAGE_SIZE)
+        if offset + quantity <= CACHE_PAGE_SIZE:
+            # Most reads lie in one page
+            return ((self.pages.get(page_index), offset, start_address, quantity),)
+        segments = []
+        address = start_address
+        end_address = start_address + quantity
+        while address < end_address:
+            page_index, offset = divmod(address, CACHE_PAGE_SIZE)
+            length = min(CACHE_PAGE_SIZE - offset, end_address - address)
+            segments.append((self.pages.get(page_index), offset, address, length))
+            address += length
+        return segments
+
+    def is_valid(self, address):
+        page = self.pages.get(address // CACHE_PAGE_SIZE)
+        return page is not None and page.valid[address % CACHE_PAGE_SIZE]
+
+    def timestamp(self, address):
+        """Time of caching of a valid register"""
+        return self.pages[address // CACHE_PAGE_SIZE].timestamps[address % CACHE_PAGE_SIZE]
+
+    def invalidate(self, address):
+        """
+        Mark one register as invalid, its page is released with its last valid register.
+
+        :returns: True if the register was valid
+        """
+        page_index, offset = divmod(address, CACHE_PAGE_SIZE)
+        page = self.pages.get(page_index)
+        if page is None or not page.valid[offset]:
+            return False
+        page.valid[offset] = 0
+        page.num_valid -= 1
+        self.num_valid -= 1
+        if page.num_valid == 0:
+            del self.pages[page_index]
+        return True
+
+    def store(self, start_address, values, current_time):
+        """Store the values of consecutive registers and mark them as valid"""
+        position = 0
+        for page, offset, address, length in self.segments(start_address, len(values)):
+            if page is None:
+                page = self.pages[address // CACHE_PAGE_SIZE] = RegisterPage()
+            newly_valid = length - page.valid.count(1, offset, offset + length)
+            page.values[offset:offset + length] = values[position:position + length]
+            page.timestamps[offset:offset + length] = array('d', [current_time]) * length
+            page.valid[offset:offset + length] = b'\x01' * length
+            page.num_valid += newly_valid
+            self.num_valid += newly_valid
+            position += length
+
+    def get_values(self, start_address, quantity):
+        """
+        :returns: array('H') of the values of a range of valid registers
+        """
+        segments = self.segments(start_address, quantity)
+        if len(segments) == 1:
+            (page, offset, _, length) = segments[0]
+            return page.values[offset:offset + length]
+        values = array('H')
+        for page, offset, _, length in segments:
+            values += page.values[offset:offset + length]
+        return values
+
+
+class CacheMetrics:
+    """Counters of the cache to tune CACHE_TTL and CACHE_MAX_ENTRIES against real traffic. Hits and misses are
+        counted per read request, evictions and expirations per register."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.partial_hits = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class Caching:
+    """This class simulates caching mechanism. when response from read holding registers arrives at proxy server
+        , its values will be saved in cache. After an amount of time (CACHE_TTL seconds) these values are not valid
+        anymore, or when new value is written to one of these holding registers. There is one register map per unit
+        id, a read of any quantity of registers is answered from cache if all registers of the range are valid.
+
+        Each stored range is pushed on a min-heap ordered by its expiry time, so that expired registers are found
+        without scanning the cache. A register stored again later keeps its newer timestamp and is skipped, when the
+        heap entry of its old range expires. At most `max_entries` registers are cached, the least recently used
+        registers are evicted first.
+
+        One cache is shared by all client sessions of the proxy server, so a value read by one client is served to
+        the others and a write of one client invalidates the cached value for all. A lock protects the register maps
+        and their bookkeeping (LRU order, expiry heap), each operation holds it only for O(quantity) array accesses.
+
+        A response may arrive after a write of another session, or a pipelined write of the same client, was
+        forwarded on another upstream connection and invalidated the registers. Every invalidation therefore increases
+        the generation of the cache and records it for the pages it touches. The generation is captured when a request
+        is forwarded, the values of its response are not stored for pages invalidated in the meantime. The
+        generations outlive released pages and register maps, they are kept in a fixed-size table hashed by unit id
+        and page index. Two pages sharing a slot only cost a value, which is not cached."""
+
+    def __init__(self, write_through=False, max_entries=CACHE_MAX_ENTRIES):
+        self._lock = threading.Lock()
+        self.write_through = write_through  # fill cache with the values of writes confirmed by server
+        self._register_maps = {}  # unit id -> RegisterMap
+        self._max_entries = max_entries
+        self._lru = OrderedDict()  # (unit id, address) of all valid registers, least recently used first
+        self._expiry_heap = []  # (expiry time, unit id, start address, quantity) of the stored ranges
+        self._generation = 0  # number of invalidations by writes
+        # generation of the last invalidation of each page, indexed by `_generation_slot`
+        self._page_generations = array('Q', bytes(8 * CACHE_GENERATION_SLOTS))
+        self.metrics = CacheMetrics()
+
+    @property
+    def num_cached_registers(self):
+        return len(self._lru)
 
     @property
-    def cache(self):
-        return self._cache
+    def generation(self):
+        """Generation to capture when a request is forwarded to server, passed on to store its response"""
+        return self._generation
+
+    @staticmethod
+    def _generation_slot(unit_id, page_index):
+        return hash((unit_id, page_index)) % CACHE_GENERATION_SLOTS
+
+    def _pages(self, start_address, quantity):
+        return range(start_address // CACHE_PAGE_SIZE, (start_address + quantity - 1) // CACHE_PAGE_SIZE + 1)
+
+    def _unchanged_ranges(self, unit_id, start_address, quantity, generation):
+        """
+        Split a range of registers into the sub-ranges, whose pages were not invalidated after `generation`.
 
-    def _get_cached_data(self, register_index):
+        :returns: list of (start_address, quantity)
         """
-        Retrieve data from cache if it exists and is still valid.
+        if generation is None or generation == self._generation:
+            return [(start_address, quantity)]
+        unchanged_ranges = []
+        end_address = start_address + quantity
+        for page_index in self._pages(start_address, quantity):
+            if self._page_generations[self._generation_slot(unit_id, page_index)] > generation:
+                continue
+            first_address = max(page_index * CACHE_PAGE_SIZE, start_address)
+            last_address = min((page_index + 1) * CACHE_PAGE_SIZE, end_address)
+            if unchanged_ranges and sum(unchanged_ranges[-1]) == first_address:
+                unchanged_ranges[-1] = (unchanged_ranges[-1][0], last_address - unchanged_ranges[-1][0])
+            else:
+                unchanged_ranges.append((first_address, last_address - first_address))
+        return unchanged_ranges
 
-        :param register_index: address of read register
+    def _get_register_map(self, unit_id):
+        register_map = self._register_maps.get(unit_id)
+        if register_map is None:
+            register_map = self._register_maps[unit_id] = RegisterMap()
+        return register_map
 
-        :returns: Register value if the value exists in cache, otherwise None
+    def _drop_register(self, unit_id, register_map, address):
+        """Mark one register as invalid. The register map of a unit is released with its last valid register."""
+        register_map.invalidate(address)
+        self._lru.pop((unit_id, address), None)
+        if register_map.num_valid == 0 and self._register_maps.get(unit_id) is register_map:
+            del self._register_maps[unit_id]
+
+    def _expire(self, current_time):
+        """Invalidate the registers of all stored ranges whose time-to-live is over"""
+        expiry_heap = self._expiry_heap
+        while expiry_heap and expiry_heap[0][0] <= current_time:
+            (_, unit_id, start_address, quantity) = heapq.heappop(expiry_heap)
+            register_map = self._register_maps.get(unit_id)
+            if register_map is None:
+                continue
+            for page, offset, address, length in register_map.segments(start_address, quantity):
+                if page is None:
+                    continue
+                for index in range(offset, offset + length):
+                    if page.valid[index] and current_time - page.timestamps[index] >= CACHE_TTL:
+                        self._drop_register(unit_id, register_map, address + index - offset)
+                        self.metrics.expirations += 1
+
+    def _find_missing_ranges(self, unit_id, start_address, quantity_to_read):
+        self._expire(time.monotonic())
+        register_map = self._register_maps.get(unit_id)
+        if register_map is None:
+            return [(start_address, quantity_to_read)]
+        missing_ranges = []
+        missing_start = None
+        for page, offset, first_address, length in register_map.segments(start_address, quantity_to_read):
+            if page is None:
+                if missing_start is None:
+                    missing_start = first_address
+                continue
+            valid = page.valid
+            if valid.count(1, offset, offset + length) == length:
+                # All registers of the segment are valid
+                if missing_start is not None:
+                    missing_ranges.append((missing_start, first_address - missing_start))
+                    missing_start = None
+                continue
+            for index in range(offset, offset + length):
+                if valid[index]:
+                    if missing_start is not None:
+                        missing_ranges.append((missing_start, first_address + index - offset - missing_start))
+                        missing_start = None
+                elif missing_start is None:
+                    missing_start = first_address + index - offset
+        if missing_start is not None:
+            missing_ranges.append((missing_start, start_address + quantity_to_read - missing_start))
+        return missing_ranges
+
+    def get_missing_ranges(self, unit_id, start_address, quantity_to_read):
         """
-        current_time = time.time()
-        if register_index in self._cache:
-            initial_time, data = self._cache[register_index]
-            if current_time - initial_time < CACHE_TTL:
-                return data
-        return None
+        Find the registers of a read request which are not in cache or not valid anymore.
 
-    def set_cache_data(self, register_index, data):
-        """Store data in cache."""
-        self._cache[register_index] = (time.time(), data)
+        :returns: list of (start_address, quantity) of the missing sub-ranges, empty list if all registers are valid
+        """
+        with self._lock:
+            return self._find_missing_ranges(unit_id, start_address, quantity_to_read)
 
-    def clean_cache(self, register_rewritten):
-        """cleaning cache by removing expired data or rewritten data"""
-        logging.info("Cache cleaning...")
-        current_time = time.time()
+    def find_partial_hit(self, request):
+        """
+        Check if a part of the registers of a read holding registers request is available in cache.
 
-        # Create a list of keys to delete
-        keys_to_delete = []
+        :param request: ModbusFrame of the read holding registers request
+        :returns: list of the missing sub-ranges or None if no register of the read is cached
+        """
+        (start_address, quantity_to_read) = request.address_and_quantity()
+        if not 1 <= quantity_to_read <= MAX_REGISTERS_PER_READ or start_address + quantity_to_read > NUM_REGISTERS:
+            return None
+        with self._lock:
+            missing_ranges = self._find_missing_ranges(request.unit_id, start_address, quantity_to_read)
+            if missing_ranges == [(start_address, quantity_to_read)]:
+                return None
+            self.metrics.partial_hits += 1
+            return missing_ranges
 
-        # Cache will be cleaned if the stored register value is expired or the value overwritten by write single
-        # register request
-        for register_index in self._cache.keys():
-            (initial_time, data) = self._cache[register_index]
-            if current_time - initial_time > CACHE_TTL or register_index == register_rewritten:
-                logging.info(f"{register_index} is removed from Cache ")
-                keys_to_delete.append(register_index)
+    def find_expiring(self, unit_id, addresses, refresh_margin):
+        """
+        Find cached registers which expire within the next `refresh_margin` seconds.
 
-        # Deleting chosen keys
-        for key in keys_to_delete:
-            del self._cache[key]
+        :param addresses: register addresses to check, in ascending order
+        :returns: list of the addresses of the valid registers expiring soon
+        """
+        with self._lock:
+            current_time = time.monotonic()
+            self._expire(current_time)
+            register_map = self._register_maps.get(unit_id)
+            if register_map is None:
+                return []
+            # A register cached at or before this time expires within the margin
+            cached_before = current_time + refresh_margin - CACHE_TTL
+            return [address for address in addresses
+                    if register_map.is_valid(address) and register_map.timestamp(address) <= cached_before]
 
-    def check_if_value_in_cache(self, pdu_body, transaction_id, protocol_id, unit_id):
-        """If the value to read is in cache and valid, a response will be created and send back to client"""
-        # Parse the address and quantity from the request
-        function_code, start_address, quantity_to_read = struct.unpack('>BHH', pdu_body)
-
-        # Check cache for the requested register
-        if self._get_cached_data(start_address) is not None:
-            cache_data = self._get_cached_data(start_address)
-            # Build the Modbus response with cached data
-            # length of pdu_body in response is 5 bytes: 1 byte function_code,
-            # 2 byte length of read data, 2 byte for read data from 1 register
-            length_pdu_response = 5
-            response = (struct.pack('>HHHB', transaction_id, protocol_id, length_pdu_response, unit_id)
-                        + struct.pack('>BBH', function_code, quantity_to_read * 2, cache_data))
-            logging.info(f"Cache hit, build response from Cache:")
-            self.mbap_header_logging(transaction_id, protocol_id, length_pdu_response, unit_id)
-
-            self.log_response_pdu(function_code, quantity_to_read, cache_data)
-            return response
+    def _store_range(self, unit_id, start_address, values, current_time):
+        register_map = self._get_register_map(unit_id)
+        register_map.store(start_address, values, current_time)
+        # The valid registers are the keys of the LRU order
+        lru = self._lru
+        for address in range(start_address, start_address + len(values)):
+            lru[(unit_id, address)] = None
+            lru.move_to_end((unit_id, address))
+        heapq.heappush(self._expiry_heap, (current_time + CACHE_TTL, unit_id, start_address, len(values)))
+
+        # Evict the least recently used registers if the cache is full
+        while len(self._lru) > self._max_entries:
+            (evicted_unit_id, evicted_address), _ = self._lru.popitem(last=False)
+            self._drop_register(evicted_unit_id, self._register_maps[evicted_unit_id], evicted_address)
+            self.metrics.evictions += 1
+
+    def _invalidate_range(self, unit_id, start_address, quantity):
+        """Drop the valid registers of a range and record the invalidation for its pages"""
+        self._generation += 1
+        for page_index in self._pages(start_address, quantity):
+            self._page_generations[self._generation_slot(unit_id, page_index)] = self._generation
+        register_map = self._register_maps.get(unit_id)
+        if register_map is not None:
+            for address in range(start_address, start_address + quantity):
+                if register_map.is_valid(address):
+                    self._drop_register(unit_id, register_map, address)
+
+    def set_cache_range(self, unit_id, start_address, values, generation=None):
+        """
+        Store values of consecutive registers beginning at `start_address` in cache.
+
+        :param generation: generation of the cache captured when the request was forwarded, the registers of pages
+                           invalidated since then are not stored. None to store all registers.
+        :returns: number of registers stored, 0 if the range runs past the last register address
+        """
+        if start_address + len(values) > NUM_REGISTERS:
+            return 0
+        num_stored = 0
+        with self._lock:
+            current_time = time.monotonic()
+            self._expire(current_time)
+            for first_address, quantity in self._unchanged_ranges(unit_id, start_address, len(values), generation):
+                position = first_address - start_address
+                self._store_range(unit_id, first_address, values[position:position + quantity], current_time)
+                num_stored += quantity
+        return num_stored
+
+    def store_read_response(self, request, response, generation=None):
+        """Store the register values of a read holding registers (FC3) or read/write multiple registers (FC23)
+            response (ModbusFrame) from server in cache. `generation` is the generation of the cache captured when
+            the request was forwarded."""
+        (start_address, quantity_to_read) = request.address_and_quantity()
+        (function_code, byte_count) = FC_BYTE_COUNT.unpack_from(response.raw, MBAP_HEADER_SIZE)
+        if (function_code not in (3, 23) or byte_count != quantity_to_read * 2
+                or len(response) < PDU_DATA_OFFSET + 1 + byte_count):
+            return
+        values = array('H')
+        values.frombytes(memoryview(response.raw)[PDU_DATA_OFFSET + 1:PDU_DATA_OFFSET + 1 + byte_count])
+        if sys.byteorder == 'little':
+            values.byteswap()
+        num_stored = self.set_cache_range(request.unit_id, start_address, values, generation)
+        if not num_stored:
+            return
+        if log_enabled(CACHE):
+            logging.info(f"{num_stored} value(s) from register {start_address} added to cache, "
+                         f"cached registers: {self.num_cached_registers}")
+
+    def store_write_response(self, request, response, generation=None):
+        """A write confirmed by server invalidates its registers again, as a read answered by the server before the
+            write may have been stored since the write was forwarded. In write-through mode the values of the write
+            are stored instead, unless another write invalidated the registers after `generation`, the generation of
+            the cache captured when this write was forwarded: the server may have executed the writes in the other
+            order. The response to write single register echoes the written value, the values of write multiple
+            registers (FC16, FC23) are taken from the request."""
+        if response.function_code == 6:
+            (start_address, value) = response.address_and_quantity()
+            values = array('H', [value])
+        elif response.function_code in (16, 23):
+            (start_address, quantity_written) = request.write_range()
+            # The byte count follows the quantity of the write range, the values follow the byte count
+            values_offset = PDU_DATA_OFFSET + (5 if response.function_code == 16 else 9)
+            byte_count = request.raw[values_offset - 1]
+            if byte_count != quantity_written * 2 or len(request) < values_offset + byte_count:
+                return
+            values = array('H')
+            values.frombytes(memoryview(request.raw)[values_offset:values_offset + byte_count])
+            if sys.byteorder == 'little':
+                values.byteswap()
         else:
+            return
+        # A write without registers or running past the last register address is rejected by the modbus server
+        if not values or start_address + len(values) > NUM_REGISTERS:
+            return
+        unit_id = request.unit_id
+        with self._lock:
+            store = (self.write_through
+                     and self._unchanged_ranges(unit_id, start_address, len(values), generation)
+                     == [(start_address, len(values))])
+            self._invalidate_range(unit_id, start_address, len(values))
+            if store:
+                current_time = time.monotonic()
+                self._expire(current_time)
+                self._store_range(unit_id, start_address, values, current_time)
+        if not store:
+            return
+        if log_enabled(CACHE):
+            logging.info(f"{len(values)} written value(s) from register {start_address} added to cache, "
+                         f"cached registers: {self.num_cached_registers}")
+
+    def clean_cache(self, unit_id, register_rewritten, quantity=1):
+        """cleaning cache by removing rewritten data. Each rewritten register is invalidated by its address, expired
+            data is removed by the expiry heap. The cache is shared, so a write of one client invalidates the
+            register for all clients. A write running past the last register address is rejected by the modbus
+            server, only its registers within the address space are invalidated."""
+        quantity = min(quantity, NUM_REGISTERS - register_rewritten)
+        if quantity < 1:
+            return
+        with self._lock:
+            self._invalidate_range(unit_id, register_rewritten, quantity)
+        if log_enabled(CACHE):
+            logging.info(f"{quantity} register(s) from {register_rewritten} removed from Cache, "
+                         f"cached registers: {self.num_cached_registers}")
+
+    def check_if_value_in_cache(self, request, count_lookup=True):
+        """If all values to read are in cache and valid, a response (ModbusFrame) will be created and send back to
+            client. `count_lookup` is False, if the read was already counted as partial hit."""
+        # Parse the address and quantity from the request
+        (start_address, quantity_to_read) = request.address_and_quantity()
+        unit_id = request.unit_id
+        if not 1 <= quantity_to_read <= MAX_REGISTERS_PER_READ or start_address + quantity_to_read > NUM_REGISTERS:
+            with self._lock:
+                self.metrics.misses += count_lookup
             return None
 
-    @staticmethod
-    def mbap_header_logging(transaction_id, protocol_id, length, unit_id):
-        """Log out the header of a modbus/TCP packet"""
-        logging.info(f"Response header:")
-        logging.info(f"Response_TID: {transaction_id}")
-        logging.info(f"Response_PID: {protocol_id}")
-        logging.info(f"Response_LF: {length}")
-        logging.info(f"Response_UID: {unit_id}")
-        logging.info("----------------------------------")
+        # Check cache for the requested registers and copy their values at once, so that no other client
+        # rewrites a register in between
+        with self._lock:
+            if self._find_missing_ranges(unit_id, start_address, quantity_to_read):
+                self.metrics.misses += count_lookup
+                return None
+            self.metrics.hits += count_lookup
+            for address in range(start_address, start_address + quantity_to_read):
+                self._lru.move_to_end((unit_id, address))
+            cache_data = self._register_maps[unit_id].get_values(start_address, quantity_to_read)
+        if sys.byteorder == 'little':
+            cache_data.byteswap()
+        # Build the Modbus response with cached data
+        # length of pdu_body in response: 1 byte function_code, 1 byte number of bytes of read data,
+        # 2 byte for read data from each register
+        length_pdu_response = 3 + quantity_to_read * 2
+        response = bytearray(MBAP_HEADER_SIZE - 1 + length_pdu_response)
+        MBAP_HEADER.pack_into(response, 0, request.transaction_id, request.protocol_id, length_pdu_response, unit_id)
+        FC_BYTE_COUNT.pack_into(response, MBAP_HEADER_SIZE, request.function_code, quantity_to_read * 2)
+        response[PDU_DATA_OFFSET + 1:] = cache_data
+        # The response is logged with the record of its transaction
+        return ModbusFrame(response)
 
-    @staticmethod
-    def log_response_pdu(function_code, quantity_to_read, cache_value):
-        logging.info(f"Response PDU:")
-        logging.info(f"Response_FC: {function_code}")
-        logging.info(f"Num_bytes_to_read: {quantity_to_read * 2}")
-        logging.info(f"Cache_value: {cache_value}")
-        logging.info("----------------------------------")
+    def log_metrics(self):
+        logging.info(f"Cache: {self.num_cached_registers}/{self._max_entries} registers cached, "
+                     f"hits: {self.metrics.hits}, misses: {self.metrics.misses} "
+                     f"(hit ratio {self.metrics.hit_ratio:.1%}), partial hits: {self.metrics.partial_hits}, "
+                     f"evictions: {self.metrics.evictions}, expirations: {self.metrics.expirations}")
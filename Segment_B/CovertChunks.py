@@ -0,0 +1,261 @@
+import logging
+import sys
+import threading
+from collections import deque
+
+from TransactionLogging import log_enabled, STEGANOGRAPHY
+
+# This module is used by the proxy server, which embeds hidden messages, and by the modbus-client and modbus-server,
+# which read them. Each segment is built as a docker image of its own, so every segment directory holds an identical
+# copy of it.
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                    handlers=[logging.StreamHandler(sys.stdout)])
+
+# A hidden message (10 bits number of message bits + 7 bits per character) is split into chunks, which are striped
+# over all sessions. Each chunk is sent as a frame: start bit, sequence number, payload. A session without chunk to
+# send embeds 0 bits, which the reader skips until the next start bit.
+COVERT_HEADER_BITS = 10  # the first bits of a hidden message represent the number of message bits following
+COVERT_SEQUENCE_BITS = 6  # sequence number of a chunk, a message consists of at most 64 chunks
+COVERT_CHUNK_BITS = 32  # bits of the hidden message carried by one chunk
+COVERT_FRAME_START = 1  # first bit of every chunk frame
+COVERT_IDLE_BIT = 0  # bit embedded by a session while it waits for a chunk
+COVERT_FRAME_BITS = 1 + COVERT_SEQUENCE_BITS + COVERT_CHUNK_BITS  # bits of one chunk frame
+
+_BIT_CHARACTERS = bytes.maketrans(b'\x00\x01', b'01')
+
+
+def split_into_frames(message_bits):
+    """
+    Split the bits of a hidden message (header and message) into chunk frames. The last chunk is filled up with zeros.
+
+    :param message_bits: string of '0' and '1'
+    :returns: list of frames (integer of COVERT_FRAME_BITS bits, most significant bit first), index is the sequence
+              number
+    """
+    frames = []
+    for sequence_number, start in enumerate(range(0, len(message_bits), COVERT_CHUNK_BITS)):
+        payload = int(message_bits[start:start + COVERT_CHUNK_BITS].ljust(COVERT_CHUNK_BITS, '0'), 2)
+        frames.append((((COVERT_FRAME_START << COVERT_SEQUENCE_BITS) | sequence_number) << COVERT_CHUNK_BITS)
+                      | payload)
+    if len(frames) > 1 << COVERT_SEQUENCE_BITS:
+        raise ValueError(f"Hidden message of {len(message_bits)} bits needs more than "
+                         f"{1 << COVERT_SEQUENCE_BITS} chunks")
+    return frames
+
+
+def bits_to_int(bits):
+    """Value of a bit array (0 or 1 per byte), most significant bit first"""
+    value = 0
+    for bit in bits:
+        value = (value << 1) | bit
+    return value
+
+
+def bits_to_string(bits):
+    """String of '0' and '1' of a bit array (0 or 1 per byte)"""
+    return bytes(bits).translate(_BIT_CHARACTERS).decode()
+
+
+class CovertChunkScheduler:
+    """Proxy-wide scheduler of the chunks of one hidden message. A session takes the next chunk, when it finished
+        sending its previous one, so that the chunks are striped over all active sessions and the covert throughput
+        grows with the number of sessions. A chunk of a session, which is closed before the chunk is sent
+        completely, is handed out again."""
+
+    def __init__(self, message_bits):
+        self._frames = split_into_frames(message_bits)
+        self._lock = threading.Lock()
+        self._pending = deque(range(len(self._frames)))
+        self._completed = set()
+
+    @property
+    def num_chunks(self):
+        return len(self._frames)
+
+    @property
+    def finished(self):
+        """All chunks are sent completely"""
+        return len(self._completed) == len(self._frames)
+
+    def acquire(self):
+        """
+        :returns: (sequence number, frame) of the next chunk to send or None if all chunks are handed out
+        """
+        with self._lock:
+            if not self._pending:
+                return None
+            sequence_number = self._pending.popleft()
+        return sequence_number, self._frames[sequence_number]
+
+    def complete(self, sequence_number):
+        with self._lock:
+            self._completed.add(sequence_number)
+            if log_enabled(STEGANOGRAPHY):
+                logging.info(f"Chunk {sequence_number} sent, {len(self._completed)}/{len(self._frames)} chunks")
+
+    def release(self, sequence_number):
+        """Hand out a chunk again, which was not sent completely"""
+        with self._lock:
+            if sequence_number not in self._completed:
+                self._pending.appendleft(sequence_number)
+
+
+class CovertCursor:
+    """Position of one session in the chunks it embeds. Bits are taken from the frames of the chunks acquired from
+        the scheduler, a chunk is completed when all bits of its frame are embedded. The bits not embedded yet are
+        kept packed in one integer, so that a symbol is taken from them with a shift and a mask."""
+
+    def __init__(self, scheduler):
+        self._scheduler = scheduler
+        self._bits = 0  # bits not embedded yet, most significant bit first
+        self._num_bits = 0
+        self._num_embedded = 0  # bits embedded since the session started
+        self._num_acquired = 0  # bits of the frames acquired since the session started
+        self._chunk_ends = deque()  # (sequence number, self._num_acquired after its frame) of the unfinished chunks
+
+    def peek_bits(self, num_bits, idle=True):
+        """
+        Return the next `num_bits` bits to embed, without consuming them.
+
+        :param num_bits: number of bits, e.g. the bits per packet of size modulation
+        :param idle: fill up with idle bits, while other sessions still send chunks. Methods, which embed a bit only
+                     in some packets, embed nothing instead.
+        :returns: symbol of `num_bits` bits as integer, most significant bit first, or None if there is nothing to
+                  embed
+        """
+        while self._num_bits < num_bits:
+            chunk = self._scheduler.acquire()
+            if chunk is None:
+                break
+            sequence_number, frame = chunk
+            self._bits = (self._bits << COVERT_FRAME_BITS) | frame
+            self._num_bits += COVERT_FRAME_BITS
+            self._num_acquired += COVERT_FRAME_BITS
+            self._chunk_ends.append((sequence_number, self._num_acquired))
+        if self._num_bits >= num_bits:
+            return self._bits >> (self._num_bits - num_bits)
+        if not idle or (not self._num_bits and self._scheduler.finished):
+            return None
+        num_idle_bits = num_bits - self._num_bits
+        return (self._bits << num_idle_bits) | (COVERT_IDLE_BIT * ((1 << num_idle_bits) - 1))
+
+    def advance(self, num_bits):
+        """Consume bits returned by `peek_bits`, a chunk whose frame is embedded completely is completed"""
+        num_bits = min(num_bits, self._num_bits)
+        self._num_bits -= num_bits
+        self._bits &= (1 << self._num_bits) - 1
+        self._num_embedded += num_bits
+        while self._chunk_ends and self._chunk_ends[0][1] <= self._num_embedded:
+            self._scheduler.complete(self._chunk_ends.popleft()[0])
+
+    def close(self):
+        """Hand the chunks, which are not embedded completely, back to the scheduler"""
+        while self._chunk_ends:
+            self._scheduler.release(self._chunk_ends.popleft()[0])
+        self._num_embedded += self._num_bits
+        self._bits = 0
+        self._num_bits = 0
+
+
+class CovertMessageAssembler:
+    """Reassemble the chunks of a hidden message by their sequence number. The chunks arrive in any order and over
+        any number of sessions. Shared by all sessions of a receiver, the payload bits are written into one
+        preallocated bit array at the offset of their chunk."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # One byte (0 or 1) per bit of the largest possible message
+        self._bits = bytearray((1 << COVERT_SEQUENCE_BITS) * COVERT_CHUNK_BITS)
+        self._received = bytearray(1 << COVERT_SEQUENCE_BITS)
+        self.num_chunks = None
+        self.message = None
+
+    @property
+    def complete(self):
+        return self.message is not None
+
+    def add_chunk(self, sequence_number, payload):
+        """
+        :param payload: bit array (0 or 1 per byte) of COVERT_CHUNK_BITS bits
+        :returns: the hidden message (string of '0' and '1') if it was completed by this chunk, otherwise None
+        """
+        with self._lock:
+            if self.message is not None or self._received[sequence_number]:
+                return None
+            start = sequence_number * COVERT_CHUNK_BITS
+            self._bits[start:start + COVERT_CHUNK_BITS] = payload
+            self._received[sequence_number] = 1
+            if log_enabled(STEGANOGRAPHY):
+                logging.info(f"Hidden message chunk {sequence_number} received: {bits_to_string(payload)}")
+            if sequence_number == 0:
+                num_message_bits = bits_to_int(payload[:COVERT_HEADER_BITS])
+                self.num_chunks = -(-(COVERT_HEADER_BITS + num_message_bits) // COVERT_CHUNK_BITS)
+                logging.info(f"number of bits to read: {num_message_bits}, chunks: {self.num_chunks}")
+            if self.num_chunks is None or self._received.count(1, 0, self.num_chunks) < self.num_chunks:
+                return None
+            num_message_bits = bits_to_int(self._bits[:COVERT_HEADER_BITS])
+            self.message = bits_to_string(self._bits[COVERT_HEADER_BITS:COVERT_HEADER_BITS + num_message_bits])
+            return self.message
+
+
+class CovertFrameReader:
+    """Read the chunk frames embedded in one session. Idle bits before a start bit are skipped, a complete frame is
+        handed to the assembler of the receiver. The bits of the current frame are collected in a preallocated bit
+        array."""
+
+    def __init__(self, assembler):
+        self._assembler = assembler
+        self._frame = bytearray(COVERT_SEQUENCE_BITS + COVERT_CHUNK_BITS)
+        # Number of bits of the current frame read, None while waiting for a start bit
+        self._position = None
+
+    def feed(self, symbol, num_bits=1):
+        """
+        :param symbol: bits read from one packet as integer, most significant bit first
+        :param num_bits: number of bits of the symbol
+        :returns: the hidden message if it was completed by these bits, otherwise None
+        """
+        message = None
+        for shift in range(num_bits - 1, -1, -1):
+            bit = (symbol >> shift) & 1
+            if self._position is None:
+                if bit == COVERT_FRAME_START:
+                    self._position = 0
+                continue
+            self._frame[self._position] = bit
+            self._position += 1
+            if self._position == len(self._frame):
+                self._position = None
+                sequence_number = bits_to_int(self._frame[:COVERT_SEQUENCE_BITS])
+                message = self._assembler.add_chunk(sequence_number, self._frame[COVERT_SEQUENCE_BITS:]) or message
+        return message
+
+
+class HiddenMessageSink:
+    """Thread-safe sink, to which the receivers publish the hidden messages they completed"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._messages = []
+
+    def publish(self, message):
+        with self._condition:
+            self._messages.append(message)
+            self._condition.notify_all()
+
+    def messages(self):
+        """
+        :returns: list of the hidden messages published so far
+        """
+        with self._condition:
+            return list(self._messages)
+
+    def wait(self, num_messages=1, timeout=None):
+        """Wait until `num_messages` hidden messages are published or the timeout expires
+
+        :returns: list of the hidden messages published so far
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._messages) >= num_messages, timeout)
+            return list(self._messages)
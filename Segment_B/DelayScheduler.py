@@ -0,0 +1,163 @@
+import logging
+import sys
+import threading
+import time
+
+from constants import DELAY_WHEEL_TICK, DELAY_WHEEL_SLOTS
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                    handlers=[logging.StreamHandler(sys.stdout)])
+
+
+class TimerHandle:
+    """A callback waiting in the timing wheel for its deadline"""
+    __slots__ = ('deadline', 'tick', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, tick, callback, args):
+        self.deadline = deadline
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """The callback is not called, if it did not fire yet"""
+        self.cancelled = True
+
+
+class DelayMetrics:
+    """Counters of the delay scheduler. The lateness is the time between the deadline of a callback and the moment
+        it is called."""
+
+    def __init__(self):
+        self.fired = 0
+        self.cancelled = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+
+    def record_lateness(self, lateness):
+        self.fired += 1
+        self.total_lateness += lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+
+    @property
+    def mean_lateness(self):
+        return self.total_lateness / self.fired if self.fired else 0.0
+
+
+class DelayScheduler:
+    """Hashed timing wheel driven by `time.monotonic`, which calls callbacks after a delay on a timer thread of its
+        own. A timer is hashed into the slot of the tick its deadline falls in, so that adding a timer costs O(1)
+        regardless of the number of waiting timers. The timer thread sleeps until the next tick holding a timer and
+        then until the exact deadline of the timer, so that a callback is called with sub-millisecond precision
+        instead of the granularity of the tick or of the event loop.
+
+        Callbacks run on the timer thread and must be short, e.g. `loop.call_soon_threadsafe` to hand a delayed
+        request back to the asyncio event loop."""
+
+    def __init__(self, tick=DELAY_WHEEL_TICK, num_slots=DELAY_WHEEL_SLOTS):
+        self._tick = tick
+        self._slots = [[] for _ in range(num_slots)]
+        self._condition = threading.Condition()
+        self._start_time = time.monotonic()
+        # No timer of the wheel belongs to a tick before the current tick
+        self._current_tick = 0
+        self._num_timers = 0
+        self._closed = False
+        self._thread = None
+        self.metrics = DelayMetrics()
+
+    def __len__(self):
+        return self._num_timers
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="delay-scheduler", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stop the timer thread, the waiting timers are dropped"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def call_later(self, delay, callback, *args):
+        """
+        Call `callback(*args)` on the timer thread after `delay` seconds. Can be called from any thread.
+
+        :returns: TimerHandle to cancel the call
+        """
+        now = time.monotonic()
+        deadline = now + delay
+        with self._condition:
+            if self._num_timers == 0:
+                # The current tick only moves on while timers are waiting. After an idle period the wheel continues
+                # at the current time, instead of scanning one revolution per wake-up until it catches up.
+                self._current_tick = max(self._current_tick, int((now - self._start_time) / self._tick))
+            tick = max(int((deadline - self._start_time) / self._tick), self._current_tick)
+            handle = TimerHandle(deadline, tick, callback, args)
+            self._slots[tick % len(self._slots)].append(handle)
+            self._num_timers += 1
+            # The timer thread may sleep until a later deadline
+            self._condition.notify()
+        return handle
+
+    def _next_tick_with_timers(self):
+        """Find the next slot holding timers, starting at the current tick. The timers of the slot may belong to a
+            later revolution of the wheel."""
+        num_slots = len(self._slots)
+        for offset in range(num_slots):
+            if self._slots[(self._current_tick + offset) % num_slots]:
+                return self._current_tick + offset
+        return self._current_tick + num_slots
+
+    def _take_next_due(self):
+        """Wait until the deadline of the next timer and remove it from the wheel. Returns None when the scheduler is
+            closed."""
+        with self._condition:
+            while not self._closed:
+                if self._num_timers == 0:
+                    self._condition.wait()
+                    continue
+                tick = self._next_tick_with_timers()
+                slot = self._slots[tick % len(self._slots)]
+                due = [handle for handle in slot if handle.tick == tick]
+                now = time.monotonic()
+                if not due:
+                    # The slot only holds timers of a later revolution
+                    tick_end = self._start_time + (tick + 1) * self._tick
+                    if now < tick_end:
+                        self._condition.wait(tick_end - now)
+                    else:
+                        self._current_tick = tick + 1
+                    continue
+                self._current_tick = tick
+                handle = min(due, key=lambda timer: timer.deadline)
+                if handle.deadline > now:
+                    # Woken up earlier if a timer with an earlier deadline is added meanwhile
+                    self._condition.wait(handle.deadline - now)
+                    continue
+                slot.remove(handle)
+                self._num_timers -= 1
+                return handle
+            return None
+
+    def _run(self):
+        while True:
+            handle = self._take_next_due()
+            if handle is None:
+                return
+            if handle.cancelled:
+                self.metrics.cancelled += 1
+                continue
+            self.metrics.record_lateness(time.monotonic() - handle.deadline)
+            try:
+                handle.callback(*handle.args)
+            except Exception as e:
+                logging.error(f"Error: {e} in delayed callback {handle.callback!r}")
+
+    def log_metrics(self):
+        logging.info(f"Delay scheduler: {self._num_timers} timers waiting, fired: {self.metrics.fired}, "
+                     f"cancelled: {self.metrics.cancelled}, mean lateness: {self.metrics.mean_lateness:.6f}s, "
+                     f"max lateness: {self.metrics.max_lateness:.6f}s")
@@ -0,0 +1,117 @@
+import struct
+import logging
+import sys
+
+from constants import RECV_BUFFER_SIZE, MBAP_HEADER_SIZE
+
+# This module is used by the proxy server and by the modbus-server. Each segment is built as a docker image of its own,
+# so both segment directories hold an identical copy of it.
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                    handlers=[logging.StreamHandler(sys.stdout)])
+
+
+def check_mbap_length(length):
+    """Reject a frame whose MBAP length field does not cover unit id and function code or exceeds a modbus/TCP frame"""
+    if not 2 <= length < 256:
+        raise ValueError(f"Invalid length field in MBAP header: {length}")
+
+
+class MbapFrameReassembler:
+    """This class cuts a TCP byte stream into modbus/TCP frames. TCP does not preserve message boundaries, one recv
+        call can return several frames or only a part of a frame. The bytes are received directly into a preallocated
+        buffer and every complete frame is handed out as a memoryview on this buffer, so that no copy of the frame is
+        made. A frame is complete when 6 + the value of the length field in its MBAP header bytes are available.
+
+        A handed out frame is only valid until the next call of `recv_from`, because the buffer is reused for the
+        following bytes of the stream."""
+
+    def __init__(self, buffer_size=RECV_BUFFER_SIZE):
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # index of the first byte which is not yet handed out as part of a frame
+        self._end = 0  # index after the last received byte
+
+    @property
+    def pending_bytes(self):
+        """Number of received bytes which do not yet form a complete frame"""
+        return self._end - self._start
+
+    def recv_from(self, sock):
+        """
+        Receive bytes from the socket directly into the free part of the buffer.
+
+        :param sock: blocking socket to read from
+
+        :returns: number of received bytes, 0 if the connection was closed by the peer
+        """
+        nbytes = sock.recv_into(self.get_buffer())
+        self.buffer_updated(nbytes)
+        return nbytes
+
+    def get_buffer(self):
+        """Return the free part of the buffer as writable memoryview. Partial frames are moved to the beginning of
+            the buffer before, so that there is always room for at least one complete frame."""
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._start > 0:
+            pending = self._end - self._start
+            self._buffer[:pending] = self._view[self._start:self._end]
+            self._start, self._end = 0, pending
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        """Mark `nbytes` bytes written into the buffer returned by `get_buffer` as received"""
+        self._end += nbytes
+
+    def next_frame(self):
+        """
+        Cut the next complete frame from the received bytes.
+
+        :returns: memoryview of the complete frame (MBAP header + PDU) or None if more bytes must be received
+        """
+        if self._end - self._start < MBAP_HEADER_SIZE:
+            return None
+        (length,) = struct.unpack_from('>H', self._buffer, self._start + 4)
+        check_mbap_length(length)
+        frame_size = MBAP_HEADER_SIZE - 1 + length
+        if self._end - self._start < frame_size:
+            return None
+        frame = self._view[self._start:self._start + frame_size]
+        self._start += frame_size
+        return frame
+
+    def frames(self):
+        """Yield all complete frames which are available in the buffer"""
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+
+def receive_frame(sock, reassembler):
+    """
+    Block until one complete modbus/TCP frame is received from the socket.
+
+    :param sock: blocking socket to read from
+    :param reassembler: MbapFrameReassembler of this socket
+
+    :returns: memoryview of the received frame
+    """
+    frame = reassembler.next_frame()
+    while frame is None:
+        if reassembler.recv_from(sock) == 0:
+            raise ConnectionError("Connection closed by peer")
+        frame = reassembler.next_frame()
+    return frame
+
+
+async def read_modbus_frame(reader):
+    """Read exactly one modbus/TCP frame (MBAP header + PDU) from an asyncio stream into a bytearray, which can be
+        owned by a ModbusFrame without copying it"""
+    frame = bytearray(await reader.readexactly(MBAP_HEADER_SIZE))
+    (length,) = struct.unpack_from('>H', frame, 4)
+    # Malformed frames are rejected the same way as by MbapFrameReassembler
+    check_mbap_length(length)
+    frame += await reader.readexactly(length - 1)
+    return frame
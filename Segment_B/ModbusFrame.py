@@ -0,0 +1,124 @@
+import struct
+
+from constants import MBAP_HEADER_SIZE
+
+# Precompiled layouts of the fields of a modbus/TCP frame, network byte order
+MBAP_HEADER = struct.Struct('>HHHB')  # transaction id, protocol id, length, unit id
+TRANSACTION_ID = struct.Struct('>H')  # first field of the MBAP header
+LENGTH = struct.Struct('>H')  # length field at offset 4 of the MBAP header
+ADDRESS_QUANTITY = struct.Struct('>HH')  # starting address and quantity (FC3, FC16, FC23) or address and value (FC6)
+REQUEST_PDU = struct.Struct('>BHH')  # function code, starting address and quantity of a read request
+FC_BYTE_COUNT = struct.Struct('>BB')  # function code and byte count of a read response
+EXCEPTION_PDU = struct.Struct('>BB')  # function code with bit 0x80 set and exception code
+REGISTER = struct.Struct('>H')  # value of one holding register
+
+LENGTH_OFFSET = 4  # offset of the length field in the MBAP header
+PDU_DATA_OFFSET = MBAP_HEADER_SIZE + 1  # offset of the first byte after the function code
+# Bytes of the address and quantity fields following the function code of a request
+REQUEST_FIELDS_SIZE = {3: 4, 6: 4, 16: 4, 23: 8}
+
+
+class ModbusFrame:
+    """A modbus/TCP frame (MBAP header + PDU) in a bytearray, whose MBAP header and function code are parsed once
+        when the frame is received. All stages of the proxy server (caching, request coalescing, protocol
+        normalisation, steganography and logging) use the parsed fields instead of unpacking the header again. Fields
+        of the header are rewritten in place with `pack_into`, the parsed field is updated with it."""
+    __slots__ = ('raw', 'transaction_id', 'protocol_id', 'length', 'unit_id', 'function_code')
+
+    def __init__(self, raw):
+        """
+        :param raw: bytearray holding exactly one frame, it is owned by the ModbusFrame from now on
+        """
+        self.raw = raw
+        (self.transaction_id, self.protocol_id, self.length, self.unit_id) = MBAP_HEADER.unpack_from(raw)
+        self.function_code = raw[MBAP_HEADER_SIZE]
+
+    @classmethod
+    def parse(cls, data):
+        """Copy a received frame, e.g. a memoryview on a receive buffer which is reused, into a ModbusFrame"""
+        return cls(bytearray(data))
+
+    @classmethod
+    def build(cls, transaction_id, protocol_id, unit_id, pdu_body):
+        """Build a frame around a pdu payload, the length field is calculated from the payload"""
+        raw = bytearray(MBAP_HEADER_SIZE + len(pdu_body))
+        MBAP_HEADER.pack_into(raw, 0, transaction_id, protocol_id, len(pdu_body) + 1, unit_id)
+        raw[MBAP_HEADER_SIZE:] = pdu_body
+        return cls(raw)
+
+    def __len__(self):
+        return len(self.raw)
+
+    @property
+    def mbap_header(self):
+        return memoryview(self.raw)[:MBAP_HEADER_SIZE]
+
+    @property
+    def pdu_body(self):
+        return memoryview(self.raw)[MBAP_HEADER_SIZE:]
+
+    @property
+    def is_exception(self):
+        return self.function_code >= 0x80
+
+    @property
+    def is_truncated(self):
+        """The pdu of a request ends before the address and quantity fields of its function code. The proxy server
+            answers such a request with an exception instead of forwarding it."""
+        return len(self.raw) < PDU_DATA_OFFSET + REQUEST_FIELDS_SIZE.get(self.function_code, 0)
+
+    def address_and_quantity(self):
+        """
+        Unpack the first two fields after the function code of a request.
+
+        :returns: (starting address, quantity) for FC3 and FC16, (address, value) for FC6, the read range for FC23,
+                  None if the request is truncated
+        """
+        if self.is_truncated:
+            return None
+        return ADDRESS_QUANTITY.unpack_from(self.raw, PDU_DATA_OFFSET)
+
+    def write_range(self):
+        """
+        Unpack the registers written by a request.
+
+        :returns: (starting address, quantity) for FC6, FC16 and FC23, None for other function codes or if the
+                  request is truncated
+        """
+        if self.is_truncated:
+            return None
+        if self.function_code == 6:
+            return ADDRESS_QUANTITY.unpack_from(self.raw, PDU_DATA_OFFSET)[0], 1
+        if self.function_code == 16:
+            return ADDRESS_QUANTITY.unpack_from(self.raw, PDU_DATA_OFFSET)
+        if self.function_code == 23:
+            # The write range follows the read range
+            return ADDRESS_QUANTITY.unpack_from(self.raw, PDU_DATA_OFFSET + 4)
+        return None
+
+    def set_transaction_id(self, transaction_id):
+        """Rewrite the transaction id in place"""
+        TRANSACTION_ID.pack_into(self.raw, 0, transaction_id)
+        self.transaction_id = transaction_id
+
+    def with_transaction_id(self, transaction_id):
+        """Return a copy of the frame with another transaction id. The frame itself stays unchanged."""
+        frame = ModbusFrame.__new__(ModbusFrame)
+        frame.raw = bytearray(self.raw)
+        (frame.protocol_id, frame.length, frame.unit_id, frame.function_code) = (self.protocol_id, self.length,
+                                                                                  self.unit_id, self.function_code)
+        frame.set_transaction_id(transaction_id)
+        return frame
+
+    def extended(self, data):
+        """Return a copy of the frame with `data` added to the end of the pdu payload and the length field
+            increased accordingly"""
+        frame = ModbusFrame.__new__(ModbusFrame)
+        frame.raw = self.raw + data
+        (frame.transaction_id, frame.protocol_id, frame.unit_id, frame.function_code) = (self.transaction_id,
+                                                                                          self.protocol_id,
+                                                                                          self.unit_id,
+                                                                                          self.function_code)
+        frame.length = self.length + len(data)
+        LENGTH.pack_into(frame.raw, LENGTH_OFFSET, frame.length)
+        return frame
@@ -1,28 +1,149 @@
-import struct
+import time
 import logging
 import sys
 
+from ModbusFrame import ModbusFrame, TRANSACTION_ID, EXCEPTION_PDU
+from TransactionLogging import log_enabled, NORMALISATION
+from constants import TRANSACTION_TIMEOUT, EXP_GATEWAY_TARGET_FAILED
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
                     handlers=[logging.StreamHandler(sys.stdout)])
 
+
+class Transaction:
+    """Container class for one request which was forwarded to the server and waits for its response"""
+    __slots__ = ('client_tid', 'upstream_tid', 'sent_time', 'context')
+
+    def __init__(self, client_tid, upstream_tid, context):
+        self.client_tid = client_tid
+        self.upstream_tid = upstream_tid
+        self.sent_time = time.monotonic()
+        self.context = context
+
+
+class TransactionTable:
+    """This class maps the transaction ids of client requests to the transaction ids used towards the server. Many
+        requests of one connection can be outstanding at the same time, the responses can come back in any order and
+        are matched by their transaction id. Transactions without response are expired after a timeout.
+
+        Transactions are stored in order of sending. Because all transactions have the same timeout, the expired
+        transactions are always at the beginning of the table."""
+
+    def __init__(self, timeout=TRANSACTION_TIMEOUT, first_upstream_tid=0):
+        self._transactions = {}  # upstream transaction id -> Transaction, in order of sending
+        self._next_upstream_tid = first_upstream_tid
+        self._timeout = timeout
+
+    def __len__(self):
+        return len(self._transactions)
+
+    def register(self, client_tid, context=None):
+        """
+        Allocate an upstream transaction id for a request. Upstream transaction ids are counted up from
+        `first_upstream_tid` and skip ids which are still outstanding.
+
+        :param client_tid: transaction id of the request from the client
+        :param context: any data needed later to process the response (e.g. request pdu, receive time)
+
+        :returns: the new Transaction
+        """
+        if len(self._transactions) >= 0x10000:
+            raise OverflowError("No free transaction id left on this connection")
+        upstream_tid = self._next_upstream_tid
+        while upstream_tid in self._transactions:
+            upstream_tid = (upstream_tid + 1) & 0xFFFF
+        self._next_upstream_tid = (upstream_tid + 1) & 0xFFFF
+        transaction = Transaction(client_tid, upstream_tid, context)
+        self._transactions[upstream_tid] = transaction
+        return transaction
+
+    def resolve(self, upstream_tid):
+        """
+        Remove and return the transaction a response belongs to.
+
+        :param upstream_tid: transaction id of the response from the server
+
+        :returns: the Transaction or None if the transaction id is unknown or already expired
+        """
+        return self._transactions.pop(upstream_tid, None)
+
+    def expire(self, now=None):
+        """
+        Remove all transactions which waited longer than the timeout for their response.
+
+        :returns: list of the expired transactions
+        """
+        now = time.monotonic() if now is None else now
+        expired = []
+        for upstream_tid, transaction in self._transactions.items():
+            if now - transaction.sent_time < self._timeout:
+                break
+            expired.append(transaction)
+        for transaction in expired:
+            del self._transactions[transaction.upstream_tid]
+        return expired
+
+    def pop_all(self):
+        """Remove and return all outstanding transactions, e.g. when the connection is closed"""
+        transactions = list(self._transactions.values())
+        self._transactions.clear()
+        return transactions
+
+
 class ProtocolNormalisation:
     """this class simulates the protocol normalisation mechanism. The request from client to server and the response
         from server to client will be normalised. """
     @staticmethod
-    def protocol_normalisation(mbap_header, pdu_body, client_to_server):
+    def normalise_request(request, transaction_table, context=None):
         """
-        Scenario: ModbusServer start with transaction_id 0, meanwhile ModbusClient starts with transaction_id 1
-        :param mbap_header: header of the modbus/TCP packet
-        :param pdu_body: payload of the modbus/TCP packet
-        :param client_to_server: flag to determine if this is a request or a response packet
+        Scenario: ModbusServer start with transaction_id 0, meanwhile ModbusClient starts with transaction_id 1. The
+        transaction id of the request is replaced by an upstream transaction id allocated in the transaction table.
+        The request itself keeps the transaction id of the client, it is needed again for the response to the client.
+
+        :param request: ModbusFrame of the request from client
+        :param transaction_table: TransactionTable of the connection to the server
+        :param context: data stored with the transaction to process the response later
 
-        :returns: Normalized modbus/TCP packet.
+        :returns: Normalized modbus/TCP packet and the registered Transaction.
         """
-        (transaction_id, protocol_id, length, unit_id) = struct.unpack('>HHHB', mbap_header)
-        logging.info("Protocol normalisation started")
-        if client_to_server:
-            new_mbap_header = struct.pack('>HHHB', transaction_id - 1, protocol_id, length, unit_id)
-        else:
-            new_mbap_header = struct.pack('>HHHB', transaction_id + 1, protocol_id, length, unit_id)
+        if log_enabled(NORMALISATION):
+            logging.info("Protocol normalisation started")
+        transaction = transaction_table.register(request.transaction_id, context)
+        normalised_request = bytearray(request.raw)
+        TRANSACTION_ID.pack_into(normalised_request, 0, transaction.upstream_tid)
+
+        return normalised_request, transaction
 
-        return new_mbap_header + pdu_body
+    @staticmethod
+    def normalise_response(response, transaction_table):
+        """
+        The transaction id of the response is replaced in place by the transaction id of the request from client.
+
+        :param response: ModbusFrame of the response from server
+        :param transaction_table: TransactionTable of the connection to the server
+
+        :returns: Transaction of the response. None if no request waits for this response
+        """
+        if log_enabled(NORMALISATION):
+            logging.info("Protocol normalisation started")
+        transaction = transaction_table.resolve(response.transaction_id)
+        if transaction is None:
+            logging.warning(f"No outstanding request for response with transaction id {response.transaction_id}")
+            return None
+        response.set_transaction_id(transaction.client_tid)
+
+        return transaction
+
+    @staticmethod
+    def build_exception_response(request, exception_code=EXP_GATEWAY_TARGET_FAILED):
+        """
+        Build a modbus exception response for a request which could not be answered by the server, e.g. 0x0B (gateway
+        target device failed to respond) when the response did not arrive before the transaction timeout.
+
+        :param request: ModbusFrame of the request from client
+        :returns: ModbusFrame of the exception with the transaction id of the client request
+        """
+        return ModbusFrame.build(request.transaction_id,
+                                 0,
+                                 request.unit_id,
+                                 EXCEPTION_PDU.pack(request.function_code | 0x80, exception_code))
@@ -1,7 +1,15 @@
+import asyncio
+import threading
 import time
 import logging
 import sys
-from constants import DELAY_INTERVAL, DELAY_DURATION
+from collections import deque
+from TransactionLogging import log_enabled, THROTTLING
+from constants import (DELAY_INTERVAL, DELAY_DURATION, THROTTLING_TIME, THROTTLING_POLICY_PERIODIC,
+                       THROTTLING_POLICY_TOKEN_BUCKET, THROTTLING_POLICY_ADAPTIVE, CLIENT_RATE_LIMIT, CLIENT_BURST_SIZE,
+                       GLOBAL_RATE_LIMIT, GLOBAL_BURST_SIZE, ADAPTIVE_INITIAL_RATE, ADAPTIVE_MIN_RATE, ADAPTIVE_MAX_RATE,
+                       ADAPTIVE_INCREASE_STEP, ADAPTIVE_DECREASE_FACTOR, ADAPTIVE_LATENCY_TARGET, ADAPTIVE_QUEUE_TARGET,
+                       ADAPTIVE_WINDOW)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
                     handlers=[logging.StreamHandler(sys.stdout)])
@@ -30,3 +38,206 @@ class RateLimiting:
 
         return self._delay_active
 
+
+
+class PeriodicThrottlingPolicy:
+    """Throttling policy with the periodic schedule of `RateLimiting`: every DELAY_INTERVAL seconds the network of a
+        client connection is throttled for DELAY_DURATION seconds, each request in this period is delayed by
+        THROTTLING_TIME seconds."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._schedules = {}  # client id -> RateLimiting
+
+    def get_delay(self, client_id):
+        """Return the time in seconds the next request of the client has to be delayed"""
+        with self._lock:
+            schedule = self._schedules.get(client_id)
+            if schedule is None:
+                schedule = self._schedules[client_id] = RateLimiting()
+            return THROTTLING_TIME if schedule.check_in_delay_period() else 0
+
+    def record_response(self, latency, queue_depth=None):
+        """The periodic schedule does not depend on the modbus server"""
+
+    def remove_client(self, client_id):
+        with self._lock:
+            self._schedules.pop(client_id, None)
+
+
+class TokenBucket:
+    """Token bucket filled with `rate` tokens per second up to `capacity` tokens, each request takes one token. If the
+        bucket is empty, the token is reserved in advance and the request has to wait until it is refilled."""
+    __slots__ = ('rate', 'capacity', 'tokens', 'last_update')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_update = time.monotonic()
+
+    def reserve(self, current_time):
+        """Take one token and return the time in seconds until it is available"""
+        self.tokens = min(self.capacity, self.tokens + (current_time - self.last_update) * self.rate)
+        self.last_update = current_time
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class TokenBucketPolicy:
+    """Throttling policy with one token bucket per client connection and one token bucket for all connections. A
+        request is delayed until there is a token in both buckets."""
+    def __init__(self, client_rate=CLIENT_RATE_LIMIT, client_burst=CLIENT_BURST_SIZE, global_rate=GLOBAL_RATE_LIMIT,
+                 global_burst=GLOBAL_BURST_SIZE):
+        self._lock = threading.Lock()
+        self._client_rate = client_rate
+        self._client_burst = client_burst
+        self._client_buckets = {}  # client id -> TokenBucket
+        self._global_bucket = TokenBucket(global_rate, global_burst)
+
+    def get_delay(self, client_id):
+        """Return the time in seconds the next request of the client has to be delayed"""
+        with self._lock:
+            current_time = time.monotonic()
+            client_bucket = self._client_buckets.get(client_id)
+            if client_bucket is None:
+                client_bucket = self._client_buckets[client_id] = TokenBucket(self._client_rate, self._client_burst)
+            return max(client_bucket.reserve(current_time), self._global_bucket.reserve(current_time))
+
+    def record_response(self, latency, queue_depth=None):
+        """The rates of the token buckets are fixed"""
+
+    def remove_client(self, client_id):
+        with self._lock:
+            self._client_buckets.pop(client_id, None)
+
+
+class AdaptiveThrottlingPolicy:
+    """Throttling policy, which adapts the allowed request rate of all client connections to the load of the modbus
+        server (additive increase, multiplicative decrease). The latency of the upstream requests and the number of
+        outstanding upstream requests are measured over a window of ADAPTIVE_WINDOW seconds. If the mean latency is
+        above ADAPTIVE_LATENCY_TARGET or the queue depth above ADAPTIVE_QUEUE_TARGET, the rate is multiplied by
+        ADAPTIVE_DECREASE_FACTOR, otherwise ADAPTIVE_INCREASE_STEP is added to it. Requests exceeding the rate are
+        delayed by a token bucket. One policy is used per modbus server."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bucket = TokenBucket(ADAPTIVE_INITIAL_RATE, GLOBAL_BURST_SIZE)
+        self._window_start = time.monotonic()
+        self._window_responses = 0
+        self._window_latency = 0.0
+        self._window_queue_depth = 0
+        # Counters to follow the effective rate over time
+        self.increases = 0
+        self.decreases = 0
+        self.delayed_requests = 0
+
+    @property
+    def rate(self):
+        return self._bucket.rate
+
+    def get_delay(self, client_id):
+        """Return the time in seconds the next request of the client has to be delayed"""
+        with self._lock:
+            delay = self._bucket.reserve(time.monotonic())
+            if delay > 0:
+                self.delayed_requests += 1
+            return delay
+
+    def record_response(self, latency, queue_depth=None):
+        """
+        Measure one upstream request and adjust the rate at the end of the window.
+
+        :param latency: time in seconds from forwarding the request until its response (or timeout)
+        :param queue_depth: number of outstanding upstream requests, None if not known by the engine
+        """
+        with self._lock:
+            self._window_responses += 1
+            self._window_latency += latency
+            if queue_depth is not None:
+                self._window_queue_depth = max(self._window_queue_depth, queue_depth)
+            current_time = time.monotonic()
+            if current_time - self._window_start >= ADAPTIVE_WINDOW:
+                self._adjust_rate()
+                self._window_start = current_time
+                self._window_responses = 0
+                self._window_latency = 0.0
+                self._window_queue_depth = 0
+
+    def _adjust_rate(self):
+        mean_latency = self._window_latency / self._window_responses
+        if mean_latency > ADAPTIVE_LATENCY_TARGET or self._window_queue_depth > ADAPTIVE_QUEUE_TARGET:
+            self._bucket.rate = max(ADAPTIVE_MIN_RATE, self._bucket.rate * ADAPTIVE_DECREASE_FACTOR)
+            self.decreases += 1
+        else:
+            self._bucket.rate = min(ADAPTIVE_MAX_RATE, self._bucket.rate + ADAPTIVE_INCREASE_STEP)
+            self.increases += 1
+        logging.info(f"Adaptive throttling: rate {self._bucket.rate:.1f} requests/s, mean latency {mean_latency:.6f}s, "
+                     f"queue depth {self._window_queue_depth}, increases: {self.increases}, "
+                     f"decreases: {self.decreases}, delayed requests: {self.delayed_requests}")
+
+    def remove_client(self, client_id):
+        """The rate is shared by all client connections"""
+
+
+def create_throttling_policy(policy_name):
+    """Create the throttling policy selected by its name"""
+    if policy_name == THROTTLING_POLICY_TOKEN_BUCKET:
+        return TokenBucketPolicy()
+    if policy_name == THROTTLING_POLICY_ADAPTIVE:
+        return AdaptiveThrottlingPolicy()
+    if policy_name != THROTTLING_POLICY_PERIODIC:
+        logging.warning(f"Unknown throttling policy {policy_name}, periodic throttling is applied")
+    return PeriodicThrottlingPolicy()
+
+
+class ThrottlingScheduler:
+    """Delay queue of the asyncio proxy engine. A throttled request is not forwarded by sleeping in its session, but
+        queued until its departure time, which is serviced by a timer of the event loop. The session continues
+        reading further requests meanwhile and other sessions are not affected. The requests of one client
+        connection leave the queue in the order they arrived. The timers of a closed client connection are cancelled,
+        so that they do not release the requests of a new connection with the same client id (peername)."""
+    def __init__(self, policy):
+        self._policy = policy
+        # client id -> deque of (forwarding callback, timer of its departure time) of the queued requests
+        self._queues = {}
+        self._last_departure = {}  # client id -> departure time (event loop time) of the last queued request
+        self.delayed_requests = 0
+
+    def schedule(self, client_id, forward):
+        """
+        Forward a request now or at the departure time given by the throttling policy.
+
+        :param client_id: identifier of the client connection
+        :param forward: callback forwarding the request
+        """
+        delay = self._policy.get_delay(client_id)
+        queue = self._queues.get(client_id)
+        if delay <= 0 and not queue:
+            forward()
+            return
+        if log_enabled(THROTTLING):
+            logging.info(f"Communication is delayed for {delay:.3f}s")
+        self.delayed_requests += 1
+        loop = asyncio.get_running_loop()
+        departure_time = max(loop.time() + delay, self._last_departure.get(client_id, 0))
+        self._last_departure[client_id] = departure_time
+        if queue is None:
+            queue = self._queues[client_id] = deque()
+        queue.append((forward, loop.call_at(departure_time, self._release, client_id)))
+
+    def _release(self, client_id):
+        queue = self._queues.get(client_id)
+        if not queue:
+            # The client connection is already closed
+            return
+        (forward, _) = queue.popleft()
+        if not queue:
+            del self._queues[client_id]
+            del self._last_departure[client_id]
+        forward()
+
+    def remove_client(self, client_id):
+        """Drop the queued requests of a closed client connection and cancel their timers"""
+        for _, timer in self._queues.pop(client_id, ()):
+            timer.cancel()
+        self._last_departure.pop(client_id, None)
+        self._policy.remove_client(client_id)
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import sys
+from collections import Counter
+
+from ModbusFrame import ModbusFrame, REQUEST_PDU
+from RequestCoalescing import InFlightReadTable
+from constants import (REFRESH_AHEAD_INTERVAL, REFRESH_AHEAD_MARGIN, REFRESH_AHEAD_HOT_READS, REFRESH_AHEAD_MAX_GAP,
+                       MAX_REGISTERS_PER_READ, NUM_REGISTERS)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                    handlers=[logging.StreamHandler(sys.stdout)])
+
+
+class RefreshAhead:
+    """This class simulates refresh-ahead caching in the proxy server. The reads of each register are counted, the
+        counts are halved every round, so that they follow the current access frequency. Hot registers, which are
+        read at least REFRESH_AHEAD_HOT_READS times, are re-read from modbus server shortly before their cached value
+        expires. The first read after CACHE_TTL then does not have to wait for the server.
+
+        Hot registers lying close together are refreshed with one ranged read holding registers request over the
+        upstream connection pool. Client reads of the same range join the outstanding refresh."""
+
+    def __init__(self, proxy_cache, upstream_pool, in_flight_reads):
+        self._proxy_cache = proxy_cache
+        self._upstream_pool = upstream_pool
+        self._in_flight_reads = in_flight_reads
+        self._access_counts = Counter()  # (unit id, address) -> decayed number of reads
+        self._transaction_id = 0
+        self._task = None
+        self.refreshed_ranges = 0
+        self.refreshed_registers = 0
+
+    def record_read(self, request):
+        """Count a read holding registers request (ModbusFrame) of a client, whether it is answered from cache or
+            not. A read running past the last register address is answered with an exception and not counted."""
+        (start_address, quantity_to_read) = request.address_and_quantity()
+        if not 1 <= quantity_to_read <= MAX_REGISTERS_PER_READ or start_address + quantity_to_read > NUM_REGISTERS:
+            return
+        access_counts = self._access_counts
+        unit_id = request.unit_id
+        for address in range(start_address, start_address + quantity_to_read):
+            access_counts[(unit_id, address)] += 1
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        logging.info(f"Refresh-ahead: {self.refreshed_ranges} ranges with {self.refreshed_registers} registers "
+                     f"refreshed")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(REFRESH_AHEAD_INTERVAL)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.error(f"Error: {e} while refreshing hot registers")
+
+    def _take_hot_registers(self):
+        """Return the hot registers per unit id and halve all read counts"""
+        hot_registers = {}
+        for (unit_id, address), count in self._access_counts.items():
+            if count >= REFRESH_AHEAD_HOT_READS:
+                hot_registers.setdefault(unit_id, []).append(address)
+        self._access_counts = Counter({key: count // 2 for key, count in self._access_counts.items() if count > 1})
+        return hot_registers
+
+    @staticmethod
+    def batch_ranges(addresses):
+        """
+        Merge registers into ranges of one read holding registers request each.
+
+        :param addresses: register addresses in ascending order
+        :returns: list of (start_address, quantity)
+        """
+        ranges = []
+        for address in addresses:
+            if ranges:
+                (start_address, quantity) = ranges[-1]
+                gap = address - (start_address + quantity)
+                if gap <= REFRESH_AHEAD_MAX_GAP and address - start_address < MAX_REGISTERS_PER_READ:
+                    ranges[-1] = (start_address, address - start_address + 1)
+                    continue
+            ranges.append((address, 1))
+        return ranges
+
+    async def refresh(self):
+        """Re-read the hot registers which expire within REFRESH_AHEAD_MARGIN seconds"""
+        refreshes = []
+        for unit_id, addresses in self._take_hot_registers().items():
+            expiring = self._proxy_cache.find_expiring(unit_id, sorted(addresses), REFRESH_AHEAD_MARGIN)
+            for start_address, quantity in self.batch_ranges(expiring):
+                refreshes.append(self._refresh_range(unit_id, start_address, quantity))
+        if refreshes:
+            await asyncio.gather(*refreshes)
+
+    async def _refresh_range(self, unit_id, start_address, quantity):
+        request = ModbusFrame.build((self._transaction_id + 1) & 0xFFFF,
+                                    0,
+                                    unit_id,
+                                    REQUEST_PDU.pack(3, start_address, quantity))
+        key = InFlightReadTable.read_key(request)
+        if key in self._in_flight_reads:
+            # A client already reads this range, its response fills the cache
+            return
+        self._transaction_id = request.transaction_id
+        cache_generation = self._proxy_cache.generation
+        refresh = self._in_flight_reads.start(key, self._upstream_pool.request(request))
+        try:
+            modbus_server_response = await asyncio.shield(refresh)
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            logging.warning(f"Refresh of {quantity} register(s) from {start_address} failed: {e!r}")
+            return
+        self._proxy_cache.store_read_response(request, modbus_server_response, cache_generation)
+        self.refreshed_ranges += 1
+        self.refreshed_registers += quantity
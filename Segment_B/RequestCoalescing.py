@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import sys
+
+from TransactionLogging import log_enabled, CACHE
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                    handlers=[logging.StreamHandler(sys.stdout)])
+
+
+class InFlightReadTable:
+    """This class simulates request coalescing (single flight) in the proxy server. When several clients read the
+        same holding registers at the same moment, only the first read is forwarded to the modbus server. The other
+        identical reads (same unit id, start address and quantity) wait for the response of this upstream
+        transaction, so that slow field devices are protected from polling storms.
+
+        The upstream transaction runs as a task of its own. If the client which started it disconnects, the other
+        clients still get the response."""
+
+    def __init__(self):
+        self._in_flight = {}  # (unit_id, start_address, quantity) -> task of the outstanding upstream read
+        self.coalesced_reads = 0
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    def __contains__(self, key):
+        return key in self._in_flight
+
+    @staticmethod
+    def read_key(request):
+        """Key identifying identical read holding registers requests (ModbusFrame)"""
+        (start_address, quantity_to_read) = request.address_and_quantity()
+        return request.unit_id, start_address, quantity_to_read
+
+    def join(self, key):
+        """
+        Look for an outstanding upstream read with the same key.
+
+        :returns: task of the outstanding read or None if the read has to be forwarded to the server
+        """
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced_reads += 1
+            if log_enabled(CACHE):
+                logging.info(f"Read of {key} joins outstanding request, coalesced reads: {self.coalesced_reads}")
+        return task
+
+    def start(self, key, upstream_read):
+        """
+        Run an upstream read, which identical reads can join until its response arrives.
+
+        :param key: key of the read returned by `read_key`
+        :param upstream_read: coroutine forwarding the read to server
+
+        :returns: task of the upstream read, must be awaited through asyncio.shield
+        """
+        task = asyncio.ensure_future(upstream_read)
+        self._in_flight[key] = task
+        task.add_done_callback(lambda finished_task: self._finish(key, finished_task))
+        return task
+
+    def invalidate(self, unit_id, start_address, quantity):
+        """A write of registers is forwarded. The outstanding reads of these registers may be answered by the server
+            before the write, so reads received from now on must not join them and start a fresh upstream read."""
+        end_address = start_address + quantity
+        overlapping = [key for key in self._in_flight
+                       if key[0] == unit_id and key[1] < end_address and start_address < key[1] + key[2]]
+        for key in overlapping:
+            del self._in_flight[key]
+        if overlapping and log_enabled(CACHE):
+            logging.info(f"Write of {quantity} register(s) from {start_address} detaches outstanding reads "
+                         f"{overlapping}")
+
+    def _finish(self, key, task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # Mark the exception as retrieved, the waiting requests may already be cancelled
+        if not task.cancelled():
+            task.exception()
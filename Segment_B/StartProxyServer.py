@@ -1,63 +1,102 @@
+import asyncio
+import functools
 import socket
-import struct
 import sys
 import threading
 from Caching import Caching
-from ProtocolNormalisation import ProtocolNormalisation
-from RateLimiting import RateLimiting
+from FrameReassembly import MbapFrameReassembler, receive_frame, read_modbus_frame
+from ModbusFrame import ModbusFrame, ADDRESS_QUANTITY, REQUEST_PDU, REGISTER, PDU_DATA_OFFSET
+from ProtocolNormalisation import ProtocolNormalisation, TransactionTable
+from UpstreamConnectionPool import UpstreamConnectionPool
+from RequestCoalescing import InFlightReadTable
+from RefreshAhead import RefreshAhead
+from RateLimiting import ThrottlingScheduler, create_throttling_policy
+from DelayScheduler import DelayScheduler
 from SteganographySizeModulationMethod import S1SizeModulation
 from SteganographyInterPacketTimesMethod import T1InterPacketTimes
-from constants import (SOCKET_TIMEOUTS, NUM_CLIENT, S1_STEG_MESS, T1_STEG_MESS, THROTTLING_TIME, NUM_BITS_CHARACTER,
-                       NUM_BITS_HEADER, PROXY_SERVER_PORT)
+from CovertChunks import CovertChunkScheduler, CovertCursor
+import TransactionLogging
+from TransactionLogging import log_enabled, THROTTLING
+from PacketTrace import setup_trace, trace_transaction, TRACE_CACHE_HIT
+from constants import (SOCKET_TIMEOUTS, NUM_CLIENT, S1_STEG_MESS, T1_STEG_MESS, NUM_BITS_CHARACTER,
+                       NUM_BITS_HEADER, S1_BITS_PER_PACKET, S1_MAX_BITS_PER_PACKET, PROXY_SERVER_PORT, T1_DELAY_TIME,
+                       PROXY_ENGINE_THREADING, PROXY_ENGINE_ASYNCIO, ASYNC_BACKLOG, MAX_PENDING_TRANSACTIONS,
+                       THROTTLING_POLICY_PERIODIC, EXP_GATEWAY_TARGET_FAILED, EXP_GATEWAY_PATH_UNAVAILABLE,
+                       EXP_ILLEGAL_DATA_VALUE)
 import logging
 import time
 import os
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
-                    handlers=[logging.StreamHandler(sys.stdout)])
-
-def mbap_header_logging(transaction_id, protocol_id, length, unit_id, source):
-    """Log out the header of a modbus/TCP packet"""
-    logging.info(f"{source} header:")
-    logging.info(f"{source}_TID: {transaction_id}")
-    logging.info(f"{source}_PID: {protocol_id}")
-    logging.info(f"{source}_LF: {length}")
-    logging.info(f"{source}_UID: {unit_id}")
-    logging.info("----------------------------------")
-
-def pdu_body_logging(function_code, pdu_body, packet_type):
-    """Log out the pdu payload of a modbus/TCP packet"""
-    if function_code == 3:
-        # Read holding Register, only one register is read each time
+TransactionLogging.setup_logging()
+setup_trace()
+
+def packet_logging(record, modbus_frame, packet_type):
+    """Add header and pdu payload of a modbus/TCP packet (ModbusFrame) to the record of its transaction"""
+    if record is None:
+        return
+    record.header(packet_type, modbus_frame.transaction_id, modbus_frame.protocol_id, modbus_frame.length,
+                  modbus_frame.unit_id)
+    pdu_body_logging(record, modbus_frame, packet_type)
+
+def pdu_body_logging(record, modbus_frame, packet_type):
+    """Add the pdu payload of a modbus/TCP packet to the record of its transaction"""
+    function_code = modbus_frame.function_code
+    if packet_type == "Request" and modbus_frame.is_truncated:
+        # Only the function code of a truncated request is logged
+        pass
+    elif function_code == 3:
         if packet_type == "Request":
-            pdu_body_truncate = pdu_body[:4]
-            logging.info("Request PDU:")
-            (starting_address, quantity_to_read) = struct.unpack(">HH", pdu_body_truncate)
-            logging.info(f"starting_address: {starting_address}")
-            logging.info(f"quantity_to_read: {quantity_to_read}")
+            (starting_address, quantity_to_read) = modbus_frame.address_and_quantity()
+            record.field("starting_address", starting_address)
+            record.field("quantity_to_read", quantity_to_read)
         else:
-            pdu_body_truncate = pdu_body[:3]
-            logging.info("Response PDU:")
-            (num_bytes_to_read, read_value) = struct.unpack(">BH", pdu_body_truncate)
-            logging.info(f"Num_bytes_to_read: {num_bytes_to_read}")
-            logging.info(f"Read_value: {read_value}")
+            # Only the value of the first register read is logged
+            num_bytes_to_read = modbus_frame.raw[PDU_DATA_OFFSET]
+            read_value = REGISTER.unpack_from(modbus_frame.raw, PDU_DATA_OFFSET + 1)[0]
+            record.field("Num_bytes_to_read", num_bytes_to_read)
+            record.field("Read_value", read_value)
     elif function_code == 6:
         # write holding register, in this experiment, only one register value is written each time
-        pdu_body_truncate = pdu_body[:4]
+        (writing_address, writing_value) = ADDRESS_QUANTITY.unpack_from(modbus_frame.raw, PDU_DATA_OFFSET)
+        record.field("writing_address", writing_address)
+        record.field("writing_value", writing_value)
+    elif function_code == 16:
+        # The response echoes starting address and quantity of the request
+        (writing_address, quantity_to_write) = ADDRESS_QUANTITY.unpack_from(modbus_frame.raw, PDU_DATA_OFFSET)
+        record.field("writing_address", writing_address)
+        record.field("quantity_to_write", quantity_to_write)
+    elif function_code == 23:
         if packet_type == "Request":
-            logging.info("Request PDU:")
+            (starting_address, quantity_to_read) = modbus_frame.address_and_quantity()
+            (writing_address, quantity_to_write) = modbus_frame.write_range()
+            record.field("starting_address", starting_address)
+            record.field("quantity_to_read", quantity_to_read)
+            record.field("writing_address", writing_address)
+            record.field("quantity_to_write", quantity_to_write)
         else:
-            logging.info("Response PDU:")
-        (writing_address, writing_value) = struct.unpack(">HH", pdu_body_truncate)
-        logging.info(f"writing_address: {writing_address}")
-        logging.info(f"writing_value: {writing_value}")
-    logging.info(f"{packet_type}_FC: {function_code}")
-    logging.info("----------------------------------")
-
-def calculate_and_log_rtt(response_source, forward_response_time, receive_request_time):
-    """ Utility for calculating RTT"""
-    logging.info(f"Forward response from {response_source} to modbus-client")
-    logging.info(f"Round-Trip-Time at proxy-server: {forward_response_time - receive_request_time}\n\n")
+            # Only the value of the first register read is logged
+            record.field("Num_bytes_to_read", modbus_frame.raw[PDU_DATA_OFFSET])
+            record.field("Read_value", REGISTER.unpack_from(modbus_frame.raw, PDU_DATA_OFFSET + 1)[0])
+    record.field(f"{packet_type}_FC", function_code)
+
+def response_logging(record, modbus_response):
+    """Add header and pdu payload of a response to the record of its transaction"""
+    packet_logging(record, modbus_response, "Response")
+
+def calculate_and_log_rtt(record, response_source, forward_response_time, receive_request_time, request,
+                          modbus_response):
+    """ Utility for calculating RTT. The record of the transaction is complete and written as one log line, the
+        transaction is added to the packet trace"""
+    trace_transaction(receive_request_time,
+                      forward_response_time - receive_request_time,
+                      request.mbap_header,
+                      request.pdu_body,
+                      modbus_response.raw,
+                      TRACE_CACHE_HIT if response_source == "cache" else 0)
+    if record is not None:
+        record.field("Response_source", response_source)
+        record.round_trip_time("Round-Trip-Time at proxy-server", forward_response_time - receive_request_time)
+        record.emit()
 
 def connect_to_server(server_address):
     """Connect proxy server with modbus server"""
@@ -68,27 +107,79 @@ def connect_to_server(server_address):
     except Exception as e:
         logging.error(f"Error: {e} while connecting to {server_address}")
 
-def apply_size_modulation():
+def create_size_modulation_scheduler():
+    """Create the proxy-wide scheduler, which stripes the chunks of the size modulation message over all connections
+        to the modbus server, if the environment variable APPLY_SIZE_MODULATION is set. S1_BITS_PER_PACKET bits
+        (environment variable, 1 by default) are encoded in each request. Returns the scheduler and the number of bits
+        per packet, (None, 0) if size modulation is not applied"""
     if os.getenv('APPLY_SIZE_MODULATION', False):
-        steg_s1 = S1SizeModulation()
-        steg_s1.convert_steganography_message_to_bits(S1_STEG_MESS)
-        logging.info("applying size modulation")
-        # Each character in steganography will be encoded by 8 bits, which represent ASCII number of that character.
-        # 8 first bits represent number of characters in the message
+        bits_per_packet = int(os.getenv('S1_BITS_PER_PACKET', S1_BITS_PER_PACKET))
+        if not 1 <= bits_per_packet <= S1_MAX_BITS_PER_PACKET:
+            logging.warning(f"S1_BITS_PER_PACKET must be between 1 and {S1_MAX_BITS_PER_PACKET}, "
+                            f"{S1_BITS_PER_PACKET} bit(s) per packet are applied")
+            bits_per_packet = S1_BITS_PER_PACKET
+        s1_scheduler = CovertChunkScheduler(S1SizeModulation.convert_steganography_message_to_bits(S1_STEG_MESS))
+        # Each character in steganography will be encoded by 7 bits, which represent ASCII number of that character.
+        # 10 first bits represent number of bits in the message
         num_bits_embed = len(S1_STEG_MESS) * NUM_BITS_CHARACTER + NUM_BITS_HEADER
-        return steg_s1, num_bits_embed
+        logging.info(f"applying size modulation with {bits_per_packet} bits-per-packet, {num_bits_embed} bits are "
+                     f"embedded in {s1_scheduler.num_chunks} chunks")
+        return s1_scheduler, bits_per_packet
     return None, 0
 
-def apply_inter_packet_times():
+def create_inter_packet_times_scheduler():
+    """Create the proxy-wide scheduler, which stripes the chunks of the inter-packet-times message over all client
+        sessions, if the environment variable APPLY_INTER_PACKET_TIMES is set. A bit is embedded with a delay of
+        T1_DELAY_TIME seconds (environment variable, 0.25 by default). Returns the scheduler and the delay, (None, 0)
+        if inter-packet-times is not applied"""
     if os.getenv('APPLY_INTER_PACKET_TIMES', False):
-        steg_t1 = T1InterPacketTimes(T1_STEG_MESS)
-        logging.info("applying inter packet times")
-        # Each character in steganography will be encoded by 8 bits, which represent ASCII number of that character.
-        # 8 first bits represent number of characters in the message
+        delay_time = float(os.getenv('T1_DELAY_TIME', T1_DELAY_TIME))
+        t1_scheduler = CovertChunkScheduler(T1InterPacketTimes.convert_steganography_message_to_bits(T1_STEG_MESS))
+        # Each character in steganography will be encoded by 7 bits, which represent ASCII number of that character.
+        # 10 first bits represent number of bits in the message
         num_bits_embed = len(T1_STEG_MESS) * NUM_BITS_CHARACTER + NUM_BITS_HEADER
-        return steg_t1, num_bits_embed
+        logging.info(f"applying inter packet times with a delay of {delay_time}s, {num_bits_embed} bits are "
+                     f"embedded in {t1_scheduler.num_chunks} chunks")
+        return t1_scheduler, delay_time
     return None, 0
 
+def apply_size_modulation(s1_scheduler, bits_per_packet):
+    """Create the size modulation of one connection to the modbus server, None if size modulation is not applied"""
+    if s1_scheduler is None:
+        return None
+    return S1SizeModulation(CovertCursor(s1_scheduler), bits_per_packet)
+
+def apply_inter_packet_times(t1_scheduler, t1_delay_time):
+    """Create the inter-packet-times of one client session, None if inter-packet-times is not applied"""
+    if t1_scheduler is None:
+        return None
+    return T1InterPacketTimes(CovertCursor(t1_scheduler), t1_delay_time)
+
+def create_proxy_cache():
+    """Create the cache shared by all client connections. Writes confirmed by server fill the cache, if the
+        environment variable CACHE_WRITE_THROUGH is set"""
+    write_through = bool(os.getenv('CACHE_WRITE_THROUGH', False))
+    if write_through:
+        logging.info("applying write-through caching")
+    return Caching(write_through)
+
+def apply_throttling_policy():
+    """Create the throttling policy shared by all client connections, which is selected by the environment variable
+        THROTTLING_POLICY (periodic, token_bucket or adaptive)"""
+    policy_name = os.getenv('THROTTLING_POLICY', THROTTLING_POLICY_PERIODIC)
+    logging.info(f"applying {policy_name} throttling")
+    return create_throttling_policy(policy_name)
+
+def apply_refresh_ahead(proxy_cache, upstream_pool, in_flight_reads):
+    """Start refreshing hot registers ahead of their expiry, if the environment variable CACHE_REFRESH_AHEAD is set
+        (asyncio engine only)"""
+    if os.getenv('CACHE_REFRESH_AHEAD', False):
+        refresh_ahead = RefreshAhead(proxy_cache, upstream_pool, in_flight_reads)
+        refresh_ahead.start()
+        logging.info("applying refresh-ahead")
+        return refresh_ahead
+    return None
+
 def close_connection(client_socket, server_socket):
     """close connection from proxy server to modbus-client and modbus-server"""
     client_socket.close()
@@ -96,124 +187,142 @@ def close_connection(client_socket, server_socket):
     server_socket.close()
     logging.info("Server socket closed")
 
-def handle_client(client_socket, server_address):
-    """Handle communication between client and server."""
+def handle_client(client_socket, client_address, server_address, proxy_cache, throttling_policy, s1_scheduler,
+                  s1_bits_per_packet, t1_scheduler, t1_delay_time):
+    """Handle communication between client and server. The cache, the throttling policy and the schedulers of the
+        hidden messages are shared with the other client threads."""
 
     # Create a socket to communicate with the actual server
     server_socket = connect_to_server(server_address)
 
-    # Network will be throttled every 30 seconds. The throttling last for 10 seconds.
-    # In this ten seconds period, each request will be delayed for 1 seconds
-    rate_limiting = RateLimiting()
-    proxy_cache = Caching()
-    # Object to apply steganography methode size modulation
-    steg_s1, num_bits_embedded_s1 = apply_size_modulation()
+    # Object to apply steganography methode size modulation, each client thread has a server connection of its own
+    steg_s1 = apply_size_modulation(s1_scheduler, s1_bits_per_packet)
     # Object to apply steganography methode inter-packet-times
-    steg_t1, num_bits_embedded_t1 = apply_inter_packet_times()
+    steg_t1 = apply_inter_packet_times(t1_scheduler, t1_delay_time)
+    # TCP can split a frame over several reads or deliver several frames with one read. Frames are reassembled in a
+    # preallocated buffer per direction and handed out as memoryviews, so slicing header and payload copies nothing
+    client_frames = MbapFrameReassembler()
+    server_frames = MbapFrameReassembler()
+    # Requests are processed one after another on this connection, the table holds at most one transaction
+    transaction_table = TransactionTable()
     try:
         while True:
-            # receive request from client
-            modbus_client_request = client_socket.recv(1024)
+            # receive request from client. If one read delivered several requests, the next one is taken from buffer.
+            # The frame is copied out of the receive buffer and its header is parsed once for all mechanisms
+            request = ModbusFrame.parse(receive_frame(client_socket, client_frames))
             # Time when the Modbus/TCP request is received
             receive_request_time = time.time()
-            logging.info(f"Request arrives proxy server at {receive_request_time}")
-
-            request_mbap_header = modbus_client_request[:7]
-            request_pdu_body = modbus_client_request[7:]
-
-            (transaction_id, protocol_id, length, unit_id) = struct.unpack('>HHHB', request_mbap_header)
-            function_code = struct.unpack('B', request_pdu_body[:1])[0]
-            mbap_header_logging(transaction_id, protocol_id, length, unit_id, "Request")
-            pdu_body_logging(function_code, request_pdu_body[1:], "Request")
+            # Record of this transaction, None if it is not logged
+            record = TransactionLogging.start_transaction()
+            packet_logging(record, request, "Request")
+
+            # A truncated request is answered with exception 0x03 by the proxy server, the modbus server would close
+            # the connection
+            if request.is_truncated:
+                exception_response = ProtocolNormalisation.build_exception_response(request, EXP_ILLEGAL_DATA_VALUE)
+                response_logging(record, exception_response)
+                calculate_and_log_rtt(record,
+                                      "proxy-server",
+                                      time.time(),
+                                      receive_request_time,
+                                      request,
+                                      exception_response)
+                client_socket.sendall(exception_response.raw)
+                continue
 
             # Check in cache if register value is available
+            function_code = request.function_code
             if function_code == 3:
-                response_from_cache = proxy_cache.check_if_value_in_cache(request_pdu_body,
-                                                                            transaction_id,
-                                                                            protocol_id,
-                                                                            unit_id)
+                response_from_cache = proxy_cache.check_if_value_in_cache(request)
                 if response_from_cache is not None:
                     receive_response_time = time.time()
-                    calculate_and_log_rtt("cache",
+                    response_logging(record, response_from_cache)
+                    calculate_and_log_rtt(record,
+                                          "cache",
                                           receive_response_time,
-                                          receive_request_time)
-                    client_socket.sendall(response_from_cache)
+                                          receive_request_time,
+                                          request,
+                                          response_from_cache)
+                    client_socket.sendall(response_from_cache.raw)
                     continue
-            elif function_code == 6:
-                # If an existing value in cache is overwritten, this value will be removed from cache
-                function_code, writing_address, value = struct.unpack('>BHH', request_pdu_body)
-                proxy_cache.clean_cache(writing_address)
-                logging.info(f"cache after being cleaned {proxy_cache.cache}")
+            elif function_code in (6, 16, 23):
+                # If existing values in cache are overwritten, these values will be removed from cache
+                proxy_cache.clean_cache(request.unit_id, *request.write_range())
+            # The response is not stored for registers invalidated by other clients in the meantime
+            cache_generation = proxy_cache.generation
 
-            if steg_s1 is not None and num_bits_embedded_s1 > 0:
+            if steg_s1 is not None:
                 # embed steganography in request
-                embedded_request = steg_s1.s1_size_modulation(modbus_client_request, True)
-                num_bits_embedded_s1 -= 1
-                request_mbap_header = embedded_request[:7]
-                request_pdu_body = embedded_request[7:]
+                request = steg_s1.s1_size_modulation(request, True)
 
-            if steg_t1 is not None and num_bits_embedded_t1 > 0:
+            if steg_t1 is not None:
                 # Check if steganography delaying is applicable. Delaying is not always applied, only when (encoded
                 # bit is 0 and function code of current packet is 6) or (encoded bit is 1 and function code of
                 # current packet is 3)
-                if steg_t1.apply_delay(function_code):
-                    num_bits_embedded_t1 -= 1
+                steg_t1.apply_delay(function_code)
 
-            # Check if we should start the network throttling period
-            if rate_limiting.check_in_delay_period():
-                logging.info("Communication is delayed")
-                time.sleep(THROTTLING_TIME)
+            # Delay the request, if the throttling policy demands it. Requests of this connection are processed one
+            # after another, so the delay is waited here
+            throttling_delay = throttling_policy.get_delay(client_address)
+            if throttling_delay > 0:
+                if log_enabled(THROTTLING):
+                    logging.info("Communication is delayed")
+                time.sleep(throttling_delay)
 
             # Protocol normalisation is applied. Example scenario: in Client the transaction id starts with 1 but in
             # Server the transaction_id starts with 0 -> Protocol must be normalised
-            normalised_request = ProtocolNormalisation.protocol_normalisation(request_mbap_header,
-                                                                              request_pdu_body,
-                                                                              True)
+            normalised_request, _ = ProtocolNormalisation.normalise_request(request, transaction_table)
 
             # Forwarding Request to Server
+            forward_request_time = time.monotonic()
             server_socket.sendall(
                 normalised_request
             )
-            logging.info("Request is forwarded to server")
 
             # Receive response from server
-            modbus_server_response = server_socket.recv(1024)
-
-            response_mbap_header = modbus_server_response[:7]
-            (transaction_id_res,
-             protocol_id_res,
-             length_res,
-             unit_id_res) = struct.unpack('>HHHB', response_mbap_header)
-
-            mbap_header_logging(transaction_id_res,
-                                protocol_id_res,
-                                length_res,
-                                unit_id_res,
-                                "Response")
-
-            response_pdu_body = modbus_server_response[7:]
-            function_code = struct.unpack('B', response_pdu_body[:1])[0]
-            pdu_body_logging(function_code, response_pdu_body[1:], "Response")
+            modbus_server_response = ModbusFrame.parse(receive_frame(server_socket, server_frames))
+            # Each thread has its own server connection with one outstanding request, the queue depth is not known
+            throttling_policy.record_response(time.monotonic() - forward_request_time)
+            response_logging(record, modbus_server_response)
 
+            function_code = modbus_server_response.function_code
             if function_code == 3:
-                (_, read_address, _) = struct.unpack('>BHH', request_pdu_body[:5])
-                (_, _, read_data) = struct.unpack('>BBH', modbus_server_response[7:11])
-                proxy_cache.set_cache_data(read_address, read_data)
-                logging.info(f"New value added to cache: {proxy_cache.cache}")
-
-            # Protocol normalisation from response from server to request
-            normalised_response = ProtocolNormalisation.protocol_normalisation(response_mbap_header,
-                                                                               response_pdu_body,
-                                                                               False)
+                # All registers of the read are stored, a partial cache hit is forwarded to server as a whole
+                proxy_cache.store_read_response(request, modbus_server_response, cache_generation)
+            elif function_code in (6, 16):
+                proxy_cache.store_write_response(request, modbus_server_response, cache_generation)
+            elif function_code == 23:
+                # The registers are written before they are read by the modbus server. The read values are stored
+                # first, the confirmed write then invalidates or stores the registers it wrote.
+                proxy_cache.store_read_response(request, modbus_server_response, cache_generation)
+                proxy_cache.store_write_response(request, modbus_server_response, cache_generation)
+
+            # Protocol normalisation from response from server to request, the transaction id is rewritten in place
+            transaction_id_res = modbus_server_response.transaction_id
+            transaction = ProtocolNormalisation.normalise_response(modbus_server_response, transaction_table)
+            if transaction is None:
+                raise ValueError(f"Response with transaction id {transaction_id_res} does not match the request")
 
             # Forward response from server to client
-            client_socket.sendall(normalised_response)
+            client_socket.sendall(modbus_server_response.raw)
             # Time when the Modbus/TCP response is received
             forward_response_time = time.time()
-            calculate_and_log_rtt("modbus-server", forward_response_time, receive_request_time)
+            calculate_and_log_rtt(record,
+                                  "modbus-server",
+                                  forward_response_time,
+                                  receive_request_time,
+                                  request,
+                                  modbus_server_response)
     except Exception as e:
         logging.error(f"Error: {e} \n...Connection will be terminated\n")
     finally:
+        # Chunks of the hidden messages, which are not sent completely, are sent by the other sessions
+        if steg_s1 is not None:
+            steg_s1.close()
+        if steg_t1 is not None:
+            steg_t1.close()
+        throttling_policy.remove_client(client_address)
+        proxy_cache.log_metrics()
         close_connection(client_socket, server_socket)
 
 def start_proxy(host='localhost', port=502, server_address=('localhost', 502)):
@@ -227,6 +336,12 @@ def start_proxy(host='localhost', port=502, server_address=('localhost', 502)):
     proxy_socket.listen(NUM_CLIENT)
     proxy_socket.settimeout(SOCKET_TIMEOUTS)
     logging.info(f"Proxy server running on {host}:{port}, forwarding to server at {server_address}")
+    # One cache and one throttling policy for all client connections
+    proxy_cache = create_proxy_cache()
+    throttling_policy = apply_throttling_policy()
+    # The hidden messages are striped over all client connections
+    s1_scheduler, s1_bits_per_packet = create_size_modulation_scheduler()
+    t1_scheduler, t1_delay_time = create_inter_packet_times_scheduler()
 
     try:
         while True:
@@ -236,7 +351,15 @@ def start_proxy(host='localhost', port=502, server_address=('localhost', 502)):
                 logging.info(f"Connection from client {client_address}")
 
                 # Start a new thread to handle the client
-                client_handler = threading.Thread(target=handle_client, args=(client_socket, server_address))
+                client_handler = threading.Thread(target=handle_client, args=(client_socket,
+                                                                               client_address,
+                                                                               server_address,
+                                                                               proxy_cache,
+                                                                               throttling_policy,
+                                                                               s1_scheduler,
+                                                                               s1_bits_per_packet,
+                                                                               t1_scheduler,
+                                                                               t1_delay_time))
                 client_handler.start()
             except socket.timeout:
                 # Timeout occurs every 1.1 second, continue the loop and check for interrupt
@@ -245,12 +368,344 @@ def start_proxy(host='localhost', port=502, server_address=('localhost', 502)):
         logging.info("Proxy server shutting down.")
     finally:
         proxy_socket.close()
+        proxy_cache.log_metrics()
         logging.info("Proxy server socket closed.")
 
 
+async def close_client_connection_async(client_writer):
+    """close asyncio stream from proxy server to modbus-client"""
+    client_writer.close()
+    try:
+        await client_writer.wait_closed()
+    except (ConnectionError, OSError):
+        pass
+    logging.info("Client socket closed")
+
+def schedule_delayed_forward(delay_scheduler, delayed_forwards, delay, forward):
+    """Hand a request to the delay scheduler, which returns it to the event loop after `delay` seconds. The request
+        is dropped, if the session is closed in the meantime."""
+    loop = asyncio.get_running_loop()
+
+    def release():
+        # Runs on the event loop, the handle is removed from delayed_forwards when the session is closed
+        if handle in delayed_forwards:
+            delayed_forwards.discard(handle)
+            forward()
+
+    handle = delay_scheduler.call_later(delay, loop.call_soon_threadsafe, release)
+    delayed_forwards.add(handle)
+
+async def forward_requests_async(client_reader, client_writer, client_id, upstream_pool, in_flight_reads,
+                                 pending_slots, proxy_cache, refresh_ahead, throttling_scheduler, delay_scheduler,
+                                 transactions_in_flight, delayed_forwards, steg_t1):
+    """Receive requests from client, apply the proxy mechanisms and forward them to server without waiting for the
+        response of the previous request. Up to MAX_PENDING_TRANSACTIONS requests can wait for a response at once.
+        Size modulation is applied by the pool connection, which forwards the request to server."""
+    while True:
+        # receive request from client
+        request = ModbusFrame(await read_modbus_frame(client_reader))
+        # Time when the Modbus/TCP request is received
+        receive_request_time = time.time()
+        # Record of this transaction, None if it is not logged
+        record = TransactionLogging.start_transaction()
+        packet_logging(record, request, "Request")
+
+        # A truncated request is answered with exception 0x03 by the proxy server, the modbus server would close the
+        # upstream connection shared with other clients
+        if request.is_truncated:
+            exception_response = ProtocolNormalisation.build_exception_response(request, EXP_ILLEGAL_DATA_VALUE)
+            response_logging(record, exception_response)
+            calculate_and_log_rtt(record,
+                                  "proxy-server",
+                                  time.time(),
+                                  receive_request_time,
+                                  request,
+                                  exception_response)
+            client_writer.write(exception_response.raw)
+            await client_writer.drain()
+            continue
+
+        # Check in cache if register value is available
+        function_code = request.function_code
+        if function_code == 3:
+            if refresh_ahead is not None:
+                refresh_ahead.record_read(request)
+            response_from_cache = proxy_cache.check_if_value_in_cache(request)
+            if response_from_cache is not None:
+                receive_response_time = time.time()
+                response_logging(record, response_from_cache)
+                calculate_and_log_rtt(record,
+                                      "cache",
+                                      receive_response_time,
+                                      receive_request_time,
+                                      request,
+                                      response_from_cache)
+                # Responses are identified by their transaction id, a response from cache may overtake responses
+                # of earlier requests which are still outstanding at the server
+                client_writer.write(response_from_cache.raw)
+                await client_writer.drain()
+                continue
+        elif function_code in (6, 16, 23):
+            # If existing values in cache are overwritten, these values will be removed from cache. Later reads of
+            # these registers do not join a read forwarded before the write.
+            proxy_cache.clean_cache(request.unit_id, *request.write_range())
+            in_flight_reads.invalidate(request.unit_id, *request.write_range())
+        # The response is not stored for registers invalidated by other requests in the meantime
+        cache_generation = proxy_cache.generation
+
+        # An identical read which is already outstanding at the server is not forwarded again
+        shared_read = None
+        missing_ranges = None
+        if function_code == 3:
+            shared_read = in_flight_reads.join(InFlightReadTable.read_key(request))
+            if shared_read is None:
+                # On a partial cache hit only the registers missing in cache are read from server
+                missing_ranges = proxy_cache.find_partial_hit(request)
+
+        inter_packet_delay = 0
+        if steg_t1 is not None and steg_t1.check_delay(function_code):
+            inter_packet_delay = steg_t1.delay_time
+
+        # Wait until less than MAX_PENDING_TRANSACTIONS requests of this connection wait for a response
+        await pending_slots.acquire()
+        # The throttling policy decides when the request is forwarded. A delayed request waits in the delay queue,
+        # while further requests of the client are received
+        schedule_forward = functools.partial(throttling_scheduler.schedule,
+                                             client_id,
+                                             functools.partial(start_transaction,
+                                                               transactions_in_flight,
+                                                               request,
+                                                               receive_request_time,
+                                                               record,
+                                                               client_writer,
+                                                               upstream_pool,
+                                                               in_flight_reads,
+                                                               shared_read,
+                                                               missing_ranges,
+                                                               pending_slots,
+                                                               proxy_cache,
+                                                               cache_generation))
+        if inter_packet_delay > 0:
+            # The request delayed to encode a bit waits in the delay scheduler. Further requests of this session are
+            # received and forwarded without delay in the meantime, the responses are matched by transaction id
+            schedule_delayed_forward(delay_scheduler, delayed_forwards, inter_packet_delay, schedule_forward)
+        else:
+            schedule_forward()
+
+def start_transaction(transactions_in_flight, *transaction_args):
+    """Start forwarding one request as task of its own"""
+    transaction = asyncio.create_task(forward_transaction_async(*transaction_args))
+    transactions_in_flight.add(transaction)
+    transaction.add_done_callback(transactions_in_flight.discard)
+
+async def forward_to_server_async(request, upstream_pool, in_flight_reads, shared_read):
+    """Forward one request over the upstream connection pool, or wait for the identical outstanding read of another
+        client. Returns the response from server normalised for client"""
+    if shared_read is None and request.function_code == 3:
+        # Identical reads arriving until the response of this read can join it
+        shared_read = in_flight_reads.start(InFlightReadTable.read_key(request), upstream_pool.request(request))
+    if shared_read is not None:
+        shared_response = await asyncio.shield(shared_read)
+        # The shared response carries the transaction id of the client which forwarded the read
+        return shared_response.with_transaction_id(request.transaction_id)
+    return await upstream_pool.request(request)
+
+async def read_missing_ranges_async(request, missing_ranges, upstream_pool, in_flight_reads, proxy_cache,
+                                    cache_generation):
+    """
+    Read the registers of a partial cache hit, which are missing in cache, from server and build the response of the
+    whole read from cache. Reads of the same missing registers by other clients are coalesced.
+
+    :returns: response for client or None if the server rejected one of the reads
+    """
+    logging.info(f"Partial cache hit, missing registers {missing_ranges} are read from server")
+    sub_reads = []
+    for start_address, quantity_to_read in missing_ranges:
+        sub_request = ModbusFrame.build(request.transaction_id,
+                                        request.protocol_id,
+                                        request.unit_id,
+                                        REQUEST_PDU.pack(3, start_address, quantity_to_read))
+        key = InFlightReadTable.read_key(sub_request)
+        sub_read = in_flight_reads.join(key)
+        if sub_read is None:
+            sub_read = in_flight_reads.start(key, upstream_pool.request(sub_request))
+        sub_reads.append((sub_request, sub_read))
+    for sub_request, sub_read in sub_reads:
+        sub_response = await asyncio.shield(sub_read)
+        if sub_response.function_code != 3:
+            return None
+        proxy_cache.store_read_response(sub_request, sub_response, cache_generation)
+    # None if a register was rewritten in the meantime
+    return proxy_cache.check_if_value_in_cache(request, False)
+
+async def forward_transaction_async(request, receive_request_time, record, client_writer, upstream_pool,
+                                    in_flight_reads, shared_read, missing_ranges, pending_slots, proxy_cache,
+                                    cache_generation):
+    """Forward one request over the upstream connection pool and the response back to client. The protocol
+        normalisation of the transaction id is done by the pool connection carrying the request. A read holding
+        registers request can be answered by an identical read of another client, which is already outstanding, or
+        on a partial cache hit from cache after the missing registers are read."""
+    response_from_cache = None
+    try:
+        if missing_ranges is not None:
+            response_from_cache = await read_missing_ranges_async(request,
+                                                                  missing_ranges,
+                                                                  upstream_pool,
+                                                                  in_flight_reads,
+                                                                  proxy_cache,
+                                                                  cache_generation)
+        if response_from_cache is None:
+            modbus_server_response = await forward_to_server_async(request,
+                                                                   upstream_pool,
+                                                                   in_flight_reads,
+                                                                   shared_read)
+    except (asyncio.TimeoutError, ConnectionError) as e:
+        # Answer with modbus exception 0x0B if the server did not respond, 0x0A if it is not reachable at all
+        exception_code = (EXP_GATEWAY_TARGET_FAILED if isinstance(e, asyncio.TimeoutError)
+                          else EXP_GATEWAY_PATH_UNAVAILABLE)
+        logging.warning(f"Request with transaction id {request.transaction_id} failed at modbus-server: {e!r}")
+        exception_response = ProtocolNormalisation.build_exception_response(request, exception_code)
+        client_writer.write(exception_response.raw)
+        await client_writer.drain()
+        response_logging(record, exception_response)
+        calculate_and_log_rtt(record,
+                              "proxy-server",
+                              time.time(),
+                              receive_request_time,
+                              request,
+                              exception_response)
+        return
+    finally:
+        pending_slots.release()
+
+    if response_from_cache is not None:
+        client_writer.write(response_from_cache.raw)
+        await client_writer.drain()
+        response_logging(record, response_from_cache)
+        calculate_and_log_rtt(record,
+                              "cache",
+                              time.time(),
+                              receive_request_time,
+                              request,
+                              response_from_cache)
+        return
+
+    response_logging(record, modbus_server_response)
+
+    function_code = modbus_server_response.function_code
+    if function_code == 3:
+        proxy_cache.store_read_response(request, modbus_server_response, cache_generation)
+    elif function_code in (6, 16):
+        proxy_cache.store_write_response(request, modbus_server_response, cache_generation)
+    elif function_code == 23:
+        # The registers are written before they are read by the modbus server. The read values are stored first,
+        # the confirmed write then invalidates or stores the registers it wrote.
+        proxy_cache.store_read_response(request, modbus_server_response, cache_generation)
+        proxy_cache.store_write_response(request, modbus_server_response, cache_generation)
+
+    # Forward response from server to client
+    client_writer.write(modbus_server_response.raw)
+    await client_writer.drain()
+    # Time when the Modbus/TCP response is received
+    forward_response_time = time.time()
+    calculate_and_log_rtt(record,
+                          "modbus-server",
+                          forward_response_time,
+                          receive_request_time,
+                          request,
+                          modbus_server_response)
+
+async def handle_client_async(client_reader, client_writer, upstream_pool, in_flight_reads, proxy_cache,
+                              refresh_ahead, throttling_scheduler, delay_scheduler, t1_scheduler, t1_delay_time):
+    """Coroutine version of `handle_client`. The same mechanisms (caching, network throttling, protocol normalisation
+        and steganography) are applied, but waiting for a socket or for a delay only suspends this session and lets
+        the event loop serve the other sessions in the meantime. Each forwarded request is a transaction of its own
+        on the upstream connection pool, so that several requests of the client can be outstanding at once."""
+    client_id = client_writer.get_extra_info('peername')
+    pending_slots = asyncio.Semaphore(MAX_PENDING_TRANSACTIONS)
+    transactions_in_flight = set()
+    delayed_forwards = set()
+    steg_t1 = apply_inter_packet_times(t1_scheduler, t1_delay_time)
+    try:
+        await forward_requests_async(client_reader, client_writer, client_id, upstream_pool, in_flight_reads,
+                                     pending_slots, proxy_cache, refresh_ahead, throttling_scheduler, delay_scheduler,
+                                     transactions_in_flight, delayed_forwards, steg_t1)
+    except asyncio.IncompleteReadError:
+        logging.info("Connection closed by peer")
+    except Exception as e:
+        logging.error(f"Error: {e} \n...Connection will be terminated\n")
+    finally:
+        throttling_scheduler.remove_client(client_id)
+        if steg_t1 is not None:
+            steg_t1.close()
+        for handle in delayed_forwards:
+            handle.cancel()
+        delayed_forwards.clear()
+        for transaction in list(transactions_in_flight):
+            transaction.cancel()
+        proxy_cache.log_metrics()
+        await close_client_connection_async(client_writer)
+
+async def start_proxy_async(host='localhost', port=502, server_address=('localhost', 502)):
+    """Start the proxy server with the asyncio engine. All client connections are served by one event loop in one
+        thread, so that thousands of concurrent Modbus/TCP sessions can be held without one OS thread per session.
+        The requests of all sessions are forwarded over a small pool of long-lived connections to the modbus server."""
+    # The throttling policy measures the latency of the modbus server on the pool connections
+    throttling_policy = apply_throttling_policy()
+    # The size modulation message is striped over the pool connections, which carry the requests of all sessions,
+    # the inter-packet-times message over the client sessions
+    s1_scheduler, s1_bits_per_packet = create_size_modulation_scheduler()
+    t1_scheduler, t1_delay_time = create_inter_packet_times_scheduler()
+    upstream_pool = UpstreamConnectionPool(server_address,
+                                           response_observer=throttling_policy.record_response,
+                                           size_modulation=functools.partial(apply_size_modulation,
+                                                                             s1_scheduler,
+                                                                             s1_bits_per_packet))
+    await upstream_pool.start()
+    # Outstanding reads and cache shared by all client sessions
+    in_flight_reads = InFlightReadTable()
+    proxy_cache = create_proxy_cache()
+    refresh_ahead = apply_refresh_ahead(proxy_cache, upstream_pool, in_flight_reads)
+    throttling_scheduler = ThrottlingScheduler(throttling_policy)
+    # Requests delayed to encode a bit with inter-packet-times wait in a timing wheel on a timer thread
+    delay_scheduler = DelayScheduler()
+    delay_scheduler.start()
+
+    async def on_client_connected(client_reader, client_writer):
+        logging.info(f"Connection from client {client_writer.get_extra_info('peername')}")
+        await handle_client_async(client_reader, client_writer, upstream_pool, in_flight_reads, proxy_cache,
+                                  refresh_ahead, throttling_scheduler, delay_scheduler, t1_scheduler,
+                                  t1_delay_time)
+
+    proxy_server = await asyncio.start_server(on_client_connected, host, port, backlog=ASYNC_BACKLOG)
+    logging.info(f"Asyncio proxy server running on {host}:{port}, forwarding to server at {server_address}")
+    try:
+        async with proxy_server:
+            await proxy_server.serve_forever()
+    finally:
+        upstream_pool.log_metrics()
+        proxy_cache.log_metrics()
+        delay_scheduler.log_metrics()
+        delay_scheduler.close()
+        if refresh_ahead is not None:
+            await refresh_ahead.close()
+        await upstream_pool.close()
+
+def run_proxy_async(host='localhost', port=502, server_address=('localhost', 502)):
+    """Run the asyncio engine until the proxy server is interrupted"""
+    try:
+        asyncio.run(start_proxy_async(host, port, server_address))
+    except KeyboardInterrupt:
+        logging.info("Proxy server shutting down.")
+
+
 # the environment variables will be set in docker-compose file
 modbus_server_name = os.getenv('MODBUS_SERVER_NAME', 'localhost')
 proxy_server_name = os.getenv('PROXY_SERVER_NAME', 'localhost')
+proxy_engine = os.getenv('PROXY_ENGINE', PROXY_ENGINE_THREADING)
 
-# Start the proxy server
-start_proxy(host=proxy_server_name, port=PROXY_SERVER_PORT, server_address=(modbus_server_name, 502))
+# Start the proxy server with the selected engine
+if proxy_engine == PROXY_ENGINE_ASYNCIO:
+    run_proxy_async(host=proxy_server_name, port=PROXY_SERVER_PORT, server_address=(modbus_server_name, 502))
+else:
+    start_proxy(host=proxy_server_name, port=PROXY_SERVER_PORT, server_address=(modbus_server_name, 502))
@@ -1,46 +1,70 @@
 import logging
 import sys
 import time
+from TransactionLogging import log_enabled, STEGANOGRAPHY
+from constants import T1_DELAY_TIME
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
                     handlers=[logging.StreamHandler(sys.stdout)])
 
 class T1InterPacketTimes:
     """This class represent steganography method inter-packet-time. It tries to hide a sequence of bits (e.g: 100101) in
-        the modbus communication. Each bit will represent by a small delay of 250ms of modbus/TCP Paket"""
+        the modbus communication. Each bit will represent by a small delay of modbus/TCP Paket (250ms by default)
 
-    def __init__(self, modbus_message=''):
-        self._embedded_message = self.convert_steganography_message_to_bits(modbus_message)
-        self._counter = 0
+        One object embeds the bits of one client session. The bits are taken from the chunks, which the proxy-wide
+        CovertChunkScheduler stripes over all sessions."""
 
-    @property
-    def embedded_message(self):
-        return self._embedded_message
+    def __init__(self, cursor, delay_time=T1_DELAY_TIME):
+        self._cursor = cursor
+        self.delay_time = delay_time
 
     def apply_delay(self, function_code):
         """
-        this function apply a small delay of 250ms on a Modbus/TCP packet. To encode bit 0, write single holding
-        register Request (function code 6) will be delay for 250ms. To encode bit 1, read single holding register
-        (function code 3) Request will be delay for 250ms.
+        this function apply a small delay of `delay_time` (250ms by default) on a Modbus/TCP packet. To encode bit 0,
+        write single holding register Request (function code 6) will be delayed. To encode bit 1, read single holding
+        register (function code 3) Request will be delayed.
 
-        The _counter determines, which bit of the hidden message is currently encoded
+        :param function_code: function_code of current modbus/TCP packet
+
+        :returns: True if the packet was delayed, otherwise False
+        """
+        if self.check_delay(function_code):
+            time.sleep(self.delay_time)
+            return True
+        return False
+
+    def check_delay(self, function_code):
+        """
+        Decide if the current packet has to be delayed to encode the current bit of the hidden message, without
+        delaying it. The caller is responsible for applying the delay of `delay_time` seconds, e.g. with the
+        DelayScheduler in the asyncio proxy engine.
+
+        The cursor determines, which bit of the hidden message is currently encoded
 
         :param function_code: function_code of current modbus/TCP packet
 
+        :returns: True if the packet has to be delayed, otherwise False
         """
-        bit = self._embedded_message[self._counter]
-        delay_mapping = {'0': 6, '1': 3}
+        # A bit is only embedded in a packet with matching function code, the session does not embed idle bits
+        bit = self._cursor.peek_bits(1, idle=False)
+        if bit is None:
+            return False
+        delay_mapping = {0: 6, 1: 3}
 
         if function_code == delay_mapping.get(bit):
-            logging.info(f"Delaying 0.25ms for bit {bit}")
-            time.sleep(0.25)
-            self._counter += 1
+            if log_enabled(STEGANOGRAPHY):
+                logging.info(f"Delaying {self.delay_time}s for bit {bit}")
+            self._cursor.advance(1)
             return True
         else:
-            logging.warning(
-                f"No delay for bit {self._embedded_message[self._counter]} and function code {function_code}")
+            if log_enabled(STEGANOGRAPHY):
+                logging.warning(f"No delay for bit {bit} and function code {function_code}")
             return False
 
+    def close(self):
+        """The session is closed, chunks which are not sent completely are sent by another session"""
+        self._cursor.close()
+
     @staticmethod
     def convert_steganography_message_to_bits(steganography_message):
         """The steganography message will be converted in a sequence of bits. Each Character of the message (
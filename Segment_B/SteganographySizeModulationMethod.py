@@ -1,89 +1,84 @@
-import struct
 import logging
 import sys
-from constants import DUMMY_EMBEDDED_BYTE
+from ModbusFrame import PDU_DATA_OFFSET
+from TransactionLogging import log_enabled, STEGANOGRAPHY
+from constants import DUMMY_EMBEDDED_BYTE, S1_BITS_PER_PACKET, S1_FUNCTION_CODES
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
                     handlers=[logging.StreamHandler(sys.stdout)])
 
-def add_one_byte_response(mbap_header_tuple, function_code, pdu_body_raw):
-    """Scenario: response is received at the proxy server and is added 1 byte at the end of the message"""
-
-    (transaction_id, protocol_id, length, unit_id) = mbap_header_tuple
-
-    new_mbap_header = struct.pack('>HHHB', transaction_id, protocol_id, length + 1, unit_id)
-
-    if function_code == 3:
-        (function_code, byte_count, value) = struct.unpack('>BBH', pdu_body_raw)
-
-        new_pdu_body = struct.pack('>BBH', function_code, byte_count + 1, value)
-        return new_mbap_header + new_pdu_body + struct.pack('B', 3)
+DUMMY_EMBEDDED_BYTES = bytes([DUMMY_EMBEDDED_BYTE])
 
-    return new_mbap_header + pdu_body_raw + struct.pack('B', 3)
-
-def add_one_byte_request(mbap_header_tuple, function_code, pdu_body_raw):
-    """Scenario: request from client is received at the proxy server and is added 1 byte at the end of the message"""
-    (transaction_id, protocol_id, length, unit_id) = mbap_header_tuple
-
-    if function_code == 3 or function_code == 6:
-        new_mbap_header = struct.pack('>HHHB', transaction_id, protocol_id, length + 1, unit_id)
+def add_one_byte_response(response):
+    """Scenario: response is received at the proxy server and is added 1 byte at the end of the message"""
+    extended_response = response.extended(b'\x03')
+    if response.function_code == 3 or response.function_code == 23:
+        # The byte count of a read response covers the added byte
+        extended_response.raw[PDU_DATA_OFFSET] += 1
+    return extended_response
 
-        return new_mbap_header + pdu_body_raw + struct.pack('B', DUMMY_EMBEDDED_BYTE)
+def add_dummy_bytes_request(request, num_bytes=1):
+    """Scenario: request from client is received at the proxy server and is added `num_bytes` dummy bytes at the end
+        of the message"""
+    if request.function_code in S1_FUNCTION_CODES:
+        return request.extended(DUMMY_EMBEDDED_BYTES * num_bytes)
+    return request
 
 
 class S1SizeModulation:
     """This class represent steganography size modulation. It tries to hide a sequence of bits (e.g: 100101) in the
-    modbus communication. Each bit will represent by the length(even or odd) of pdu payload of one modbus/TCP Paket"""
+    modbus communication. The bits are split into symbols of `bits_per_packet` bits, each symbol is represented by
+    the length of one modbus/TCP Paket modulo 2^bits_per_packet. With 1 bit per packet, an odd length represents 1
+    and an even length represents 0.
 
-    def __init__(self):
-        self._counter = 0
-        self._embedded_message = ''
+    One object embeds the bits of one connection to the modbus server. The bits are taken from the chunks, which the
+    proxy-wide CovertChunkScheduler stripes over all connections."""
 
-    def increment_after(func):
-        """
-        Decorator to increment the counter after executing the method.
-        """
+    def __init__(self, cursor, bits_per_packet=S1_BITS_PER_PACKET):
+        self._cursor = cursor
+        self.bits_per_packet = bits_per_packet
 
-        def wrapper(self, *args, **kwargs):
-            result = func(self, *args, **kwargs)  # Call the method
-            self._counter += 1  # Increment the counter after the method call
-            return result
-
-        return wrapper
-
-    @increment_after
     def s1_size_modulation(self, modbus_message, request):
         """
-        This function modifies field length in MBAP header of modbus/TCP package. An odd length will
-        represent an 1 and an even length will represent an 0. The pdu payload will also be adapted to match new
-        length.
+        This function modifies field length in MBAP header of modbus/TCP package, so that the length modulo
+        2^bits_per_packet is the current symbol of the hidden message. Between 0 and 2^bits_per_packet-1 dummy bytes
+        are added to the pdu payload to match the new length.
 
-        :param modbus_message: the modbus/TCP packet to encoded bit of hidden message
+        :param modbus_message: ModbusFrame of the modbus/TCP packet to encoded symbol of hidden message
         :param request: determine, if this modbus/TCP packet is a request from client
 
-        :returns: modbus/TCP packet after modification
+        :returns: ModbusFrame of the modbus/TCP packet after modification
         """
-        mbap_header = modbus_message[:7]
-        pdu_body = modbus_message[7:]
-
-        # header contains (transaction_id, protocol_id, length, unit_id)
-        mbap_header_tuple = struct.unpack('>HHHB', mbap_header)
-
-        function_code = struct.unpack('B', pdu_body[:1])[0]
-
-        current_bit = self._embedded_message[self._counter]
+        # Only requests, to which dummy bytes can be added, carry bits. The payload of the bulk function codes
+        # (FC16, FC23) is checked against its byte count by the modbus server.
+        if not request or modbus_message.function_code not in S1_FUNCTION_CODES:
+            return modbus_message
+        symbol = self._cursor.peek_bits(self.bits_per_packet)
+        # All chunks of the hidden message are sent
+        if symbol is None:
+            return modbus_message
+        self._cursor.advance(self.bits_per_packet)
+        num_dummy_bytes = (symbol - modbus_message.length) % (1 << self.bits_per_packet)
 
-        # If the length matches the representation of current bit in embedded message, do nothing
-        if int(current_bit) == mbap_header_tuple[2] % 2 or not request:
-            logging.info(f"current bit {current_bit}, payload length {mbap_header_tuple[2]}")
+        # If the length matches the representation of current symbol in embedded message, do nothing
+        if num_dummy_bytes == 0:
+            if log_enabled(STEGANOGRAPHY):
+                logging.info(f"current symbol {symbol:0{self.bits_per_packet}b}, payload length {modbus_message.length}")
             return modbus_message
         else:
             # E.g: If the length is odd but current bit is 0 and need to be represented by even length, one dummy
-            # byte will be added to payload and the length will be increased by 1 and vice versa
-            logging.info(f"current bit {current_bit}, payload length {mbap_header_tuple[2]}, 1 byte will be added")
-            return add_one_byte_request(mbap_header_tuple, function_code, pdu_body)
-
-    def convert_steganography_message_to_bits(self, steganography_message):
+            # byte will be added to payload and the length will be increased by 1
+            if log_enabled(STEGANOGRAPHY):
+                logging.info(f"current symbol {symbol:0{self.bits_per_packet}b}, payload length {modbus_message.length}, {num_dummy_bytes} "
+                             f"byte(s) will be added")
+            return add_dummy_bytes_request(modbus_message, num_dummy_bytes)
+
+    def close(self):
+        """The connection is closed, chunks which are not sent completely are sent by another connection"""
+        self._cursor.close()
+
+    @staticmethod
+    def convert_steganography_message_to_bits(steganography_message):
         """The steganography message will be converted in a sequence of bits. Each Character of the message (
         including space character) will be converted in it corresponding number in ASCII table. After that this
         number will be represented by a sequence of 7 bits. The first 10 bits in the sequence represent the number of
@@ -97,9 +92,5 @@ class S1SizeModulation:
         logging.info(f"length binary {length_binary}")
         # Convert each character in the text to its ASCII value and then to binary
         binary_representation = ''.join(format(ord(char), '07b') for char in steganography_message)
-        self._embedded_message = length_binary + binary_representation
         logging.info(f"embedded message (without header) {binary_representation}")
-
-    @property
-    def embedded_message(self):
-        return self._embedded_message
+        return length_binary + binary_representation
@@ -0,0 +1,104 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+# This module is used by all segments (modbus-client, proxy-server and modbus-server). Each segment is built as a
+# docker image of its own, so every segment directory holds an identical copy of it.
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Categories of log lines, which can be sampled with the environment variable LOG_SAMPLE_RATES,
+# e.g. LOG_SAMPLE_RATES="transaction=0.1,cache=0" writes every tenth transaction record and no cache log line
+TRANSACTION = 'transaction'  # one record per modbus/TCP transaction
+CACHE = 'cache'  # caching and request coalescing in proxy server
+STEGANOGRAPHY = 'steganography'  # embedding and reading of hidden messages
+NORMALISATION = 'normalisation'  # protocol normalisation in proxy server
+THROTTLING = 'throttling'  # requests delayed by network throttling in proxy server
+
+_listener = None
+_sample_rates = {}
+
+
+def parse_sample_rates(sample_rates):
+    """
+    Parse sample rates of log categories.
+
+    :param sample_rates: comma separated list of category=rate, rate between 0 (nothing) and 1 (every line)
+    :returns: dictionary category -> rate
+    """
+    rates = {}
+    for entry in sample_rates.split(','):
+        if '=' in entry:
+            category, rate = entry.split('=', 1)
+            rates[category.strip()] = min(1.0, max(0.0, float(rate)))
+    return rates
+
+
+def setup_logging(level=logging.INFO):
+    """Route all log records of the process through a queue. Formatting and writing the records to stdout is done by a
+        background thread, so that a packet does not wait for the I/O of its log lines. Calling it again has no
+        effect."""
+    global _listener, _sample_rates
+    if _listener is not None:
+        return
+    _sample_rates = parse_sample_rates(os.getenv('LOG_SAMPLE_RATES', ''))
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    # The queue handler only passes the message on, the time stamp is added from the record by the listener
+    logging.basicConfig(level=level, format='%(message)s', handlers=[logging.handlers.QueueHandler(log_queue)],
+                        force=True)
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _listener.start()
+    # Write the remaining records before the process exits
+    atexit.register(_listener.stop)
+
+
+def log_enabled(category):
+    """Decide whether a log line of the category is written. Callers check it before building the line, so that a
+        disabled or not sampled line costs nothing."""
+    rate = _sample_rates.get(category, 1.0)
+    if rate < 1.0 and (rate == 0.0 or random.random() >= rate):
+        return False
+    return logging.root.isEnabledFor(logging.INFO)
+
+
+def start_transaction():
+    """
+    Start the record of a modbus/TCP transaction.
+
+    :returns: TransactionRecord or None if the transaction is not logged
+    """
+    return TransactionRecord() if log_enabled(TRANSACTION) else None
+
+
+class TransactionRecord:
+    """All fields of one transaction (request header and payload, response header and payload, round-trip-time),
+        which are written as one log line instead of one line per field. The fields keep the format `Request_TID: 5`
+        of the former log lines, the round-trip-time is always the last field of the line."""
+    __slots__ = ('_fields', '_round_trip_time')
+
+    def __init__(self):
+        self._fields = []
+        self._round_trip_time = None
+
+    def header(self, packet_type, transaction_id, protocol_id, length, unit_id):
+        """Add the MBAP header of a request or response"""
+        self._fields.append(f"{packet_type}_TID: {transaction_id}, {packet_type}_PID: {protocol_id}, "
+                            f"{packet_type}_LF: {length}, {packet_type}_UID: {unit_id}")
+
+    def field(self, name, value):
+        self._fields.append(f"{name}: {value}")
+
+    def round_trip_time(self, label, round_trip_time):
+        self._round_trip_time = f"{label}: {round_trip_time:.9f}"
+
+    def emit(self):
+        """Write the record as one log line"""
+        if self._round_trip_time is not None:
+            self._fields.append(self._round_trip_time)
+        logging.info(", ".join(self._fields))
@@ -0,0 +1,252 @@
+import asyncio
+import socket
+import struct
+import time
+import logging
+import sys
+
+from FrameReassembly import read_modbus_frame
+from ModbusFrame import ModbusFrame
+from ProtocolNormalisation import ProtocolNormalisation, TransactionTable
+from constants import (UPSTREAM_POOL_SIZE, UPSTREAM_MAX_IN_FLIGHT, POOL_HEALTH_CHECK_INTERVAL, POOL_METRICS_INTERVAL,
+                       TRANSACTION_TIMEOUT)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                    handlers=[logging.StreamHandler(sys.stdout)])
+
+
+class PoolMetrics:
+    """Counters of the upstream connection pool. The wait time is the time a request waits for a free slot on one
+        of the pool connections, the utilisation is the share of slots which are in use."""
+
+    def __init__(self):
+        self.requests = 0
+        self.timeouts = 0
+        self.reconnects = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def record_wait(self, wait_time):
+        self.requests += 1
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    @property
+    def mean_wait_time(self):
+        return self.total_wait_time / self.requests if self.requests else 0.0
+
+
+class UpstreamConnection:
+    """One long-lived connection from proxy server to modbus server. Requests of all client sessions are multiplexed
+        over it. Each request gets an upstream transaction id from the transaction table of this connection, so that
+        the responses can be demultiplexed to the waiting requests by their transaction id. Size modulation is applied
+        per connection, because the modbus server reads the hidden bits from the requests of one connection in the
+        order they are written."""
+
+    def __init__(self, server_address, index, size_modulation=None):
+        self._server_address = server_address
+        self._index = index
+        # Creates the S1SizeModulation of each new connection, None if size modulation is not applied
+        self._size_modulation = size_modulation
+        self._steg_s1 = None
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._transaction_table = TransactionTable()
+        # Serialises reconnects, so that concurrent requests do not close a connection another one just opened
+        self.reconnect_lock = asyncio.Lock()
+
+    @property
+    def is_healthy(self):
+        return (self._writer is not None and not self._writer.is_closing()
+                and self._read_task is not None and not self._read_task.done())
+
+    @property
+    def outstanding(self):
+        return len(self._transaction_table)
+
+    async def connect(self):
+        """Open the connection to the modbus server and start reading responses from it"""
+        self._reader, self._writer = await asyncio.open_connection(*self._server_address)
+        # Let TCP detect a modbus server which disappeared without closing the connection
+        self._writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self._read_task = asyncio.create_task(self._read_responses())
+        if self._size_modulation is not None:
+            self._steg_s1 = self._size_modulation()
+        logging.info(f"Upstream connection {self._index} to {self._server_address} is open")
+
+    def send(self, request):
+        """
+        Forward a request to the modbus server.
+
+        :param request: ModbusFrame of the request from client
+
+        :returns: future, which will be set to the ModbusFrame of the response normalised for client
+        """
+        future = asyncio.get_running_loop().create_future()
+        if self._steg_s1 is not None:
+            # embed steganography in request
+            request = self._steg_s1.s1_size_modulation(request, True)
+        normalised_request, _ = ProtocolNormalisation.normalise_request(request, self._transaction_table, future)
+        self._writer.write(normalised_request)
+        return future
+
+    async def _read_responses(self):
+        """Read responses from modbus server and hand each one to the request waiting for it"""
+        try:
+            while True:
+                modbus_server_response = ModbusFrame(await read_modbus_frame(self._reader))
+                transaction = ProtocolNormalisation.normalise_response(modbus_server_response,
+                                                                       self._transaction_table)
+                # The transaction is None, if the request is already expired
+                if transaction is not None and not transaction.context.done():
+                    transaction.context.set_result(modbus_server_response)
+        except (asyncio.IncompleteReadError, ConnectionError, OSError, ValueError, IndexError, struct.error) as e:
+            logging.error(f"Upstream connection {self._index} is lost: {e}")
+        finally:
+            self._fail_outstanding(ConnectionError(f"Upstream connection {self._index} is lost"))
+            self._release_size_modulation()
+            self._writer.close()
+
+    def expire(self):
+        """Fail the requests which did not get their response within TRANSACTION_TIMEOUT seconds"""
+        expired = self._transaction_table.expire()
+        for transaction in expired:
+            if not transaction.context.done():
+                transaction.context.set_exception(asyncio.TimeoutError())
+        return len(expired)
+
+    def _fail_outstanding(self, error):
+        for transaction in self._transaction_table.pop_all():
+            if not transaction.context.done():
+                transaction.context.set_exception(error)
+
+    def _release_size_modulation(self):
+        """Chunks of the hidden message, which are not sent completely on this connection, are sent by another one"""
+        if self._steg_s1 is not None:
+            self._steg_s1.close()
+            self._steg_s1 = None
+
+    async def close(self):
+        self._release_size_modulation()
+        if self._read_task is not None:
+            self._read_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+
+class UpstreamConnectionPool:
+    """This class holds a bounded number of long-lived connections to the modbus server, which are shared by all
+        client sessions of the asyncio proxy engine. N clients therefore do not open N sessions on the PLC. A request
+        waits if all slots of the pool are in use. A health check reconnects lost connections and expires requests
+        without response. The latency of each request and the number of outstanding requests are reported to the
+        optional `response_observer`, e.g. an adaptive throttling policy. The optional `size_modulation` creates the
+        size modulation of each pool connection."""
+
+    def __init__(self, server_address, size=UPSTREAM_POOL_SIZE, max_in_flight=UPSTREAM_MAX_IN_FLIGHT,
+                 response_observer=None, size_modulation=None):
+        self._server_address = server_address
+        self._response_observer = response_observer
+        self._connections = [UpstreamConnection(server_address, index, size_modulation) for index in range(size)]
+        self._capacity = size * max_in_flight
+        self._slots = asyncio.Semaphore(self._capacity)
+        self._maintenance_task = None
+        self.metrics = PoolMetrics()
+
+    @property
+    def in_flight(self):
+        return sum(connection.outstanding for connection in self._connections)
+
+    @property
+    def utilisation(self):
+        return self.in_flight / self._capacity
+
+    async def start(self):
+        """Open all pool connections and start the health check"""
+        for connection in self._connections:
+            await self._reconnect(connection)
+        self._maintenance_task = asyncio.create_task(self._maintain())
+
+    async def close(self):
+        if self._maintenance_task is not None:
+            self._maintenance_task.cancel()
+        for connection in self._connections:
+            await connection.close()
+
+    async def request(self, request):
+        """
+        Forward a request over the least used healthy pool connection and wait for its response.
+
+        :param request: ModbusFrame of the request from client
+
+        :returns: ModbusFrame of the response from server, normalised for client
+        :raises asyncio.TimeoutError: if no response arrives within TRANSACTION_TIMEOUT seconds
+        :raises ConnectionError: if no connection to the modbus server is available
+        """
+        wait_start = time.monotonic()
+        async with self._slots:
+            connection = await self._select_connection()
+            send_time = time.monotonic()
+            self.metrics.record_wait(send_time - wait_start)
+            try:
+                return await connection.send(request)
+            finally:
+                if self._response_observer is not None:
+                    self._response_observer(time.monotonic() - send_time, self.in_flight)
+
+    async def _select_connection(self):
+        healthy_connections = [connection for connection in self._connections if connection.is_healthy]
+        if healthy_connections:
+            return min(healthy_connections, key=lambda connection: connection.outstanding)
+        # All connections are lost, try to reconnect one of them before giving up
+        connection = self._connections[0]
+        if await self._reconnect(connection):
+            return connection
+        raise ConnectionError(f"No connection to modbus server {self._server_address} available")
+
+    async def _reconnect(self, connection):
+        """
+        Reconnect a lost connection. Requests and the health check, which find the same connection lost, wait for
+        the reconnect in progress instead of starting one of their own.
+
+        :returns: True if the connection is healthy afterwards
+        """
+        if connection.reconnect_lock.locked():
+            # Share the result of the reconnect in progress, a lost server is not hit by one attempt per waiter
+            async with connection.reconnect_lock:
+                return connection.is_healthy
+        async with connection.reconnect_lock:
+            if connection.is_healthy:
+                return True
+            try:
+                await connection.close()
+                await connection.connect()
+                return True
+            except OSError as e:
+                logging.error(f"Error: {e} while connecting to {self._server_address}")
+                return False
+
+    async def _maintain(self):
+        """Health check of the pool: expire requests without response, reconnect lost connections and log metrics"""
+        last_metrics_log = time.monotonic()
+        while True:
+            await asyncio.sleep(min(POOL_HEALTH_CHECK_INTERVAL, TRANSACTION_TIMEOUT / 2))
+            for connection in self._connections:
+                self.metrics.timeouts += connection.expire()
+                if not connection.is_healthy and await self._reconnect(connection):
+                    self.metrics.reconnects += 1
+            if time.monotonic() - last_metrics_log >= POOL_METRICS_INTERVAL:
+                last_metrics_log = time.monotonic()
+                self.log_metrics()
+
+    def log_metrics(self):
+        healthy = sum(1 for connection in self._connections if connection.is_healthy)
+        logging.info(f"Upstream pool: {healthy}/{len(self._connections)} connections healthy, "
+                     f"{self.in_flight}/{self._capacity} requests in flight (utilisation {self.utilisation:.1%}), "
+                     f"requests: {self.metrics.requests}, mean wait: {self.metrics.mean_wait_time:.6f}s, "
+                     f"max wait: {self.metrics.max_wait_time:.6f}s, timeouts: {self.metrics.timeouts}, "
+                     f"reconnects: {self.metrics.reconnects}")
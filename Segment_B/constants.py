@@ -6,9 +6,53 @@ S1_STEG_MESS = "this steganography message will be embedded with S1 method"
 T1_STEG_MESS = "this steganography message will be embedded with T1 method"
 NUM_BITS_CHARACTER = 7  # each character in hidden message is represented by 7 bits (number in ASCII table)
 NUM_BITS_HEADER = 10  # 10 first bits in embedded message represents number of bits following (max 1023 bits)
+S1_BITS_PER_PACKET = 1  # hidden bits encoded in the length of one request with size modulation (1 = parity)
+S1_MAX_BITS_PER_PACKET = 7  # at most 2^7-1 dummy bytes are added to one request with size modulation
+S1_FUNCTION_CODES = (3, 6)  # requests carrying hidden bits with size modulation, must match the modbus server
 CACHE_TTL = 30  # Time-to-live of a cached value in the cache
 DELAY_INTERVAL = 30  # Time in seconds after which delay should be introduced
 DELAY_DURATION = 10  # Time in seconds indicates how long the throttling of the network should take place
 THROTTLING_TIME = 0.07  # Time to delay of a packet in second with network throttling mechanism in proxy-server
 DUMMY_EMBEDDED_BYTE = 0
 PROXY_SERVER_PORT = 502
+T1_DELAY_TIME = 0.25  # Time in seconds a packet is delayed to encode one bit with inter-packet-times method
+PROXY_ENGINE_THREADING = 'threading'  # One OS thread per client connection with blocking sockets
+PROXY_ENGINE_ASYNCIO = 'asyncio'  # All client connections are served as coroutines on one event loop
+ASYNC_BACKLOG = 4096  # Number of pending connections the asyncio proxy engine accepts at once
+RECV_BUFFER_SIZE = 4096  # Size of the preallocated receive buffer per socket, fits several modbus/TCP frames
+MBAP_HEADER_SIZE = 7  # Size of the MBAP header of a modbus/TCP frame in bytes
+TRANSACTION_TIMEOUT = 5  # Time in seconds a forwarded request waits for its response before it is expired
+MAX_PENDING_TRANSACTIONS = 16  # Maximum number of requests per client connection waiting for a response at once
+EXP_GATEWAY_TARGET_FAILED = 0x0B  # Modbus exception code: gateway target device failed to respond
+EXP_GATEWAY_PATH_UNAVAILABLE = 0x0A  # Modbus exception code: gateway path unavailable
+EXP_ILLEGAL_DATA_VALUE = 0x03  # Modbus exception code: illegal data value, e.g. a truncated request
+UPSTREAM_POOL_SIZE = 2  # Number of long-lived connections from proxy server to modbus server (asyncio engine)
+UPSTREAM_MAX_IN_FLIGHT = 32  # Maximum number of outstanding requests on one upstream connection
+POOL_HEALTH_CHECK_INTERVAL = 1  # Time in seconds between health checks (reconnect, expire transactions) of the pool
+POOL_METRICS_INTERVAL = 30  # Time in seconds between two log outputs of the pool metrics
+NUM_REGISTERS = 65536  # Number of holding register addresses of one unit, the cache holds a register map of this size
+CACHE_PAGE_SIZE = 64  # Number of registers of one page of a cached register map, allocated with its first register
+MAX_REGISTERS_PER_READ = 125  # Maximum quantity of registers of one read holding registers request
+CACHE_MAX_ENTRIES = 10000  # Maximum number of registers held in the cache, least recently used registers are evicted
+CACHE_GENERATION_SLOTS = 4096  # Number of invalidation generations of cached pages, hashed by unit id and page index
+REFRESH_AHEAD_INTERVAL = 1  # Time in seconds between two rounds of the refresh-ahead poller (asyncio engine)
+REFRESH_AHEAD_MARGIN = 3  # Time in seconds before expiry of a cached hot register, from which it is re-read
+REFRESH_AHEAD_HOT_READS = 2  # Minimum decayed number of reads of a register to be refreshed ahead, halved each round
+REFRESH_AHEAD_MAX_GAP = 8  # Maximum number of not needed registers between two hot registers read in one batch
+THROTTLING_POLICY_PERIODIC = 'periodic'  # Delay each packet by THROTTLING_TIME during periodic throttling windows
+THROTTLING_POLICY_TOKEN_BUCKET = 'token_bucket'  # Delay packets exceeding the per-client or global token bucket rate
+CLIENT_RATE_LIMIT = 20  # Requests per second one client connection may send without delay (token bucket policy)
+CLIENT_BURST_SIZE = 10  # Number of requests one client connection may send at once (token bucket policy)
+GLOBAL_RATE_LIMIT = 200  # Requests per second of all client connections forwarded without delay (token bucket policy)
+GLOBAL_BURST_SIZE = 50  # Number of requests of all client connections forwarded at once (token bucket policy)
+THROTTLING_POLICY_ADAPTIVE = 'adaptive'  # Adjust the allowed request rate to the measured upstream latency (AIMD)
+ADAPTIVE_INITIAL_RATE = 100  # Requests per second allowed at start of the adaptive policy
+ADAPTIVE_MIN_RATE = 5  # Lowest request rate in requests per second the adaptive policy decreases to
+ADAPTIVE_MAX_RATE = 1000  # Highest request rate in requests per second the adaptive policy increases to
+ADAPTIVE_INCREASE_STEP = 10  # Requests per second added to the rate after a window without congestion
+ADAPTIVE_DECREASE_FACTOR = 0.5  # Factor the rate is multiplied with after a window with congestion
+ADAPTIVE_LATENCY_TARGET = 0.1  # Mean upstream latency in seconds above which the modbus server counts as congested
+ADAPTIVE_QUEUE_TARGET = 32  # Number of outstanding upstream requests above which the modbus server counts as congested
+ADAPTIVE_WINDOW = 1  # Time in seconds over which latency and queue depth are measured before the rate is adjusted
+DELAY_WHEEL_TICK = 0.005  # Width in seconds of one slot of the timing wheel delaying inter-packet-times requests
+DELAY_WHEEL_SLOTS = 256  # Number of slots of the timing wheel, one revolution covers DELAY_WHEEL_SLOTS ticks
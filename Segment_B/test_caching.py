@@ -0,0 +1,95 @@
+import struct
+import unittest
+
+from Caching import Caching
+from ModbusFrame import ModbusFrame
+from constants import NUM_REGISTERS
+
+
+def read_request(unit_id, start_address, quantity):
+    return ModbusFrame.build(1, 0, unit_id, struct.pack('>BHH', 3, start_address, quantity))
+
+
+def read_response(unit_id, values):
+    return ModbusFrame.build(1, 0, unit_id, struct.pack(f'>BB{len(values)}H', 3, len(values) * 2, *values))
+
+
+def write_multiple_request(unit_id, start_address, values):
+    return ModbusFrame.build(1, 0, unit_id, struct.pack(f'>BHHB{len(values)}H', 16, start_address, len(values),
+                                                        len(values) * 2, *values))
+
+
+class TestCacheAddressRange(unittest.TestCase):
+    """Writes running past the last register address must not break the client session"""
+
+    def setUp(self):
+        self.cache = Caching(write_through=True)
+        # Cache the last 16 registers of the address space
+        self.last_registers = list(range(16))
+        self.cache.store_read_response(read_request(1, NUM_REGISTERS - 16, 16), read_response(1, self.last_registers))
+
+    def test_write_ending_beyond_last_register_invalidates_cached_registers(self):
+        request = write_multiple_request(1, NUM_REGISTERS - 8, list(range(32)))
+        self.cache.clean_cache(request.unit_id, *request.write_range())
+        self.assertEqual(self.cache.num_cached_registers, 8)
+        self.assertIsNone(self.cache.check_if_value_in_cache(read_request(1, NUM_REGISTERS - 16, 16)))
+        self.assertIsNotNone(self.cache.check_if_value_in_cache(read_request(1, NUM_REGISTERS - 16, 8)))
+
+    def test_write_through_ending_beyond_last_register_is_not_stored(self):
+        request = write_multiple_request(1, NUM_REGISTERS - 8, list(range(32)))
+        response = ModbusFrame.build(1, 0, 1, struct.pack('>BHH', 16, NUM_REGISTERS - 8, 32))
+        self.cache.store_write_response(request, response)
+        self.assertEqual(self.cache.num_cached_registers, 16)
+        self.assertFalse(self.cache.set_cache_range(1, NUM_REGISTERS - 1, [1, 2]))
+
+
+
+class TestCacheInvalidationGeneration(unittest.TestCase):
+    """A response overtaken by a write of another session must not store the values before the write"""
+
+    def setUp(self):
+        self.cache = Caching(write_through=True)
+
+    def test_read_response_overtaken_by_write_is_not_stored(self):
+        request = read_request(1, 100, 4)
+        generation = self.cache.generation
+        self.cache.clean_cache(1, 101)
+        self.cache.store_read_response(request, read_response(1, [1, 2, 3, 4]), generation)
+        self.assertIsNone(self.cache.check_if_value_in_cache(request))
+        self.assertEqual(self.cache.num_cached_registers, 0)
+
+    def test_read_response_is_stored_outside_invalidated_pages(self):
+        request = read_request(1, 0, 100)
+        generation = self.cache.generation
+        self.cache.clean_cache(1, 10)
+        self.cache.store_read_response(request, read_response(1, list(range(100))), generation)
+        self.assertIsNone(self.cache.check_if_value_in_cache(read_request(1, 0, 64)))
+        self.assertIsNotNone(self.cache.check_if_value_in_cache(read_request(1, 64, 36)))
+
+    def test_write_confirmed_after_later_write_is_not_stored(self):
+        first_write = write_multiple_request(1, 100, [1, 2])
+        self.cache.clean_cache(1, *first_write.write_range())
+        first_generation = self.cache.generation
+        second_write = write_multiple_request(1, 100, [3, 4])
+        self.cache.clean_cache(1, *second_write.write_range())
+        second_generation = self.cache.generation
+        self.cache.store_write_response(second_write, ModbusFrame.build(1, 0, 1, struct.pack('>BHH', 16, 100, 2)),
+                                        second_generation)
+        self.cache.store_write_response(first_write, ModbusFrame.build(1, 0, 1, struct.pack('>BHH', 16, 100, 2)),
+                                        first_generation)
+        self.assertEqual(self.cache.num_cached_registers, 0)
+
+    def test_read_stored_before_write_is_confirmed_is_invalidated(self):
+        write = write_multiple_request(1, 100, [3, 4])
+        self.cache.clean_cache(1, *write.write_range())
+        write_generation = self.cache.generation
+        # A read forwarded after the write is answered by the server before the write
+        self.cache.store_read_response(read_request(1, 100, 2), read_response(1, [1, 2]), self.cache.generation)
+        self.cache.write_through = False
+        self.cache.store_write_response(write, ModbusFrame.build(1, 0, 1, struct.pack('>BHH', 16, 100, 2)),
+                                        write_generation)
+        self.assertIsNone(self.cache.check_if_value_in_cache(read_request(1, 100, 2)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import threading
+import time
+import unittest
+
+from DelayScheduler import DelayScheduler
+
+
+class TestDelaySchedulerIdle(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = DelayScheduler(tick=0.001, num_slots=256)
+        self.scheduler.start()
+
+    def tearDown(self):
+        self.scheduler.close()
+
+    def test_timer_after_long_idle_period_fires_on_time(self):
+        # The wheel was started a day ago and stayed empty since then
+        self.scheduler._start_time -= 24 * 3600
+        fired = threading.Event()
+        self.scheduler.call_later(0.01, fired.set)
+        self.assertTrue(fired.wait(1))
+        self.assertLess(self.scheduler.metrics.max_lateness, 0.005)
+
+    def test_timers_fire_in_deadline_order(self):
+        fired = []
+        done = threading.Event()
+        for delay in (0.03, 0.01, 0.02):
+            self.scheduler.call_later(delay, fired.append, delay)
+        self.scheduler.call_later(0.04, done.set)
+        self.assertTrue(done.wait(1))
+        self.assertEqual(fired, [0.01, 0.02, 0.03])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import struct
+import unittest
+
+from ModbusFrame import ModbusFrame
+
+
+class TestTruncatedRequest(unittest.TestCase):
+    """The fields of a truncated request are not unpacked"""
+
+    def test_truncated_write_multiple_registers(self):
+        request = ModbusFrame.build(1, 0, 1, b'\x10\x00')
+        self.assertTrue(request.is_truncated)
+        self.assertIsNone(request.write_range())
+        self.assertIsNone(request.address_and_quantity())
+
+    def test_read_write_multiple_registers_without_write_range(self):
+        request = ModbusFrame.build(1, 0, 1, struct.pack('>BHH', 23, 0, 2))
+        self.assertTrue(request.is_truncated)
+        self.assertIsNone(request.write_range())
+
+    def test_complete_request(self):
+        request = ModbusFrame.build(1, 0, 1, struct.pack('>BHHB2H', 16, 100, 2, 4, 1, 2))
+        self.assertFalse(request.is_truncated)
+        self.assertEqual(request.write_range(), (100, 2))
+        self.assertEqual(ModbusFrame.build(1, 0, 1, struct.pack('>BHH', 6, 7, 9)).write_range(), (7, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
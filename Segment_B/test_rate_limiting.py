@@ -0,0 +1,39 @@
+import asyncio
+import unittest
+
+from RateLimiting import ThrottlingScheduler
+
+
+class FixedDelayPolicy:
+    """Throttling policy delaying every request by the same time"""
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def get_delay(self, client_id):
+        return self.delay
+
+    def remove_client(self, client_id):
+        pass
+
+
+class TestThrottlingSchedulerReconnect(unittest.IsolatedAsyncioTestCase):
+    """A client reconnecting from the same source port gets the same client id (peername)"""
+
+    async def test_timers_of_closed_connection_do_not_release_requests_of_new_connection(self):
+        policy = FixedDelayPolicy(0.05)
+        scheduler = ThrottlingScheduler(policy)
+        forwarded = []
+        scheduler.schedule(('client', 3000), lambda: forwarded.append('old'))
+        scheduler.schedule(('client', 3000), lambda: forwarded.append('old'))
+        scheduler.remove_client(('client', 3000))
+        policy.delay = 0.2
+        scheduler.schedule(('client', 3000), lambda: forwarded.append('new'))
+        await asyncio.sleep(0.15)
+        self.assertEqual(forwarded, [])
+        await asyncio.sleep(0.1)
+        self.assertEqual(forwarded, ['new'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import asyncio
+import unittest
+
+from RequestCoalescing import InFlightReadTable
+
+
+class TestInFlightReadInvalidation(unittest.IsolatedAsyncioTestCase):
+    """A read received after a write must not join a read forwarded before the write"""
+
+    async def test_write_detaches_overlapping_reads(self):
+        in_flight_reads = InFlightReadTable()
+        response = asyncio.get_running_loop().create_future()
+        forwarded_read = in_flight_reads.start((1, 100, 10), response)
+        other_read = in_flight_reads.start((1, 110, 10), asyncio.sleep(0))
+        in_flight_reads.invalidate(1, 109, 1)
+        self.assertIsNone(in_flight_reads.join((1, 100, 10)))
+        self.assertIs(in_flight_reads.join((1, 110, 10)), other_read)
+        # The detached read still answers the clients which joined it before the write
+        response.set_result('response')
+        self.assertEqual(await forwarded_read, 'response')
+        self.assertIsNone(in_flight_reads.join((1, 100, 10)))
+        await other_read
+
+    async def test_fresh_read_is_not_removed_by_detached_read(self):
+        in_flight_reads = InFlightReadTable()
+        response = asyncio.get_running_loop().create_future()
+        forwarded_read = in_flight_reads.start((1, 100, 10), response)
+        in_flight_reads.invalidate(1, 100, 1)
+        fresh_read = in_flight_reads.start((1, 100, 10), asyncio.get_running_loop().create_future())
+        response.set_result('response')
+        await forwarded_read
+        self.assertIs(in_flight_reads.join((1, 100, 10)), fresh_read)
+        fresh_read.cancel()
+
+    async def test_write_of_other_unit_keeps_reads(self):
+        in_flight_reads = InFlightReadTable()
+        forwarded_read = in_flight_reads.start((1, 100, 10), asyncio.sleep(0))
+        in_flight_reads.invalidate(2, 100, 10)
+        self.assertIs(in_flight_reads.join((1, 100, 10)), forwarded_read)
+        await forwarded_read
+
+
+if __name__ == '__main__':
+    unittest.main()
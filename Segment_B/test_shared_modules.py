@@ -0,0 +1,29 @@
+import filecmp
+import os
+import unittest
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules of which each directory holds an identical copy, as every segment is built as a docker image of its own
+SHARED_MODULES = {
+    'CovertChunks.py': ('Segment_A', 'Segment_B', 'Segment_C'),
+    'FrameReassembly.py': ('Segment_B', 'Segment_C'),
+    'PacketTrace.py': ('Segment_A', 'Segment_B', 'Segment_C', 'TestResults'),
+    'TransactionLogging.py': ('Segment_A', 'Segment_B', 'Segment_C'),
+}
+
+
+class TestSharedModules(unittest.TestCase):
+    """A change of a shared module must be copied into every directory holding it"""
+
+    def test_copies_are_identical(self):
+        for module, directories in SHARED_MODULES.items():
+            original = os.path.join(REPOSITORY, directories[0], module)
+            for directory in directories[1:]:
+                with self.subTest(module=module, directory=directory):
+                    self.assertTrue(filecmp.cmp(original, os.path.join(REPOSITORY, directory, module), shallow=False),
+                                    f"{directory}/{module} differs from {directories[0]}/{module}")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import asyncio
+import socket
+import threading
+import time
+import logging
+import sys
+
+from pyModbusTCP.server import ModbusServer as BaseModbusServer
+from CustomModbusServer import CustomModbusServer
+from constants import ASYNC_BACKLOG, MBAP_HEADER_SIZE
+
+logger = logging.getLogger('pyModbusTCP.server')
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                    handlers=[logging.StreamHandler(sys.stdout)])
+
+
+class AsyncModbusServer(CustomModbusServer):
+    """Modbus server with the asyncio engine. All client sessions are served as coroutines on one event loop in one
+        thread, so that thousands of concurrent sessions can be held without one OS thread per session, and the server
+        stops without waiting for socket timeouts. Only the transport differs from CustomModbusServer: the MBAP and
+        PDU filtering, the hidden message decoding and the function code handlers are the same."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loop = None
+        self._sock = None
+        self._serve_task = None
+        # Writer of each session task, a session is stopped by closing its connection
+        self._sessions = {}
+
+    def start(self):
+        """Start the server.
+
+        This function will block (or not if no_block flag is set).
+        """
+        # do nothing if server is already running
+        if self.is_run:
+            return
+        family = socket.AF_INET6 if self.ipv6 else socket.AF_INET
+        try:
+            self._sock = socket.create_server((self.host, self.port), family=family, backlog=ASYNC_BACKLOG)
+        except OSError as e:
+            raise BaseModbusServer.NetworkError(e)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self._loop = asyncio.new_event_loop()
+        self._serve_task = self._loop.create_task(self._serve_async())
+        self._evt_running.set()
+        # serve request
+        if self.no_block:
+            self._serve_th = threading.Thread(target=self._serve)
+            self._serve_th.daemon = True
+            self._serve_th.start()
+        else:
+            self._serve()
+
+    def stop(self):
+        """Stop the server, the sessions are cancelled at once."""
+        if self.is_run:
+            self._loop.call_soon_threadsafe(self._serve_task.cancel)
+            if self._serve_th is not None and self._serve_th is not threading.current_thread():
+                self._serve_th.join()
+
+    def _serve(self):
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._serve_task)
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            pass
+        finally:
+            self._evt_running.clear()
+            self._loop.close()
+            self._sock.close()
+
+    async def _serve_async(self):
+        server = await asyncio.start_server(self._handle_session, sock=self._sock, backlog=ASYNC_BACKLOG)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for writer in self._sessions.values():
+                writer.close()
+            await asyncio.gather(*self._sessions, return_exceptions=True)
+
+    async def _handle_session(self, reader, writer):
+        """Serve the requests of one client connection one after another"""
+        session = asyncio.current_task()
+        self._sessions[session] = writer
+        # init and update server info structure
+        session_data = CustomModbusServer.SessionData()
+        (session_data.client.address, session_data.client.port) = writer.get_extra_info('peername')[:2]
+        # debug message
+        logger.debug('Accept new connection from %r', session_data.client)
+        try:
+            # main processing loop
+            while True:
+                # init session data for new request
+                session_data.new_request()
+                session_data.receive_mbap(await reader.readexactly(MBAP_HEADER_SIZE))
+                request_pdu = await reader.readexactly(session_data.request.mbap.length - 1)
+
+                receive_request_time = time.time()
+                response_frame = session_data.process_request(request_pdu, self._engine)
+                writer.write(response_frame)
+                await writer.drain()
+                session_data.end_request(request_pdu, response_frame, receive_request_time, time.time())
+        except (BaseModbusServer.Error, asyncio.IncompleteReadError, ConnectionError, OSError) as e:
+            # debug message
+            logger.debug('Exception during request handling: %r', e)
+        finally:
+            self._sessions.pop(session, None)
+            # on main loop except: exit from it and cleanly close the current socket
+            writer.close()
@@ -0,0 +1,126 @@
+import logging
+import multiprocessing
+import socket
+import struct
+import sys
+import threading
+import time
+
+from pyModbusTCP.server import DataBank, ModbusServer as BaseModbusServer
+from CustomModbusServer import CustomModbusServer
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                    handlers=[logging.StreamHandler(sys.stdout)])
+
+# Benchmark of the request rate one core sustains with the threading engine of the modbus server on one connection,
+# without logging. The client sends `pipeline` requests at once, so that one read of the server can deliver several
+# of them.
+# usage: python BenchmarkServerReceive.py [number of requests] [port]
+
+REQUEST = struct.pack('>HHHBBHH', 1, 0, 6, 1, 3, 10, 1)
+RESPONSE_SIZE = 11
+
+
+class SessionDataWithNewFrames(CustomModbusServer.SessionData):
+    """SessionData before the frames were reused: new frame objects for every request"""
+
+    def new_request(self):
+        self.request = CustomModbusServer.Frame()
+        self.response = CustomModbusServer.Frame()
+        super().new_request()
+
+
+class ModbusServiceWithRecvAll(CustomModbusServer.ModbusService):
+    """ModbusService before the receive buffer: two blocking reads per request, MBAP header and PDU, each one built
+        by concatenating the received chunks"""
+
+    def _recv_all(self, size):
+        data = b''
+        while len(data) < size:
+            try:
+                if not self.server_running:
+                    raise BaseModbusServer.NetworkError('main server is not running')
+                data_chunk = self.request.recv(size - len(data))
+                if data_chunk:
+                    data += data_chunk
+                else:
+                    raise BaseModbusServer.NetworkError('recv return null')
+            except socket.timeout:
+                pass
+        return data
+
+    def handle(self):
+        session_data = SessionDataWithNewFrames()
+        try:
+            while True:
+                session_data.new_request()
+                session_data.receive_mbap(self._recv_all(7))
+                request_pdu = self._recv_all(session_data.request.mbap.length - 1)
+                receive_request_time = time.time()
+                response_frame = session_data.process_request(request_pdu, self.server.engine)
+                self._send_all(response_frame)
+                session_data.end_request(request_pdu, response_frame, receive_request_time, time.time())
+        except (BaseModbusServer.Error, socket.error):
+            self.request.close()
+
+
+class ModbusServerWithRecvAll(CustomModbusServer):
+    ModbusService = ModbusServiceWithRecvAll
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by server")
+        data += chunk
+    return data
+
+
+def run_client(port, num_requests, pipeline):
+    """Send the requests in batches of `pipeline` requests and wait for all responses of a batch"""
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        batch = REQUEST * pipeline
+        for _ in range(num_requests // pipeline):
+            sock.sendall(batch)
+            recv_exactly(sock, RESPONSE_SIZE * pipeline)
+
+
+def benchmark(server_class, port, num_requests, pipeline):
+    """
+    The client runs in a process of its own, so that only the server uses the CPU time of this process.
+
+    :returns: requests per second of CPU time of the server, best of 3 runs
+    """
+    server = server_class(host='127.0.0.1', port=port, no_block=True, data_bank=DataBank(h_regs_size=100))
+    server.start()
+    try:
+        best = 0.0
+        for _ in range(3):
+            client = multiprocessing.Process(target=run_client, args=(port, num_requests, pipeline))
+            start = time.process_time()
+            client.start()
+            client.join()
+            best = max(best, num_requests // pipeline * pipeline / (time.process_time() - start))
+        return best
+    finally:
+        server.stop()
+        # wait until the session threads noticed the stop of the server
+        while threading.active_count() > 1:
+            time.sleep(0.1)
+
+
+if __name__ == '__main__':
+    num_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 5020
+    # The benchmark measures the receive path, not the log lines of the transactions
+    logging.disable(logging.INFO)
+    for pipeline in (1, 16):
+        rate_with_recv_all = benchmark(ModbusServerWithRecvAll, port, num_requests, pipeline)
+        rate_with_buffer = benchmark(CustomModbusServer, port, num_requests, pipeline)
+        print(f"{pipeline} request(s) per send:")
+        print(f"  _recv_all and new frames:    {rate_with_recv_all:.0f} requests per CPU second")
+        print(f"  recv_into and reused frames: {rate_with_buffer:.0f} requests per CPU second")
+        print(f"  speed-up:                    {rate_with_buffer / rate_with_recv_all:.2f}x")
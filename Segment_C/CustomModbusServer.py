@@ -2,66 +2,64 @@ import os
 import struct
 import time
 
-from pyModbusTCP.constants import READ_HOLDING_REGISTERS, EXP_DATA_VALUE
+from pyModbusTCP.constants import (READ_HOLDING_REGISTERS, WRITE_SINGLE_REGISTER, WRITE_MULTIPLE_REGISTERS,
+                                   WRITE_READ_MULTIPLE_REGISTERS, EXP_DATA_VALUE, EXP_DATA_ADDRESS)
 from pyModbusTCP.server import ModbusServer as BaseModbusServer
 import socket
 import logging
 import sys
+from TransactionLogging import start_transaction
+from PacketTrace import trace_enabled, trace_transaction
+from FrameReassembly import MbapFrameReassembler
+from RegisterBank import ArrayDataBank, MultiUnitDataHandler
+from constants import MBAP_HEADER_SIZE
+from CovertChunks import CovertFrameReader, CovertMessageAssembler, HiddenMessageSink
 
 logger = logging.getLogger('pyModbusTCP.server')
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
                     handlers=[logging.StreamHandler(sys.stdout)])
 
-HEADER_BITS_LENGTH = 10
+FC_BYTE_COUNT = struct.Struct('>BB')  # function code and byte count of a read response
+REGISTER = struct.Struct('>H')  # one register value of a read response
 
-class ReadMsgS1:
-    """This class is used to extract hidden messages from Proxy Server embedded with size-modulation methods"""
-    hidden_message_s1 = ''
-    msg_bits = ''
-    bits_message_counter = 0
-    stop_read_msg = False
+# Number of hidden bits encoded in the length of one request, must match S1_BITS_PER_PACKET of the proxy server
+S1_BITS_PER_PACKET = int(os.getenv('S1_BITS_PER_PACKET', 1))
+# Read the hidden message embedded with size modulation, set in the docker-compose file
+APPLY_SIZE_MODULATION = os.getenv('APPLY_SIZE_MODULATION', False)
+# Function codes accepted by the application-layer filter
+SUPPORTED_FUNCTION_CODES = (READ_HOLDING_REGISTERS, WRITE_SINGLE_REGISTER, WRITE_MULTIPLE_REGISTERS,
+                            WRITE_READ_MULTIPLE_REGISTERS)
+# Requests carrying hidden bits in their length, must match S1_FUNCTION_CODES of the proxy server
+S1_FUNCTION_CODES = (READ_HOLDING_REGISTERS, WRITE_SINGLE_REGISTER)
 
-    @staticmethod
-    def resolve_hidden_message_s1(length):
+class ReadMsgS1:
+    """This class is used to extract hidden messages from Proxy Server embedded with size-modulation methods. Each
+        connection has a decoder of its own, which reads the chunk frames of its requests. The proxy server stripes
+        the message in sequence-numbered chunks over all its connections, the chunks of all connections are
+        reassembled by one CovertMessageAssembler and the completed message is published to the sink."""
+    assembler = CovertMessageAssembler()
+    sink = HiddenMessageSink()
+
+    def __init__(self, bits_per_packet=S1_BITS_PER_PACKET):
+        self.bits_per_packet = bits_per_packet
+        self._symbol_mask = (1 << bits_per_packet) - 1
+        self._frame_reader = CovertFrameReader(ReadMsgS1.assembler)
+
+    def resolve_hidden_message_s1(self, length):
         """
-        this method resolves and add bit to the result string `hidden_message_s1`. A modbus/TCP packet with even length
-        represents a bit 1 and a modbus/TCP packet with odd length represents a bit 0.
+        this method resolves the symbol of `bits_per_packet` bits encoded in the length of a modbus/TCP packet and
+        hands its bits to the frame reader of the connection. The symbol is the length modulo 2^bits_per_packet,
+        with 1 bit per packet a modbus/TCP packet with odd length represents a bit 1 and a modbus/TCP packet with even
+        length represents a bit 0.
 
         :param length: length of received modbus/TCP packet from client
         """
-        # Read the header of hidden message
-        if len(ReadMsgS1.msg_bits) < HEADER_BITS_LENGTH:
-            ReadMsgS1.resolve_length_message(length)
-        # Read the real hidden message
-        else:
-            if ReadMsgS1.bits_message_counter > 0:
-                if length % 2 == 1:
-                    ReadMsgS1.hidden_message_s1 += '1'
-                else:
-                    ReadMsgS1.hidden_message_s1 += '0'
-
-                ReadMsgS1.bits_message_counter -= 1
-                logging.info(f"reading hidden message: {ReadMsgS1.hidden_message_s1}")
-            else:
-                logging.info(f"Reading finish. Full hidden message: {ReadMsgS1.hidden_message_s1}")
-                ReadMsgS1.stop_read_msg = True
-
-    @classmethod
-    def resolve_length_message(cls, length):
-        """
-        The first 10 bits of hidden message represent the number of bits following. there will be maximum 1023 bits can
-        be sent with 10 bits in header
-
-        :param length: the length of current modbus/TCP packet
-        """
-        if length % 2 == 1:
-            cls.msg_bits += '1'
-        else:
-            cls.msg_bits += '0'
-        logging.info(f"Hidden message Header: {cls.msg_bits}")
-        if len(cls.msg_bits) == HEADER_BITS_LENGTH:
-            cls.bits_message_counter = int(cls.msg_bits, 2)
-            logging.info(f"number of bits to read: {cls.bits_message_counter}")
+        if ReadMsgS1.assembler.complete:
+            return
+        message = self._frame_reader.feed(length & self._symbol_mask, self.bits_per_packet)
+        if message is not None:
+            logging.info(f"Reading finish. Full hidden message: {message}")
+            ReadMsgS1.sink.publish(message)
 
 
 class CustomModbusServer(BaseModbusServer):
@@ -72,6 +70,10 @@ class CustomModbusServer(BaseModbusServer):
             self.client = CustomModbusServer.ClientInfo()
             self.request = CustomModbusServer.Frame()
             self.response = CustomModbusServer.Frame()
+            # Record of the current transaction, None if it is not logged
+            self.record = None
+            # Decoder of the hidden message embedded with size modulation in the requests of this connection
+            self.hidden_message_s1 = ReadMsgS1()
 
         @property
         def srv_info(self):
@@ -81,8 +83,62 @@ class CustomModbusServer(BaseModbusServer):
             return info
 
         def new_request(self):
-            self.request = CustomModbusServer.Frame()
-            self.response = CustomModbusServer.Frame()
+            # The frames of the session are reused for every request, all fields of the request are set when it is
+            # received
+            self.response.pdu.clear()
+            self.record = start_transaction()
+
+        def receive_mbap(self, mbap_raw):
+            """Check and set the mbap header of the request"""
+            # Application-layer filtering: Check and set mbap header if valid @raw.setter from MBAP class
+            self.request.mbap.raw = mbap_raw
+
+        def process_request(self, request_pdu, engine):
+            """
+            Check the pdu of the request and build its response. Used by both server engines.
+
+            :param request_pdu: pdu of the request received after its mbap header
+            :param engine: request processing engine of the server, which fills the response pdu
+            :returns: raw response frame (MBAP + PDU)
+            """
+            record = self.record
+            if record is not None:
+                request_mbap = self.request.mbap
+                record.header("Request",
+                              request_mbap.transaction_id,
+                              request_mbap.protocol_id,
+                              request_mbap.length,
+                              request_mbap.unit_id)
+
+            # Application-layer filtering: Check and set pdu header if valid @raw.setter from PDU class
+            function_code = CustomModbusServer.ModbusService.request_pdu_filter(request_pdu)
+
+            # Check if there is hidden message to read, the proxy server embeds it in FC3 and FC6 requests only
+            if APPLY_SIZE_MODULATION and function_code in S1_FUNCTION_CODES:
+                self.hidden_message_s1.resolve_hidden_message_s1(self.request.mbap.length)
+
+            self.request.pdu.raw = request_pdu
+
+            # update response MBAP fields with request data
+            self.set_response_mbap()
+            # pass the current session data to request engine
+            engine(self)
+            return self.response.raw
+
+        def end_request(self, request_pdu, response_frame, receive_request_time, send_response_time):
+            """Trace the transaction and write its record after the response is sent"""
+            if trace_enabled():
+                trace_transaction(receive_request_time,
+                                  send_response_time - receive_request_time,
+                                  self.request.mbap.raw,
+                                  request_pdu,
+                                  response_frame)
+            record = self.record
+            if record is not None:
+                record.field("Response_LF", self.response.mbap.length)
+                record.round_trip_time("Round-Trip-Time of packet at Server",
+                                       send_response_time - receive_request_time)
+                record.emit()
 
         def set_response_mbap(self):
             self.response.mbap.transaction_id = self.request.mbap.transaction_id
@@ -98,8 +154,6 @@ class CustomModbusServer(BaseModbusServer):
         @property
         def raw(self):
             self.mbap.length = len(self.pdu) + 1
-            logging.info(f"Response_LF: {self.mbap.length}")
-            logging.info("----------------------------------")
             return self.mbap.raw + self.pdu.raw
 
     class ModbusService(BaseModbusServer.ModbusService):
@@ -114,28 +168,24 @@ class CustomModbusServer(BaseModbusServer):
             except socket.timeout:
                 return False
 
-        def _recv_all(self, size):
-            data = b''
-            while len(data) < size:
+        def _recv_into(self, reassembler):
+            """Receive the next bytes of the request stream into the preallocated buffer of the session"""
+            while True:
                 try:
                     # avoid keeping this TCP thread run after server.stop() on main server
                     if not self.server_running:
                         raise BaseModbusServer.NetworkError('main server is not running')
-                    # recv all data or a chunk of it
-                    data_chunk = self.request.recv(size - len(data))
-                    # check data chunk
-                    if data_chunk:
-                        data += data_chunk
-                    else:
+                    # recv all data or a chunk of it, it may hold several requests
+                    if reassembler.recv_from(self.request) == 0:
                         raise BaseModbusServer.NetworkError('recv return null')
+                    return
                 except socket.timeout:
                     # just redo main server run test and recv operations on timeout
                     pass
-            return data
 
         def setup(self):
             # set a socket timeout of 1s on blocking operations (like send/recv)
-            # this avoids hang thread deletion when main server exit (see _recv_all method)
+            # this avoids hang thread deletion when main server exit (see _recv_into method)
             self.request.settimeout(1.0)
 
         def handle(self):
@@ -146,36 +196,27 @@ class CustomModbusServer(BaseModbusServer):
             (session_data.client.address, session_data.client.port) = self.request.getpeername()
             # debug message
             logger.debug('Accept new connection from %r', session_data.client)
+            # Requests are received into a buffer of the session, which is reused for all of them
+            reassembler = MbapFrameReassembler()
             try:
                 # main processing loop
                 while True:
-                    # init session data for new request
-                    session_data.new_request()
-
-                    # Application-layer filtering: Check and set mbap header if valid @raw.setter from MBAP class
-                    session_data.request.mbap.raw = self._recv_all(7)
-                    request_pdu = self._recv_all(session_data.request.mbap.length - 1)
-
-                    # receive mbap from client
-                    logger.info("A request is received")
-                    receive_request_time = time.time()
-                    logger.info(f"Request arrives modbus-server at {receive_request_time}")
-
-                    # Application-layer filtering: Check and set pdu header if valid @raw.setter from PDU class
-                    self.request_pdu_filter(request_pdu)
-
-                    session_data.request.pdu.raw = request_pdu
-
-                    # update response MBAP fields with request data
-                    session_data.set_response_mbap()
-                    # pass the current session data to request engine
-                    self.server.engine(session_data)
-                    # send the tx pdu with the last rx mbap (only length field change)
-                    self._send_all(session_data.response.raw)
-                    send_response_time = time.time()
-                    logger.info(f"Response is sent back to modbus-client at {send_response_time}")
-                    logger.info(f"Round-Trip-Time of packet at Server : {send_response_time - receive_request_time}\n\n")
-            except (BaseModbusServer.Error, socket.error) as e:
+                    self._recv_into(reassembler)
+                    # A read can deliver several requests, each one is answered before the buffer is read again
+                    for frame in reassembler.frames():
+                        # init session data for new request
+                        session_data.new_request()
+
+                        session_data.receive_mbap(frame[:MBAP_HEADER_SIZE])
+                        request_pdu = frame[MBAP_HEADER_SIZE:]
+
+                        # receive mbap from client
+                        receive_request_time = time.time()
+                        response_frame = session_data.process_request(request_pdu, self.server.engine)
+                        # send the tx pdu with the last rx mbap (only length field change)
+                        self._send_all(response_frame)
+                        session_data.end_request(request_pdu, response_frame, receive_request_time, time.time())
+            except (BaseModbusServer.Error, socket.error, ValueError) as e:
                 # debug message
                 logger.debug('Exception during request handling: %r', e)
                 # on main loop except: exit from it and cleanly close the current socket
@@ -183,14 +224,18 @@ class CustomModbusServer(BaseModbusServer):
 
         @staticmethod
         def request_pdu_filter(request_pdu_body):
+            """
+            :returns: function code of the request
+            """
             function_code = struct.unpack('B', request_pdu_body[:1])[0]
             # logging.info(f"function code in response: {function_code}")
-            if function_code != 3 and function_code != 6:
-                raise BaseModbusServer.NetworkError(4, 'Function code is not 3 or 6')
+            if function_code not in SUPPORTED_FUNCTION_CODES:
+                raise BaseModbusServer.NetworkError(4, 'Function code is not 3, 6, 16 or 23')
 
             # check PDU length for global minimal frame (an except frame: func code + exp code)
             if len(request_pdu_body) < 4:
                 raise BaseModbusServer.NetworkError(4, 'PDU length is too short')
+            return function_code
 
     class MBAP(BaseModbusServer.MBAP):
         @property
@@ -210,15 +255,6 @@ class CustomModbusServer(BaseModbusServer):
             # decode header
             (self.transaction_id, self.protocol_id,
              self.length, self.unit_id) = struct.unpack('>HHHB', value)
-            self.mbap_header_logging(self.transaction_id,
-                                     self.protocol_id,
-                                     self.length,
-                                     self.unit_id,
-                                     "Request")
-            # Check if there is hidden message to read
-            if os.getenv('APPLY_SIZE_MODULATION', False):
-                if not ReadMsgS1.stop_read_msg:
-                    ReadMsgS1.resolve_hidden_message_s1(self.length)
 
             # check frame header content inconsistency
             if self.protocol_id != 0:
@@ -226,14 +262,14 @@ class CustomModbusServer(BaseModbusServer):
             if not 2 < self.length < 256:
                 raise BaseModbusServer.DataFormatError('MBAP length must be between 2 and 256')
 
-        @staticmethod
-        def mbap_header_logging(transaction_id, protocol_id, length, unit_id, packet_type):
-            logging.info(f"{packet_type} header:")
-            logging.info(f"{packet_type}_TID: {transaction_id}")
-            logging.info(f"{packet_type}_PID: {protocol_id}")
-            logging.info(f"{packet_type}_LF: {length}")
-            logging.info(f"{packet_type}_UID: {unit_id}")
-            logging.info("----------------------------------")
+    def unit_data_bank(self, unit_id):
+        """
+        :returns: data bank of the unit addressed by a request, None if the server does not emulate the unit
+        """
+        if isinstance(self.data_hdl, MultiUnitDataHandler):
+            return self.data_hdl.data_bank_of(unit_id)
+        # A server with one data bank answers requests to any unit id
+        return self.data_bank
 
     def _read_words(self, session_data):
         """
@@ -250,36 +286,64 @@ class CustomModbusServer(BaseModbusServer):
         # print("send_pdu", type(send_pdu))
         # decode pdu
         (start_addr, quantity_regs) = recv_pdu.unpack('>HH', from_byte=1, to_byte=5)
-        self.pdu_body_logging(recv_pdu.func_code,
+        self.pdu_body_logging(session_data.record,
+                              recv_pdu.func_code,
                               start_addr,
-                              "read from register: ",
+                              "read_from_register",
                               quantity_regs,
-                              "number of register: ",
+                              "number_of_registers",
                               "Request")
         # check quantity of requested words
         if 0x0001 <= quantity_regs <= 0x007D:
+            self._add_read_registers(session_data, recv_pdu.func_code == READ_HOLDING_REGISTERS, start_addr,
+                                     quantity_regs)
+        else:
+            send_pdu.build_except(recv_pdu.func_code, EXP_DATA_VALUE)
+        # print("send_pdu ", send_pdu.raw)
+
+    def _add_read_registers(self, session_data, holding_registers, start_addr, quantity_regs):
+        """
+        Build the response of a read of holding registers (FC3, FC23) or input registers (FC4).
+
+        :param session_data: server engine data
+        :param holding_registers: read the holding registers, otherwise the input registers
+        """
+        recv_pdu = session_data.request.pdu
+        send_pdu = session_data.response.pdu
+        data_bank = self.unit_data_bank(session_data.request.mbap.unit_id)
+        if isinstance(data_bank, ArrayDataBank):
+            # the registers are copied as bytes from the data bank into the response, without a list of int
+            if holding_registers:
+                registers = data_bank.get_holding_registers_bytes(start_addr, quantity_regs)
+            else:
+                registers = data_bank.get_input_registers_bytes(start_addr, quantity_regs)
+            if registers is None:
+                send_pdu.build_except(recv_pdu.func_code, EXP_DATA_ADDRESS)
+                return
+            send_pdu.raw = FC_BYTE_COUNT.pack(recv_pdu.func_code, quantity_regs * 2) + registers
+            first_value = REGISTER.unpack_from(registers)[0]
+        else:
             # data handler read request: for holding or input registers space
-            if recv_pdu.func_code == READ_HOLDING_REGISTERS:
+            if holding_registers:
                 ret_hdl = self.data_hdl.read_h_regs(start_addr, quantity_regs, session_data.srv_info)
             else:
                 ret_hdl = self.data_hdl.read_i_regs(start_addr, quantity_regs, session_data.srv_info)
             # format regular or except response
-            if ret_hdl.ok:
-                # build pdu
-                send_pdu.add_pack('BB', recv_pdu.func_code, quantity_regs * 2)
-                # add_pack requested words
-                send_pdu.add_pack('>%dH' % len(ret_hdl.data), *ret_hdl.data)
-                self.pdu_body_logging(recv_pdu.func_code,
-                                      ret_hdl.data[0],
-                                      "read value: ",
-                                      quantity_regs,
-                                      "number of register: ",
-                                      "Response")
-            else:
+            if not ret_hdl.ok:
                 send_pdu.build_except(recv_pdu.func_code, ret_hdl.exp_code)
-        else:
-            send_pdu.build_except(recv_pdu.func_code, EXP_DATA_VALUE)
-        # print("send_pdu ", send_pdu.raw)
+                return
+            # build pdu
+            send_pdu.add_pack('BB', recv_pdu.func_code, quantity_regs * 2)
+            # add_pack requested words
+            send_pdu.add_pack('>%dH' % len(ret_hdl.data), *ret_hdl.data)
+            first_value = ret_hdl.data[0]
+        self.pdu_body_logging(session_data.record,
+                              recv_pdu.func_code,
+                              first_value,
+                              "read_value",
+                              quantity_regs,
+                              "number_of_registers",
+                              "Response")
 
     def _write_single_register(self, session_data):
         """
@@ -293,30 +357,111 @@ class CustomModbusServer(BaseModbusServer):
         send_pdu = session_data.response.pdu
         # decode pdu
         (reg_addr, reg_value) = recv_pdu.unpack('>HH', from_byte=1, to_byte=5)
-        self.pdu_body_logging(recv_pdu.func_code,
+        self.pdu_body_logging(session_data.record,
+                              recv_pdu.func_code,
                               reg_addr,
-                              "write to register ",
+                              "write_to_register",
                               reg_value,
-                              "written value ",
+                              "written_value",
                               "Request")
         # data handler update request
         ret_hdl = self.data_hdl.write_h_regs(reg_addr, [reg_value], session_data.srv_info)
         # format regular or except response
         if ret_hdl.ok:
             send_pdu.add_pack('>BHH', recv_pdu.func_code, reg_addr, reg_value)
-            self.pdu_body_logging(recv_pdu.func_code,
+            self.pdu_body_logging(session_data.record,
+                                  recv_pdu.func_code,
                                   reg_addr,
-                                  "register address ",
+                                  "register_address",
                                   reg_value,
-                                  "writen value ",
+                                  "written_value",
                                   "Response")
         else:
             send_pdu.build_except(recv_pdu.func_code, ret_hdl.exp_code)
 
+    def _write_multiple_registers(self, session_data):
+        """
+        Function Write Multiple Registers (0x10).
+
+        :param session_data: server engine data
+        :type session_data: ModbusServer.SessionData
+        """
+        # pdu alias
+        recv_pdu = session_data.request.pdu
+        send_pdu = session_data.response.pdu
+        # decode pdu
+        (start_addr, quantity_regs, byte_count) = recv_pdu.unpack('>HHB', from_byte=1, to_byte=6)
+        self.pdu_body_logging(session_data.record,
+                              recv_pdu.func_code,
+                              start_addr,
+                              "write_to_register",
+                              quantity_regs,
+                              "number_of_registers",
+                              "Request")
+        if 0x0001 <= quantity_regs <= 0x007B and byte_count == quantity_regs * 2 and len(recv_pdu) >= 6 + byte_count:
+            # all register values are decoded at once
+            registers = recv_pdu.unpack('>%dH' % quantity_regs, from_byte=6, to_byte=6 + byte_count)
+            # data handler update request
+            ret_hdl = self.data_hdl.write_h_regs(start_addr, list(registers), session_data.srv_info)
+            # format regular or except response
+            if ret_hdl.ok:
+                send_pdu.add_pack('>BHH', recv_pdu.func_code, start_addr, quantity_regs)
+                self.pdu_body_logging(session_data.record,
+                                      recv_pdu.func_code,
+                                      start_addr,
+                                      "register_address",
+                                      quantity_regs,
+                                      "number_of_registers",
+                                      "Response")
+            else:
+                send_pdu.build_except(recv_pdu.func_code, ret_hdl.exp_code)
+        else:
+            send_pdu.build_except(recv_pdu.func_code, EXP_DATA_VALUE)
+
+    def _write_read_multiple_registers(self, session_data):
+        """
+        Function Read/Write Multiple Registers (0x17). The registers are written before they are read.
+
+        :param session_data: server engine data
+        :type session_data: ModbusServer.SessionData
+        """
+        # pdu alias
+        recv_pdu = session_data.request.pdu
+        send_pdu = session_data.response.pdu
+        # decode pdu
+        (read_start_addr,
+         read_quantity_regs,
+         write_start_addr,
+         write_quantity_regs,
+         byte_count) = recv_pdu.unpack('>HHHHB', from_byte=1, to_byte=10)
+        self.pdu_body_logging(session_data.record,
+                              recv_pdu.func_code,
+                              read_start_addr,
+                              "read_from_register",
+                              read_quantity_regs,
+                              "number_of_registers",
+                              "Request")
+        if session_data.record is not None:
+            session_data.record.field("write_to_register", write_start_addr)
+            session_data.record.field("number_of_written_registers", write_quantity_regs)
+        if (0x0001 <= read_quantity_regs <= 0x007D and 0x0001 <= write_quantity_regs <= 0x0079
+                and byte_count == write_quantity_regs * 2 and len(recv_pdu) >= 10 + byte_count):
+            # all register values are decoded at once
+            registers = recv_pdu.unpack('>%dH' % write_quantity_regs, from_byte=10, to_byte=10 + byte_count)
+            # data handler update request
+            ret_hdl = self.data_hdl.write_h_regs(write_start_addr, list(registers), session_data.srv_info)
+            # format regular or except response
+            if ret_hdl.ok:
+                self._add_read_registers(session_data, True, read_start_addr, read_quantity_regs)
+            else:
+                send_pdu.build_except(recv_pdu.func_code, ret_hdl.exp_code)
+        else:
+            send_pdu.build_except(recv_pdu.func_code, EXP_DATA_VALUE)
+
     @staticmethod
-    def pdu_body_logging(function_code, value_1, msg_value_1, value_2, msg_value_2, packet_type):
-        logging.info(f"{packet_type} PDU:")
-        logging.info(f"{packet_type}_FC: {function_code}")
-        logging.info(f"{msg_value_1}: {value_1}")
-        logging.info(f"{msg_value_2}: {value_2}")
-        logging.info("-------------------------------")
+    def pdu_body_logging(record, function_code, value_1, msg_value_1, value_2, msg_value_2, packet_type):
+        """Add the pdu payload of a modbus/TCP packet to the record of its transaction"""
+        if record is not None:
+            record.field(f"{packet_type}_FC", function_code)
+            record.field(msg_value_1, value_1)
+            record.field(msg_value_2, value_2)
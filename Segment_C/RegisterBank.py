@@ -0,0 +1,322 @@
+import sys
+import threading
+from array import array
+from contextlib import contextmanager
+
+from pyModbusTCP.constants import EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND
+from pyModbusTCP.server import DataBank, DataHandler
+from constants import REGISTER_SPACE_SIZE, REGISTER_PAGE_SIZE
+
+# The registers are stored in network byte order, so that a read request is answered with a copy of a slice of the
+# storage without converting each register
+_SWAP_BYTES = sys.byteorder == 'little'
+
+
+class SeqLock:
+    """Sequence lock of one data space. Writers serialise on a lock and keep the sequence number odd while they
+        write. Readers take no lock: they copy the data and retry, if the sequence number was odd or changed during
+        the copy, so that concurrent readers never wait for each other."""
+
+    def __init__(self):
+        self._write_lock = threading.Lock()
+        self.sequence = 0
+
+    @contextmanager
+    def write(self):
+        with self._write_lock:
+            self.sequence += 1
+            try:
+                yield
+            finally:
+                self.sequence += 1
+
+
+class ArrayDataBank(DataBank):
+    """Data bank of the modbus server for the full 65536 addresses of each data space. Holding and input registers
+        are stored in array('H'), coils and discrete inputs in a bytearray (0 or 1 per address), instead of the
+        lock-protected lists of pyModbusTCP. Reads are lock-free with a SeqLock per data space, a write of one request
+        is atomic. The methods of DataBank keep their behaviour, FC3/FC4 read the registers as bytes with
+        `get_holding_registers_bytes` and `get_input_registers_bytes`."""
+
+    def __init__(self, coils_size=REGISTER_SPACE_SIZE, coils_default_value=False,
+                 d_inputs_size=REGISTER_SPACE_SIZE, d_inputs_default_value=False,
+                 h_regs_size=REGISTER_SPACE_SIZE, h_regs_default_value=0,
+                 i_regs_size=REGISTER_SPACE_SIZE, i_regs_default_value=0):
+        super().__init__(coils_size=0, coils_default_value=coils_default_value,
+                         d_inputs_size=0, d_inputs_default_value=d_inputs_default_value,
+                         h_regs_size=0, h_regs_default_value=h_regs_default_value,
+                         i_regs_size=0, i_regs_default_value=i_regs_default_value)
+        self.coils_size = int(coils_size)
+        self.d_inputs_size = int(d_inputs_size)
+        self.h_regs_size = int(h_regs_size)
+        self.i_regs_size = int(i_regs_size)
+        self._coils = self._new_bits(self.coils_default_value, self.coils_size)
+        self._coils_seqlock = SeqLock()
+        self._d_inputs = self._new_bits(self.d_inputs_default_value, self.d_inputs_size)
+        self._d_inputs_seqlock = SeqLock()
+        self._h_regs = self._new_registers(self.h_regs_default_value, self.h_regs_size)
+        self._h_regs_seqlock = SeqLock()
+        self._i_regs = self._new_registers(self.i_regs_default_value, self.i_regs_size)
+        self._i_regs_seqlock = SeqLock()
+
+    @staticmethod
+    def _new_bits(default_value, size):
+        return bytearray([bool(default_value)]) * size
+
+    @staticmethod
+    def _new_registers(default_value, size):
+        registers = array('H', [default_value & 0xffff]) * size
+        if _SWAP_BYTES:
+            registers.byteswap()
+        return registers
+
+    @staticmethod
+    def _read(seqlock, space, address, number):
+        """
+        Copy a slice of a data space without lock.
+
+        :returns: copy of the slice (same type as the space) or None if the addresses are out of the space
+        """
+        if address < 0 or address + number > len(space):
+            return None
+        while True:
+            sequence = seqlock.sequence
+            if not sequence & 1:
+                data = space[address:address + number]
+                if seqlock.sequence == sequence:
+                    return data
+
+    @staticmethod
+    def _to_words(registers):
+        """Register values of a slice in network byte order as list of int"""
+        if _SWAP_BYTES:
+            registers.byteswap()
+        return registers.tolist()
+
+    @staticmethod
+    def _registers(word_list):
+        """Values to write as array('H') in network byte order"""
+        registers = array('H', [int(word) & 0xffff for word in word_list])
+        if _SWAP_BYTES:
+            registers.byteswap()
+        return registers
+
+    @staticmethod
+    def _write(seqlock, space, address, values):
+        """
+        Overwrite a slice of a data space atomically.
+
+        :param values: array or bytearray of the same type as the space
+        :returns: previous values of the slice or None if the addresses are out of the space
+        """
+        if address < 0 or address + len(values) > len(space):
+            return None
+        with seqlock.write():
+            previous = space[address:address + len(values)]
+            space[address:address + len(values)] = values
+        return previous
+
+    def get_coils(self, address, number=1, srv_info=None):
+        bits = self._read(self._coils_seqlock, self._coils, address, number)
+        return None if bits is None else [bool(bit) for bit in bits]
+
+    def set_coils(self, address, bit_list, srv_info=None):
+        bits = bytearray(bool(bit) for bit in bit_list)
+        previous = self._write(self._coils_seqlock, self._coils, address, bits)
+        if previous is None:
+            return None
+        # on server update
+        if srv_info:
+            # notify changes with on change method (after atomic update)
+            for offset, (from_value, to_value) in enumerate(zip(previous, bits)):
+                if from_value != to_value:
+                    self.on_coils_change(address + offset, bool(from_value), bool(to_value), srv_info)
+        return True
+
+    def get_discrete_inputs(self, address, number=1, srv_info=None):
+        bits = self._read(self._d_inputs_seqlock, self._d_inputs, address, number)
+        return None if bits is None else [bool(bit) for bit in bits]
+
+    def set_discrete_inputs(self, address, bit_list):
+        bits = bytearray(bool(bit) for bit in bit_list)
+        return None if self._write(self._d_inputs_seqlock, self._d_inputs, address, bits) is None else True
+
+    def get_holding_registers(self, address, number=1, srv_info=None):
+        registers = self._read(self._h_regs_seqlock, self._h_regs, address, number)
+        return None if registers is None else self._to_words(registers)
+
+    def get_holding_registers_bytes(self, address, number=1):
+        """
+        :returns: registers in network byte order as in a read response or None if the addresses are out of the space
+        """
+        registers = self._read(self._h_regs_seqlock, self._h_regs, address, number)
+        return None if registers is None else registers.tobytes()
+
+    def set_holding_registers(self, address, word_list, srv_info=None):
+        registers = self._registers(word_list)
+        previous = self._write(self._h_regs_seqlock, self._h_regs, address, registers)
+        if previous is None:
+            return None
+        # on server update
+        if srv_info:
+            # notify changes with on change method (after atomic update)
+            for offset, (from_value, to_value) in enumerate(zip(self._to_words(previous),
+                                                                self._to_words(registers))):
+                if from_value != to_value:
+                    self.on_holding_registers_change(address + offset, from_value, to_value, srv_info=srv_info)
+        return True
+
+    def get_input_registers(self, address, number=1, srv_info=None):
+        registers = self._read(self._i_regs_seqlock, self._i_regs, address, number)
+        return None if registers is None else self._to_words(registers)
+
+    def get_input_registers_bytes(self, address, number=1):
+        """
+        :returns: registers in network byte order as in a read response or None if the addresses are out of the space
+        """
+        registers = self._read(self._i_regs_seqlock, self._i_regs, address, number)
+        return None if registers is None else registers.tobytes()
+
+    def set_input_registers(self, address, word_list):
+        registers = self._registers(word_list)
+        return None if self._write(self._i_regs_seqlock, self._i_regs, address, registers) is None else True
+
+
+class PagedSpace:
+    """Data space stored in pages of `page_size` addresses. A page is allocated with its first write, all pages which
+        were never written share one page of default values, so that a data space of a device with a mostly empty
+        register map takes a few bytes only. Slices are read and written like the array or bytearray of a dense data
+        space, so that ArrayDataBank copies and overwrites them the same way."""
+    __slots__ = ('_default_page', '_pages', '_size', '_page_size')
+
+    def __init__(self, default_page, size):
+        """
+        :param default_page: page of default values (array('H') or bytearray), its length is the page size
+        """
+        self._default_page = default_page
+        self._pages = {}  # page index -> page, only the pages written to
+        self._size = size
+        self._page_size = len(default_page)
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def num_pages(self):
+        """Number of allocated pages"""
+        return len(self._pages)
+
+    def __getitem__(self, key):
+        page_index, offset = divmod(key.start, self._page_size)
+        stop = key.stop
+        page = self._pages.get(page_index, self._default_page)
+        if stop - key.start <= self._page_size - offset:
+            # The slice lies in one page
+            return page[offset:offset + stop - key.start]
+        data = page[offset:]
+        address = (page_index + 1) * self._page_size
+        while address < stop:
+            page_index += 1
+            data += self._pages.get(page_index, self._default_page)[:stop - address]
+            address += self._page_size
+        return data
+
+    def __setitem__(self, key, values):
+        address = key.start
+        position = 0
+        while position < len(values):
+            page_index, offset = divmod(address, self._page_size)
+            page = self._pages.get(page_index)
+            if page is None:
+                page = self._pages[page_index] = self._default_page[:]
+            length = min(self._page_size - offset, len(values) - position)
+            page[offset:offset + length] = values[position:position + length]
+            address += length
+            position += length
+
+
+class PagedDataBank(ArrayDataBank):
+    """ArrayDataBank whose data spaces are PagedSpace, for devices of which only a few registers are used, e.g. the
+        thousands of units behind a gateway. Reads and writes behave as in ArrayDataBank."""
+
+    def __init__(self, page_size=REGISTER_PAGE_SIZE, **kwargs):
+        self._page_size = page_size
+        super().__init__(**kwargs)
+
+    def _new_bits(self, default_value, size):
+        return PagedSpace(ArrayDataBank._new_bits(default_value, self._page_size), size)
+
+    def _new_registers(self, default_value, size):
+        return PagedSpace(ArrayDataBank._new_registers(default_value, self._page_size), size)
+
+    @property
+    def num_pages(self):
+        """Number of allocated pages of all data spaces"""
+        return sum(space.num_pages for space in (self._coils, self._d_inputs, self._h_regs, self._i_regs))
+
+
+class MultiUnitDataHandler(DataHandler):
+    """Data handler of a modbus server, which emulates several devices behind a gateway. Each request is dispatched by
+        the unit id of its MBAP header to the data bank of its unit. A request to a unit which is not emulated is
+        answered with the exception "gateway target device failed to respond"."""
+
+    def __init__(self, data_banks):
+        """
+        :param data_banks: dict unit id -> data bank of the unit
+        """
+        # The data bank of the first unit is the data bank of the server, e.g. for the MEI device identification
+        super().__init__(data_bank=next(iter(data_banks.values())))
+        # One data handler per unit id, None if the unit is not emulated
+        self._unit_handlers = [None] * 256
+        for unit_id, data_bank in data_banks.items():
+            self._unit_handlers[unit_id] = DataHandler(data_bank=data_bank)
+
+    @property
+    def unit_ids(self):
+        return [unit_id for unit_id, handler in enumerate(self._unit_handlers) if handler is not None]
+
+    def data_bank_of(self, unit_id):
+        """
+        :returns: data bank of the unit or None if the unit is not emulated
+        """
+        handler = self._unit_handlers[unit_id]
+        return None if handler is None else handler.data_bank
+
+    def _unit_handler(self, srv_info):
+        return self._unit_handlers[srv_info.recv_frame.mbap.unit_id]
+
+    def read_coils(self, address, count, srv_info):
+        handler = self._unit_handler(srv_info)
+        if handler is None:
+            return DataHandler.Return(exp_code=EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND)
+        return handler.read_coils(address, count, srv_info)
+
+    def write_coils(self, address, bits_l, srv_info):
+        handler = self._unit_handler(srv_info)
+        if handler is None:
+            return DataHandler.Return(exp_code=EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND)
+        return handler.write_coils(address, bits_l, srv_info)
+
+    def read_d_inputs(self, address, count, srv_info):
+        handler = self._unit_handler(srv_info)
+        if handler is None:
+            return DataHandler.Return(exp_code=EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND)
+        return handler.read_d_inputs(address, count, srv_info)
+
+    def read_h_regs(self, address, count, srv_info):
+        handler = self._unit_handler(srv_info)
+        if handler is None:
+            return DataHandler.Return(exp_code=EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND)
+        return handler.read_h_regs(address, count, srv_info)
+
+    def write_h_regs(self, address, words_l, srv_info):
+        handler = self._unit_handler(srv_info)
+        if handler is None:
+            return DataHandler.Return(exp_code=EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND)
+        return handler.write_h_regs(address, words_l, srv_info)
+
+    def read_i_regs(self, address, count, srv_info):
+        handler = self._unit_handler(srv_info)
+        if handler is None:
+            return DataHandler.Return(exp_code=EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND)
+        return handler.read_i_regs(address, count, srv_info)
@@ -2,31 +2,62 @@
 import os
 import time
 import random
-from pyModbusTCP.server import DataBank, DataHandler
-from CustomModbusServer import CustomModbusServer, ReadMsgS1
+from pyModbusTCP.server import DataHandler
+from CustomModbusServer import CustomModbusServer, ReadMsgS1, S1_BITS_PER_PACKET
+from AsyncModbusServer import AsyncModbusServer
+from RegisterBank import ArrayDataBank, PagedDataBank, MultiUnitDataHandler
+from constants import SERVER_ENGINE_THREADING, SERVER_ENGINE_ASYNCIO
+from TransactionLogging import setup_logging
+from PacketTrace import setup_trace
 import logging
-import sys
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
-                    handlers=[logging.StreamHandler(sys.stdout)])
+# Log lines are written by a background thread
+setup_logging()
+setup_trace()
+
+
+def parse_unit_ids(unit_ids):
+    """
+    :param unit_ids: comma separated unit ids and ranges of unit ids, e.g. "1-247" or "1,2,10-20"
+    :returns: list of unit ids
+    """
+    result = []
+    for part in unit_ids.split(','):
+        first, _, last = part.strip().partition('-')
+        result.extend(range(int(first), int(last or first) + 1))
+    if not all(0 <= unit_id <= 255 for unit_id in result):
+        raise ValueError(f"Unit ids must be between 0 and 255: {unit_ids}")
+    return result
+
 
 # Initialize DataBank to manage Modbus data space
-data_bank = DataBank(
-    coils_size=0, coils_default_value=False,
-    d_inputs_size=0, d_inputs_default_value=False,
-    h_regs_size=100, h_regs_default_value=0,
-    i_regs_size=0, i_regs_default_value=0
-)
+# Unit ids of the devices emulated behind a gateway, set in the docker-compose file. If not set, the server emulates
+# one device which answers requests to any unit id
+server_unit_ids = os.getenv('SERVER_UNIT_IDS')
+if server_unit_ids:
+    # Each unit has a register map of its own, whose pages are allocated with their first write
+    data_banks = {unit_id: PagedDataBank() for unit_id in parse_unit_ids(server_unit_ids)}
+    request_handler = MultiUnitDataHandler(data_banks)
+    logging.info(f"Emulating {len(data_banks)} units behind a gateway")
+else:
+    # All data spaces span the full 65536 addresses of a device
+    data_banks = {0: ArrayDataBank()}
+    request_handler = DataHandler(data_bank=data_banks[0])
 print("DataBank is initialized")
 
 # Generate initial random values for holding registers
-initial_values = [random.randint(0, 1000) for _ in range(100)]
-data_bank.set_holding_registers(0, initial_values)
+for data_bank in data_banks.values():
+    initial_values = [random.randint(0, 1000) for _ in range(100)]
+    data_bank.set_holding_registers(0, initial_values)
 
 # Initialize Modbus servers
 modbus_server_name = os.getenv('MODBUS_SERVER_NAME', 'localhost')
-server = CustomModbusServer(host=modbus_server_name, port=502, data_bank=data_bank, no_block=True)
-request_handler = DataHandler(data_bank=data_bank)
+server_engine = os.getenv('SERVER_ENGINE', SERVER_ENGINE_THREADING)
+server_class = AsyncModbusServer if server_engine == SERVER_ENGINE_ASYNCIO else CustomModbusServer
+logging.info(f"Modbus server engine: {server_engine}")
+server = server_class(host=modbus_server_name, port=502, data_hdl=request_handler, no_block=True)
+if os.getenv('APPLY_SIZE_MODULATION', False):
+    logging.info(f"reading size modulation with {S1_BITS_PER_PACKET} bits-per-packet")
 
 try:
     print("Modbus TCP Server is starting up")
@@ -36,5 +67,6 @@ try:
 except KeyboardInterrupt:
     print("Stopping Modbus TCP Server...")
     server.stop()
-    logging.info(f"Hidden Message {ReadMsgS1.hidden_message_s1}")
+    for hidden_message in ReadMsgS1.sink.messages():
+        logging.info(f"Hidden Message {hidden_message}")
     print("Modbus TCP Server is stopped")
@@ -0,0 +1,7 @@
+SERVER_ENGINE_THREADING = 'threading'  # One OS thread per client connection with blocking sockets (pyModbusTCP)
+SERVER_ENGINE_ASYNCIO = 'asyncio'  # All client connections are served as coroutines on one event loop
+ASYNC_BACKLOG = 4096  # Number of pending connections the asyncio server engine accepts at once
+MBAP_HEADER_SIZE = 7  # Size of the MBAP header of a modbus/TCP frame in bytes
+RECV_BUFFER_SIZE = 4096  # Size of the preallocated receive buffer per socket, fits several modbus/TCP frames
+REGISTER_SPACE_SIZE = 0x10000  # Number of addresses of each data space (coils, discrete inputs, holding and input registers)
+REGISTER_PAGE_SIZE = 256  # Number of addresses of one page of a paged data space, allocated on its first write
@@ -0,0 +1,108 @@
+import logging
+import sys
+
+import numpy as np
+
+from PacketTrace import read_trace, TRACE_CACHE_HIT, TRACE_EXCEPTION
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                    handlers=[logging.StreamHandler(sys.stdout)])
+
+
+class ModbusTraceAnalyser:
+    """Same analysis as ModbusLogAnalyser in AnalyseLogsOfComponents.py, but on the binary packet trace written by the
+        segments with the environment variable PACKET_TRACE_FILE. The records are read as NumPy structured arrays, so
+        that no log line has to be parsed."""
+
+    def __init__(self, file_path):
+        chunks = list(read_trace(file_path))
+        if not chunks:
+            raise ValueError(f"No trace records in {file_path}")
+        self._trace = np.concatenate(chunks)
+        logging.info(f"{len(self._trace)} transactions read from {file_path}")
+
+    def analyse_transaction_id_endpoints(self):
+        """At endpoints(client and server) the transaction id of request, and it's corresponding response must be the
+            same"""
+        if np.array_equal(self._trace['request_tid'], self._trace['response_tid']):
+            logging.info("All transaction IDs match!")
+        else:
+            logging.error("Transaction ID mismatch")
+        self.analyse_transaction_id_increment()
+
+    def analyse_transaction_id_increment(self):
+        """Check if the transactionIDs increase by 1 for each new request"""
+        request_tids = self._trace['request_tid'].astype(np.int64)
+        not_incremented = np.flatnonzero(np.diff(request_tids) != 1)
+        for i in not_incremented:
+            logging.warning(f"Transaction ID is not increased by 1: {request_tids[i]} and {request_tids[i + 1]}")
+        if len(not_incremented) == 0:
+            logging.info("All TIDs are incremented by 1 from previous TID")
+        else:
+            logging.warning("Some TIDs are increased different from previous TID")
+
+    def analyse_protocol_id(self):
+        if (self._trace['protocol_id'] == 0).all():
+            logging.info("All protocol IDs are zero")
+        else:
+            logging.warning("Some protocol IDs are not zero")
+
+    def analyse_unit_id(self):
+        # In this experiment we only have one modbus-client, so that the unit_id will always be 1
+        if (self._trace['unit_id'] == 1).all():
+            logging.info("All unit IDs are one")
+        else:
+            logging.warning("Some unit IDs are not one")
+
+    def analyse_payload_length(self):
+        """calculate mean and standard deviation (sample standard deviation like statistics.stdev) of lengths"""
+        for packet_type, field in (("requests", 'request_lf'), ("responses", 'response_lf')):
+            lengths = self._trace[field]
+            logging.info(f"Mean of all payload length in {packet_type}: {round(float(lengths.mean()), 4)}")
+            logging.info(f"standard deviation of all payload lengths in {packet_type}: "
+                         f"{round(float(lengths.std(ddof=1)), 9)}")
+
+    def analysing_rtt(self):
+        round_trip_times = self._trace['round_trip_time']
+        logging.info(f"Mean of all RTT values: {round(float(round_trip_times.mean()), 4)}")
+        logging.info(f"Standard deviation of all RTT values: {round(float(round_trip_times.std(ddof=1)), 4)}")
+
+    def analyse_response_source(self):
+        """Count the responses built from cache of the proxy server and the modbus exceptions"""
+        flags = self._trace['flags']
+        logging.info(f"Responses from cache: {np.count_nonzero(flags & TRACE_CACHE_HIT)}, "
+                     f"modbus exceptions: {np.count_nonzero(flags & TRACE_EXCEPTION)}")
+
+    def run_analysis_on_proxy_trace(self):
+        self.analyse_transaction_id_increment()
+        self.analyse_protocol_id()
+        self.analyse_unit_id()
+        self.analyse_payload_length()
+        self.analysing_rtt()
+        self.analyse_response_source()
+
+    def run_analysis_on_client_trace(self):
+        self.analyse_transaction_id_endpoints()
+        self.analyse_protocol_id()
+        self.analyse_unit_id()
+        self.analyse_payload_length()
+        self.analysing_rtt()
+
+    def run_analysis_on_server_trace(self):
+        # On server transaction_id isn't checked, because of caching, some packet will not arrive server at all.
+        self.analyse_protocol_id()
+        self.analyse_unit_id()
+        self.analyse_payload_length()
+        self.analysing_rtt()
+
+
+if __name__ == '__main__':
+    # usage: python AnalysePacketTrace.py <client trace> <proxy trace> <server trace>
+    clientAnalyser = ModbusTraceAnalyser(sys.argv[1])
+    clientAnalyser.run_analysis_on_client_trace()
+    logging.info("------------------------------------------------------------------")
+    proxyAnalyser = ModbusTraceAnalyser(sys.argv[2])
+    proxyAnalyser.run_analysis_on_proxy_trace()
+    logging.info("------------------------------------------------------------------")
+    serverAnalyser = ModbusTraceAnalyser(sys.argv[3])
+    serverAnalyser.run_analysis_on_server_trace()